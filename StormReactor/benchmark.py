@@ -0,0 +1,285 @@
+"""
+Benchmarks for the per-step cost of StormReactor.
+
+Every water quality method is run on synthetic star networks of storage
+nodes (see StormReactor.networks), each one treated, and the time spent in
+SWMM's step is separated from the time spent in waterQuality.updateWQState
+(the Python overhead). Toolkit get/set calls are counted per step. Results
+are saved as JSON so a later run can be compared against them to catch
+performance regressions.
+
+The "numba" engine runs the batch engine with the compiled kernels (see
+StormReactor.jit); compare it with the "per-asset" and "batch" engines
+for the speedup of a whole run. benchmark_kernels times the kernels alone
+on synthetic inputs: the loops of StormReactor.jit before compilation,
+the NumPy kernel and, if Numba is installed, the compiled kernel.
+
+Usage:
+    python -m StormReactor.benchmark --sizes 10 100 1000 10000 --output results.json
+    python -m StormReactor.benchmark --output new.json --baseline results.json
+    python -m StormReactor.benchmark --kernels --sizes 100 10000 1000000
+"""
+
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import numpy as np
+import pyswmm
+from pyswmm import Simulation
+
+import StormReactor
+from StormReactor import jit, kernels
+from StormReactor.networks import METHOD_PARAMETERS, generate_network
+from StormReactor.waterQuality import ToolkitCounter, waterQuality
+
+SIZES = (10, 100, 1000, 10000)
+ENGINES = ("batch", "per-asset", "numba")
+
+
+def benchmark_method(method, n_assets, steps=100, vectorize=True, workdir=None, backend="numpy"):
+    """
+    Runs one water quality method in every tank of an n_assets network for
+    the given number of steps and returns a result record. Without a
+    workdir, the model files are written to a temporary directory that is
+    removed afterwards.
+    """
+
+    if workdir is None:
+        with tempfile.TemporaryDirectory(prefix="stormreactor_bench_") as workdir:
+            return benchmark_method(method, n_assets, steps, vectorize, workdir, backend)
+    inp = os.path.join(workdir, "network_{}.inp".format(n_assets))
+    config = generate_network(inp, n_assets, topology="star", methods=method, duration=steps+1)
+
+    swmm_time = 0.0
+    wq_time = 0.0
+    start = time.perf_counter()
+    with Simulation(inp, os.path.join(workdir, "bench.rpt"), os.path.join(workdir, "bench.out")) as sim:
+        counter = ToolkitCounter(sim)
+        WQ = waterQuality(sim, config, vectorize=vectorize, backend=backend)
+        setup = time.perf_counter() - start
+        counter.gets = counter.sets = 0
+        steps_run = 0
+        for step in range(steps):
+            t0 = time.perf_counter()
+            try:
+                next(sim)
+            except StopIteration:
+                break
+            t1 = time.perf_counter()
+            WQ.updateWQState()
+            t2 = time.perf_counter()
+            swmm_time += t1 - t0
+            wq_time += t2 - t1
+            steps_run += 1
+        avoided = WQ.cache.avoided
+        counter.close()
+
+    steps_run = max(steps_run, 1)
+    return {
+        "method": method,
+        "n_assets": n_assets,
+        "engine": ("numba" if WQ.backend == "numba" else "batch") if vectorize else "per-asset",
+        "steps": steps_run,
+        "setup_s": setup,
+        "wall_per_step_s": (swmm_time + wq_time)/steps_run,
+        "swmm_per_step_s": swmm_time/steps_run,
+        "wq_per_step_s": wq_time/steps_run,
+        "wq_per_asset_step_us": 1e6*wq_time/steps_run/n_assets,
+        "python_overhead_ratio": wq_time/swmm_time if swmm_time > 0 else float("nan"),
+        "toolkit_gets_per_step": counter.gets/steps_run,
+        "toolkit_sets_per_step": counter.sets/steps_run,
+        "toolkit_gets_avoided_per_step": avoided/steps_run,
+        }
+
+
+def run_benchmarks(methods=None, sizes=SIZES, steps=100, engines=("batch", "per-asset"), verbose=True):
+    """
+    Benchmarks every method, network size and engine and returns the
+    list of result records.
+    """
+
+    methods = methods or list(METHOD_PARAMETERS)
+    records = []
+    with tempfile.TemporaryDirectory(prefix="stormreactor_bench_") as workdir:
+        for n_assets in sizes:
+            for method in methods:
+                for engine in engines:
+                    backend = "numba" if engine == "numba" else "numpy"
+                    record = benchmark_method(method, n_assets, steps, engine != "per-asset", workdir, backend)
+                    records.append(record)
+                    if verbose:
+                        print("{method:>18} {n_assets:>6} {engine:>9}  wq {wq_per_step_s:.2e} s/step"
+                              "  swmm {swmm_per_step_s:.2e} s/step  overhead x{python_overhead_ratio:.2f}"
+                              "  gets {toolkit_gets_per_step:.0f}  sets {toolkit_sets_per_step:.0f}".format(**record))
+    return records
+
+
+def kernel_inputs(method, n_assets, seed=0):
+    """
+    Returns synthetic (state, arguments) for one call of a compiled
+    method's kernel on n_assets assets: half of the assets are quiescent
+    or dry, concentrations straddle the method's thresholds. For CSTR the
+    arguments are those of the right-hand side.
+    """
+
+    rng = np.random.default_rng(seed)
+    C = rng.uniform(0.0, 20.0, n_assets)
+    Q = rng.uniform(0.0, 0.2, n_assets)
+    d = rng.uniform(0.0, 2.0, n_assets)
+    parameters = [np.full(n_assets, float(value)) for name, value in METHOD_PARAMETERS[method].items()
+                  if name != "c0"]
+    if method == "ConcDependRemoval":
+        return None, [C] + parameters
+    if method == "GravitySettling":
+        return None, [C, Q, d, 60.0] + parameters
+    if method == "Phosphorus":
+        return kernels.AssetState(n_assets), [C, Q, 60.0] + parameters
+    V = rng.uniform(1.0, 100.0, n_assets)
+    return None, [0.0, C, Q, rng.uniform(0.0, 20.0, n_assets), Q, V] + parameters
+
+
+def _uncompiled(kernel):
+    # The loops of StormReactor.jit before compilation
+    return getattr(kernel, "py_func", kernel)
+
+
+def _uncompiled_phosphorus(state, *args):
+    return _uncompiled(jit._phosphorus_event)(state.event_time, *args)
+
+
+def benchmark_kernels(sizes=(100, 10000, 1000000), repeat=20, verbose=True):
+    """
+    Times one call of every compiled method's kernel (the CSTR right-hand
+    side for CSTR) with the uncompiled loop of StormReactor.jit, the NumPy
+    kernel and, if Numba is installed, the compiled kernel, and returns
+    the records with the speedup of each over the uncompiled loop. The
+    uncompiled loop is not used by either engine; it shows what Numba
+    compiles away. It is timed once on at most 10,000 assets and scaled,
+    since it is slow.
+    """
+
+    def timed(func, state, args, repeat):
+        best = float("inf")
+        for _ in range(repeat):
+            t0 = time.perf_counter()
+            func(*args) if state is None else func(state, *args)
+            best = min(best, time.perf_counter() - t0)
+        return best
+
+    numpy_kernels = {method: kernels.BATCH_KERNELS[method].func for method in jit.JIT_KERNELS}
+    numpy_kernels["CSTR"] = kernels.cstr_tank
+    jit_kernels = {method: jit.JIT_KERNELS[method].func for method in jit.JIT_KERNELS}
+    jit_kernels["CSTR"] = jit.cstr_tank
+    records = []
+    for n_assets in sizes:
+        for method in jit.JIT_KERNELS:
+            loop_kernel = _uncompiled_phosphorus if method == "Phosphorus" else _uncompiled(jit_kernels[method])
+            n_loop = min(n_assets, 10000)
+            state, args = kernel_inputs(method, n_loop)
+            record = {"method": method, "n_assets": n_assets,
+                      "loop_s": timed(loop_kernel, state, args, 1)*n_assets/n_loop}
+            state, args = kernel_inputs(method, n_assets)
+            record["numpy_s"] = timed(numpy_kernels[method], state, args, repeat)
+            record["numba_s"] = float("nan")
+            if jit.NUMBA_AVAILABLE:
+                # The first call compiles the kernel
+                timed(jit_kernels[method], state, args, 1)
+                record["numba_s"] = timed(jit_kernels[method], state, args, repeat)
+            record["numpy_speedup"] = record["loop_s"]/record["numpy_s"]
+            record["numba_speedup"] = record["loop_s"]/record["numba_s"]
+            record["numba_vs_numpy"] = record["numpy_s"]/record["numba_s"]
+            records.append(record)
+            if verbose:
+                print("{method:>18} {n_assets:>8}  uncompiled loop {loop_s:.2e} s  numpy {numpy_s:.2e} s"
+                      " (x{numpy_speedup:.0f})  numba {numba_s:.2e} s (x{numba_speedup:.0f})".format(**record))
+    if verbose and not jit.NUMBA_AVAILABLE:
+        print("Numba is not installed; only the uncompiled loops and NumPy kernels were timed.")
+    return records
+
+
+def save_results(records, path):
+    """
+    Saves benchmark records and the environment they were measured in as JSON.
+    """
+
+    results = {
+        "created": datetime.now().isoformat(),
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "numpy": np.__version__,
+            "pyswmm": pyswmm.__version__,
+            "StormReactor": StormReactor.__version__,
+            },
+        "records": records,
+        }
+    with open(path, "w") as f:
+        json.dump(results, f, indent=2)
+    return results
+
+
+def load_results(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def compare_results(baseline, current, tolerance=0.25, metric="wq_per_step_s"):
+    """
+    Compares two sets of benchmark records and returns the records of
+    current whose metric is more than tolerance (fractional) slower than
+    the matching baseline record, as (baseline record, current record)
+    pairs.
+    """
+
+    def key(record):
+        return record["method"], record["n_assets"], record["engine"]
+
+    reference = {key(record): record for record in baseline["records"]}
+    regressions = []
+    for record in current["records"]:
+        old = reference.get(key(record))
+        if old is not None and record[metric] > old[metric]*(1+tolerance):
+            regressions.append((old, record))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the per-step cost of StormReactor.")
+    parser.add_argument("--methods", nargs="+", choices=sorted(METHOD_PARAMETERS), default=None)
+    parser.add_argument("--sizes", nargs="+", type=int, default=list(SIZES))
+    parser.add_argument("--steps", type=int, default=100)
+    parser.add_argument("--engines", nargs="+", choices=ENGINES, default=["batch", "per-asset"])
+    parser.add_argument("--kernels", action="store_true", help="time the compiled methods' kernels alone")
+    parser.add_argument("--output", default="stormreactor_benchmark.json")
+    parser.add_argument("--baseline", default=None, help="earlier results to check for regressions")
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    args = parser.parse_args(argv)
+
+    if args.kernels:
+        records = benchmark_kernels(args.sizes)
+        save_results(records, args.output)
+        print("Results saved to {}".format(args.output))
+        return 0
+
+    records = run_benchmarks(args.methods, args.sizes, args.steps, args.engines)
+    results = save_results(records, args.output)
+    print("Results saved to {}".format(args.output))
+
+    if args.baseline:
+        regressions = compare_results(load_results(args.baseline), results, args.tolerance)
+        for old, new in regressions:
+            print("REGRESSION {method} {n_assets} {engine}: {old:.2e} -> {new:.2e} s/step".format(
+                old=old["wq_per_step_s"], new=new["wq_per_step_s"], **new))
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
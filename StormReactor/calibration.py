@@ -0,0 +1,302 @@
+"""
+Calibration of treatment parameters against observed series.
+
+Free parameters (with bounds) of one or more treatments are fitted to
+observed concentration or load series at one or more assets with a SciPy
+optimizer. The objective is the weighted mean squared error over every
+observation. Candidates are evaluated in a pool of worker processes (see
+StormReactor.ensemble), parameter sets that were already simulated to the
+end are answered from a cache, and a trial is stopped as soon as its
+partial error is worse than the best complete error so far: the squared
+errors only accumulate, so such a trial cannot become the best one. The
+partial errors of stopped trials are not cached, so a stopped parameter
+set is simulated again if the optimizer proposes it again.
+
+Example:
+    observations = [Observation("Tank", "P1", times, measured)]
+    free = {"Tank": {"k": (0.0, 1.0), "C_s": (0.0, 10.0)}}
+    if __name__ == "__main__":
+        result = calibrate("model.inp", config, observations, free)
+        print(result.parameters, result.error)
+
+Scripts that calibrate with workers need the if __name__ == "__main__"
+guard because workers are started with the "spawn" method by default.
+"""
+
+from collections import namedtuple
+
+import numpy as np
+import pyswmm.toolkitapi as tka
+from pyswmm import Simulation
+from scipy import optimize
+
+from StormReactor.ensemble import EnsemblePool, apply_overrides
+from StormReactor.waterQuality import ElementType, waterQuality
+
+# Observed series at one asset. times are seconds since the start of the
+# simulation; kind is "concentration" or "load" (outflow times
+# concentration); weight scales the squared errors of the series.
+Observation = namedtuple("Observation", ["ID", "pollutant", "times", "values", "kind", "weight"],
+                         defaults=("concentration", 1.0))
+
+KINDS = ("concentration", "load")
+
+# Result of a calibration. parameters are overrides (see
+# ensemble.apply_overrides) and config is the calibrated config.
+CalibrationResult = namedtuple("CalibrationResult", ["parameters", "config", "error", "evaluations",
+                                                     "cache_hits", "pruned", "optimizer"])
+
+
+class Objective:
+    """
+    Weighted mean squared error of a simulation against observed series.
+
+    observations = list of Observations
+    """
+
+    def __init__(self, observations):
+        self.observations = []
+        for observation in observations:
+            observation = Observation(*observation)
+            if observation.kind not in KINDS:
+                raise ValueError("Unknown observation kind '{}'. Valid kinds are: {}".format(
+                    observation.kind, ", ".join(KINDS)))
+            times = np.asarray(observation.times, dtype=float)
+            values = np.asarray(observation.values, dtype=float)
+            if times.shape != values.shape:
+                raise ValueError("Observation of {} has {} times but {} values".format(
+                    (observation.ID, observation.pollutant), len(times), len(values)))
+            order = np.argsort(times, kind="stable")
+            self.observations.append(observation._replace(times=times[order], values=values[order]))
+        self.total = sum(o.weight*len(o.values) for o in self.observations)
+
+    def _sources(self, WQ):
+        """
+        Locates the simulated value of every observation in the state cache.
+        """
+
+        model = WQ.sim._model
+        sources = []
+        for observation in self.observations:
+            if observation.ID not in WQ.config:
+                raise ValueError("'{}' is not in the water quality config".format(observation.ID))
+            element_type = ElementType.Nodes if WQ.config[observation.ID]["type"] == "node" else ElementType.Links
+            quality = WQ.cache.buffer(element_type, "quality")
+            flow = WQ.cache.buffer(element_type, "outflow") if observation.kind == "load" else None
+            sources.append((quality, quality.rows([observation.ID]), flow,
+                            flow.rows([observation.ID]) if flow is not None else None,
+                            model.getObjectIDIndex(tka.ObjectType.POLLUT, observation.pollutant)))
+        return sources
+
+    def run(self, inp, config, threshold=np.inf, reportfile=None, outputfile=None, steps=None):
+        """
+        Simulates config and returns (error, complete). The simulation
+        stops once every observation is matched, or as soon as the partial
+        error (squared errors so far over all observations) exceeds
+        threshold. complete is then False and error is the mean squared
+        error of the observations matched so far, which is above threshold.
+        """
+
+        with Simulation(inp, reportfile, outputfile) as sim:
+            WQ = waterQuality(sim, config)
+            sources = self._sources(WQ)
+            pointers = [0]*len(self.observations)
+            squared_error = 0.0
+            matched = 0.0
+            for index, step in enumerate(sim):
+                WQ.updateWQState()
+                time = (sim.current_time - WQ.start_time).total_seconds()
+                for k, observation in enumerate(self.observations):
+                    end = np.searchsorted(observation.times, time, side="right")
+                    if end > pointers[k]:
+                        squared_error += self._score(WQ, k, sources[k], pointers[k], end)
+                        matched += observation.weight*(end - pointers[k])
+                        pointers[k] = end
+                if squared_error/self.total > threshold:
+                    return squared_error/matched, False
+                if all(p == len(o.times) for p, o in zip(pointers, self.observations)):
+                    break
+                if steps is not None and index+1 >= steps:
+                    break
+            # Observations after the end of the run are compared with the
+            # final state
+            for k, observation in enumerate(self.observations):
+                squared_error += self._score(WQ, k, sources[k], pointers[k], len(observation.times))
+            return squared_error/self.total, True
+
+    def _score(self, WQ, k, source, start, end):
+        """
+        Weighted squared error of observations start:end of observation k
+        against the current simulated value.
+        """
+
+        if end <= start:
+            return 0.0
+        quality, rows, flow, flow_rows, column = source
+        value = WQ.cache.read(quality, rows, column)[0]
+        if flow is not None:
+            value *= WQ.cache.read(flow, flow_rows)[0]
+        residuals = value - self.observations[k].values[start:end]
+        return self.observations[k].weight*np.dot(residuals, residuals)
+
+
+def _run_trial(inp, config, task, objective, reportfile, outputfile, steps):
+    """
+    Ensemble runner for calibration trials: task is (overrides, threshold).
+    """
+
+    overrides, threshold = task
+    return objective.run(inp, apply_overrides(config, overrides), threshold, reportfile, outputfile, steps)
+
+
+class Calibration:
+    """
+    Fits free treatment parameters to observed series.
+
+    inp = path of the SWMM model
+    config = water quality config; the free parameters are overridden in it
+    observations = list of Observations
+    free = {asset_ID or (asset_ID, pollutant): {parameter: (low, high)}}
+    workers = number of worker processes; 0 evaluates every candidate in
+        this process (default: one per core)
+    prune = stop trials whose partial error exceeds the best error so far;
+        pruned trials score the error of the observations they matched,
+        which is not cached (leave it off for gradient-based optimizers)
+    steps = stop each simulation after this many steps
+    timeout = seconds after which a trial is stopped and scores inf
+    context = multiprocessing start method
+    """
+
+    def __init__(self, inp, config, observations, free, workers=None, prune=True,
+                 steps=None, timeout=None, context="spawn"):
+        self.inp = inp
+        self.config = config
+        self.objective = Objective(observations)
+        self.names = [(key, name) for key, parameters in free.items() for name in parameters]
+        self.bounds = [tuple(float(b) for b in free[key][name]) for key, name in self.names]
+        for (key, name), (low, high) in zip(self.names, self.bounds):
+            if low > high:
+                raise ValueError("Lower bound of {} {} is above its upper bound".format(key, name))
+        # Fail early on unknown assets or pollutants
+        apply_overrides(config, self.overrides([low for low, high in self.bounds]))
+        self.prune = prune
+        self.steps = steps
+        self.pool = None
+        if workers != 0:
+            self.pool = EnsemblePool(inp, config, self.objective, workers, steps, timeout,
+                                     context=context, runner=_run_trial)
+        self.cache = {}
+        self.evaluations = 0
+        self.cache_hits = 0
+        self.pruned = 0
+        self.best = np.inf
+        self.best_x = None
+
+    def overrides(self, x):
+        """
+        Returns the overrides of the parameter vector x.
+        """
+
+        overrides = {}
+        for (key, name), value in zip(self.names, x):
+            overrides.setdefault(key, {})[name] = float(value)
+        return overrides
+
+    def _record(self, x, error, complete):
+        if not complete:
+            self.pruned += 1
+        else:
+            if error < self.best:
+                self.best = error
+                self.best_x = x
+            self.cache[x] = error
+        self.evaluations += 1
+        return error
+
+    def evaluate(self, candidates):
+        """
+        Returns the error of every candidate parameter vector. New
+        candidates are simulated in parallel; all of them are pruned
+        against the best error found before the call. Candidates pruned
+        before are simulated again.
+        """
+
+        keys = [tuple(float(v) for v in np.atleast_1d(x)) for x in candidates]
+        new = [x for x in dict.fromkeys(keys) if x not in self.cache]
+        self.cache_hits += len(keys) - len(new)
+        errors = {}
+        if self.pool is None:
+            for x in new:
+                threshold = self.best if self.prune else np.inf
+                result = self.objective.run(self.inp, apply_overrides(self.config, self.overrides(x)),
+                                            threshold, steps=self.steps)
+                errors[x] = self._record(x, *result)
+        elif new:
+            threshold = self.best if self.prune else np.inf
+            tasks = ((self.overrides(x), threshold) for x in new)
+            for member in self.pool.stream(tasks):
+                x = new[member.index]
+                if member.error is not None:
+                    print("Calibration trial {} failed: {}".format(self.overrides(x), member.error))
+                    errors[x] = self._record(x, np.inf, True)
+                else:
+                    errors[x] = self._record(x, *member.result)
+        return [errors[x] if x in errors else self.cache[x] for x in keys]
+
+    def __call__(self, x):
+        return self.evaluate([x])[0]
+
+    def map(self, func, candidates):
+        """
+        Map-like callable for the workers argument of SciPy's
+        differential_evolution: evaluates a whole population at once.
+        """
+
+        return self.evaluate(list(candidates))
+
+    def fit(self, method="differential_evolution", x0=None, **options):
+        """
+        Runs the optimizer and returns a CalibrationResult.
+
+        method = "differential_evolution" (global, evaluates each
+            population in parallel) or any scipy.optimize.minimize method
+            (e.g. "Nelder-Mead", "Powell"; one candidate at a time)
+        x0 = starting point of minimize (default: the middle of the bounds)
+        options = passed to the optimizer
+        """
+
+        if method == "differential_evolution":
+            options.setdefault("polish", False)
+            result = optimize.differential_evolution(self, self.bounds, workers=self.map,
+                                                     updating="deferred", **options)
+        else:
+            if x0 is None:
+                x0 = [(low + high)/2 for low, high in self.bounds]
+            result = optimize.minimize(self, x0, method=method, bounds=self.bounds, **options)
+        if self.best_x is None:
+            raise RuntimeError("No calibration trial finished")
+        parameters = self.overrides(self.best_x)
+        return CalibrationResult(parameters, apply_overrides(self.config, parameters), self.best,
+                                 self.evaluations, self.cache_hits, self.pruned, result)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def calibrate(inp, config, observations, free, method="differential_evolution", workers=None,
+              prune=True, steps=None, timeout=None, x0=None, **options):
+    """
+    Fits free treatment parameters to observed series (see Calibration)
+    and returns a CalibrationResult.
+    """
+
+    with Calibration(inp, config, observations, free, workers, prune, steps, timeout) as calibration:
+        return calibration.fit(method, x0, **options)
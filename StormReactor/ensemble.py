@@ -0,0 +1,289 @@
+"""
+Parallel ensemble runs of a StormReactor model.
+
+SWMM allows one simulation per process, so each ensemble member (one set
+of parameter overrides) runs its Simulation + waterQuality loop in a
+worker process. Workers are reused across members, results are streamed
+back as members finish, and a member that raises or kills its worker
+(e.g. a crash inside SWMM) is reported as failed while the rest of the
+ensemble keeps running. Each member writes its own .rpt/.out files.
+
+Example:
+    overrides = [{"Tank": {"k": k, "C_s": C_s}} for k in (0.01, 0.1) for C_s in (1.0, 5.0)]
+    if __name__ == "__main__":
+        for member in stream_ensemble("model.inp", config, overrides):
+            print(member.index, member.error or member.result[("Tank", "P1")]["outflow"])
+
+Scripts that start an ensemble need the if __name__ == "__main__" guard
+because workers are started with the "spawn" method by default.
+"""
+
+import copy
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+import traceback
+from collections import namedtuple
+from multiprocessing.connection import wait
+
+from pyswmm import Simulation
+
+from StormReactor.waterQuality import waterQuality
+
+# Result of one ensemble member. error is None if the member succeeded,
+# otherwise the traceback or the reason the worker died.
+MemberResult = namedtuple("MemberResult", ["index", "overrides", "result", "error"])
+
+
+def apply_overrides(config, overrides):
+    """
+    Returns a copy of config with parameter overrides applied.
+
+    overrides = {asset_ID: {parameter: value}} sets the parameters of
+        every treatment of the asset; use (asset_ID, pollutant) as the key
+        to override one treatment of an asset with several treatments
+    """
+
+    config = copy.deepcopy(config)
+    for key, parameters in overrides.items():
+        asset_ID, pollutant = key if isinstance(key, tuple) else (key, None)
+        if asset_ID not in config:
+            raise KeyError("'{}' is not in the water quality config".format(asset_ID))
+        treatments = config[asset_ID].get("treatments", [config[asset_ID]])
+        matched = [t for t in treatments if pollutant is None or t.get("pollutant", None) == pollutant]
+        if not matched:
+            raise KeyError("'{}' does not treat pollutant '{}'".format(asset_ID, pollutant))
+        for treatment in matched:
+            treatment["parameters"] = dict(treatment.get("parameters", {}), **parameters)
+    return config
+
+
+def summarize(WQ):
+    """
+    Default reducer: the mass balance of every treated asset (inflow,
+    outflow, removed and stored loads, continuity error and peak
+    concentration) and the network continuity error.
+    """
+
+    result = {key: {name: float(value) for name, value in totals.items()}
+              for key, totals in WQ.massBalance().items()}
+    result["continuity_error"] = WQ.continuityError()
+    return result
+
+
+def run_member(inp, config, reducer=summarize, reportfile=None, outputfile=None, steps=None):
+    """
+    Runs one simulation with StormReactor and returns reducer(WQ).
+    """
+
+    with Simulation(inp, reportfile, outputfile) as sim:
+        WQ = waterQuality(sim, config, mass_balance=True)
+        for index, step in enumerate(sim):
+            WQ.updateWQState()
+            if steps is not None and index+1 >= steps:
+                break
+        return reducer(WQ)
+
+
+def _run_overrides(inp, config, overrides, reducer, reportfile, outputfile, steps):
+    """
+    Default member runner: applies the overrides and runs the simulation.
+    """
+
+    return run_member(inp, apply_overrides(config, overrides), reducer, reportfile, outputfile, steps)
+
+
+def _worker(conn, inp, config, reducer, workdir, steps, runner):
+    """
+    Worker process: runs members sent over conn until it receives None.
+    """
+
+    while True:
+        task = conn.recv()
+        if task is None:
+            break
+        index, overrides = task
+        reportfile = os.path.join(workdir, "member_{}.rpt".format(index))
+        outputfile = os.path.join(workdir, "member_{}.out".format(index))
+        try:
+            result = runner(inp, config, overrides, reducer, reportfile, outputfile, steps)
+            conn.send((index, result, None))
+        except Exception:
+            conn.send((index, None, traceback.format_exc()))
+    conn.close()
+
+
+class _Worker:
+    def __init__(self, context, args):
+        self.conn, child = context.Pipe()
+        self.process = context.Process(target=_worker, args=(child,) + args, daemon=True)
+        self.process.start()
+        child.close()
+        self.task = None
+        self.started = None
+
+    def send(self, task):
+        self.task = task
+        self.started = time.monotonic()
+        self.conn.send(task)
+
+    def kill(self):
+        self.process.terminate()
+        self.process.join()
+        self.conn.close()
+
+    def stop(self):
+        try:
+            self.conn.send(None)
+        except (BrokenPipeError, OSError):
+            pass
+        self.process.join(5)
+        if self.process.is_alive():
+            self.process.terminate()
+        self.conn.close()
+
+
+class EnsemblePool:
+    """
+    Pool of worker processes that run ensemble members of one model. The
+    workers are kept alive between calls to stream, so a caller that
+    submits members in batches (e.g. an optimizer) only starts them once.
+
+    inp = path of the SWMM model
+    config = water quality config shared by all members
+    reducer = function of the finished waterQuality object that returns
+        the (picklable) result of a member; it must be importable by the
+        workers. The default (summarize) returns the mass balance.
+    workers = number of worker processes (default: one per core)
+    steps = stop each simulation after this many steps
+    timeout = seconds after which a member is stopped and reported failed
+    workdir = directory for the members' .rpt/.out files (default: a
+        temporary directory that is removed on close)
+    keep_files = keep the members' .rpt/.out files
+    context = multiprocessing start method
+    runner = function (inp, config, overrides, reducer, reportfile,
+        outputfile, steps) that runs one member in a worker; the default
+        applies the overrides to config and runs the whole simulation
+    """
+
+    def __init__(self, inp, config, reducer=summarize, workers=None, steps=None, timeout=None,
+                 workdir=None, keep_files=False, context="spawn", runner=_run_overrides):
+        self.context = multiprocessing.get_context(context)
+        self.workers = workers or os.cpu_count() or 1
+        self.timeout = timeout
+        self.cleanup = workdir is None and not keep_files
+        self.workdir = workdir or tempfile.mkdtemp(prefix="stormreactor_ensemble_")
+        self.args = (os.path.abspath(inp), config, reducer, self.workdir, steps, runner)
+        self.pool = []
+
+    def stream(self, overrides):
+        """
+        Runs one member per set of overrides and yields a MemberResult for
+        each member as it finishes (not necessarily in order). overrides is
+        consumed lazily, one member at a time.
+        """
+
+        members = enumerate(overrides)
+        pool = self.pool
+        timeout = self.timeout
+        pending = True
+        try:
+            while pending or any(worker.task is not None for worker in pool):
+                # Hand out members to idle workers, starting workers as needed
+                idle = [worker for worker in pool if worker.task is None]
+                while pending and (idle or len(pool) < self.workers):
+                    task = next(members, None)
+                    if task is None:
+                        pending = False
+                        break
+                    worker = idle.pop() if idle else _Worker(self.context, self.args)
+                    if worker not in pool:
+                        pool.append(worker)
+                    worker.send(task)
+
+                busy = [worker for worker in pool if worker.task is not None]
+                if not busy:
+                    continue
+                wait_time = None
+                if timeout is not None:
+                    wait_time = max(0.0, min(worker.started + timeout for worker in busy) - time.monotonic())
+                ready = wait([w.conn for w in busy] + [w.process.sentinel for w in busy], wait_time)
+
+                for worker in busy:
+                    index, member_overrides = worker.task
+                    if worker.conn in ready:
+                        try:
+                            _, result, error = worker.conn.recv()
+                            worker.task = None
+                            yield MemberResult(index, member_overrides, result, error)
+                            continue
+                        except (EOFError, OSError):
+                            pass
+                    if worker.process.sentinel in ready or worker.conn in ready:
+                        worker.process.join()
+                        error = "worker process died with exit code {}".format(worker.process.exitcode)
+                    elif timeout is not None and time.monotonic() - worker.started >= timeout:
+                        error = "member timed out after {} s".format(timeout)
+                    else:
+                        continue
+                    # Replace the worker; the member is reported as failed
+                    worker.kill()
+                    pool.remove(worker)
+                    yield MemberResult(index, member_overrides, None, error)
+        finally:
+            # Members still running when the caller stops iterating would
+            # answer the next call; drop their workers
+            for worker in [worker for worker in pool if worker.task is not None]:
+                worker.kill()
+                pool.remove(worker)
+
+    def close(self):
+        for worker in self.pool:
+            worker.stop()
+        self.pool = []
+        if self.cleanup:
+            shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def stream_ensemble(inp, config, overrides, reducer=summarize, workers=None, steps=None,
+                    timeout=None, workdir=None, keep_files=False, context="spawn"):
+    """
+    Runs one simulation per set of parameter overrides in a pool of worker
+    processes and yields a MemberResult for each member as it finishes
+    (not necessarily in order).
+
+    inp = path of the SWMM model
+    config = water quality config shared by all members
+    overrides = list or generator of overrides (see apply_overrides); it
+        is consumed lazily, one member at a time
+    reducer = function of the finished waterQuality object that returns
+        the (picklable) result of a member; it must be importable by the
+        workers. The default (summarize) returns the mass balance.
+    workers = number of worker processes (default: one per core)
+    steps = stop each simulation after this many steps
+    timeout = seconds after which a member is stopped and reported failed
+    workdir = directory for the members' .rpt/.out files (default: a
+        temporary directory that is removed afterwards)
+    keep_files = keep the members' .rpt/.out files
+    context = multiprocessing start method
+    """
+
+    with EnsemblePool(inp, config, reducer, workers, steps, timeout, workdir, keep_files, context) as pool:
+        yield from pool.stream(overrides)
+
+
+def run_ensemble(inp, config, overrides, **options):
+    """
+    Runs an ensemble (see stream_ensemble) and returns the list of
+    MemberResults in member order.
+    """
+
+    return sorted(stream_ensemble(inp, config, overrides, **options), key=lambda member: member.index)
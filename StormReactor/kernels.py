@@ -0,0 +1,421 @@
+"""
+Batch water quality kernels for StormReactor.
+
+Each kernel evaluates one water quality method for every asset that uses
+it in a single NumPy call. Inputs are arrays with one entry per asset
+(SWMM states gathered by waterQuality, method parameters and the model
+dt), and the return value is the array of new concentrations. A kernel
+may also return a (Cnew, mask) tuple, in which case only the assets where
+mask is True are updated in SWMM.
+
+Stateful kernels (CSTR, Phosphorus) also take a per-group state object as
+their first argument. The state is created from the group's parameter
+arrays when the simulation starts and is carried across steps. Per-asset
+state lives in records of STATE_DTYPE (see AssetState), which waterQuality
+allocates as one array for every stateful asset.
+
+The formulas are identical to the per-asset methods in waterQuality; the
+heaviside switches are written with np.where, which selects exactly the
+same branch so results match to within one ulp of np.exp.
+"""
+
+from collections import namedtuple
+import numpy as np
+from scipy.integrate import ode, solve_ivp
+from scipy.sparse import diags
+
+
+def event_mean_conc(C):
+    """
+    Event Mean Concentration Treatment (SWMM Water Quality Manual, 2016)
+    C = constant treatment concentration for each pollutant (SI/US: mg/L)
+    """
+    return np.array(C, dtype=float, copy=True)
+
+
+def constant_removal(Cin, R):
+    """
+    CONSTANT REMOVAL TREATMENT (SWMM Water Quality Manual, 2016)
+    R = pollutant removal fraction (unitless)
+    """
+    return (1-R)*Cin
+
+
+def co_removal(Cin, R1, R2):
+    """
+    CO-REMOVAL TREATMENT (SWMM Water Quality Manual, 2016)
+    R1 = pollutant removal fraction (unitless)
+    R2 = pollutant removal fraction for other pollutant (unitless)
+    """
+    return (1-R1*R2)*Cin
+
+
+def conc_depend_removal(Cin, R_l, BC, R_u):
+    """
+    CONCENTRATION-DEPENDENT REMOVAL (SWMM Water Quality Manual, 2016)
+    R_l = lower removal rate (unitless)
+    BC  = boundary concentration that determines removal rate (SI/US: mg/L)
+    R_u = upper removal rate (unitless)
+    """
+    R = np.where(Cin > BC, R_u, R_l)
+    return (1-R)*Cin
+
+
+def nth_order_reaction(C, dt, routing_step, k, n):
+    """
+    NTH ORDER REACTION KINETICS (SWMM Water Quality Manual, 2016)
+    k   = reaction rate constant (SI: m/hr, US: ft/hr)
+    n   = reaction order (first order, second order, etc.) (unitless)
+
+    dC/dt = -k*C^n is integrated over dt with its exact solution,
+    C*exp(-k*dt) for n = 1 and (C^(1-n) + (n-1)*k*dt)^(1/(1-n)) otherwise
+    (zero once an order n < 1 reaction has used up the pollutant), so any
+    step is stable and accurate. Growth (k < 0) of order n > 1 past its
+    blow-up time has no exact solution and falls back to an exponential
+    integrator, C*exp(-k*C^(n-1)*h), over sub-steps h no longer than the
+    routing step. Concentrations are clamped at zero.
+    """
+    C = np.maximum(C, 0.0)
+    with np.errstate(over="ignore", invalid="ignore", divide="ignore"):
+        base = C**(1-n) + (n-1)*k*dt
+        power = np.where(base > 0, base, 0.0)**(1/(1-n))
+        Cnew = np.where(n == 1.0, C*np.exp(-k*dt), power)
+    # A reaction of order n > 0 leaves zero at zero
+    Cnew = np.where((C == 0.0) & (n > 0.0), 0.0, Cnew)
+    blow_up = (n > 1.0) & (base <= 0.0) & (C > 0.0)
+    if np.any(blow_up):
+        X, kb, nb = C[blow_up], k[blow_up], n[blow_up]
+        substeps = max(1, int(np.ceil(dt/routing_step - 1e-9)))
+        h = dt/substeps
+        with np.errstate(over="ignore"):
+            for _ in range(substeps):
+                X = X*np.exp(-kb*X**(nb-1)*h)
+        Cnew[blow_up] = X
+    return np.maximum(Cnew, 0.0)
+
+
+def kc_model(Cin, d, hrt, k, C_s):
+    """
+    K-C_STAR MODEL (SWMM Water Quality Manual, 2016)
+    k   = reaction rate constant (SI: m/hr, US: ft/hr)
+    C_s = constant residual concentration that always remains (SI/US: mg/L)
+    """
+    wet = (d != 0.0) & (Cin != 0.0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        R = (1-np.exp(-k*hrt/d))*(1-C_s/Cin)
+    R = np.where(wet & (Cin > C_s), R, 0.0)
+    return (1-R)*Cin
+
+
+def gravity_settling(Cin, Q, d, dt, k, C_s):
+    """
+    GRAVITY SETTLING (SWMM Water Quality Manual, 2016)
+    k   = reaction rate constant (SI: m/hr, US: ft/hr)
+    C_s = constant residual concentration that always remains (SI/US: mg/L)
+
+    The exponential is the exact solution over dt, so any step is stable;
+    concentrations are clamped at zero.
+    """
+    quiescent = Q < 0.1
+    H = np.where(quiescent, 1.0, 0.0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        settled = C_s + (Cin-C_s)*np.exp(-k/d*dt/3600)
+    # Zero depth keeps the per-asset method's expression
+    dry = H*C_s + (Cin-C_s) + (1-H)*Cin
+    return np.maximum(np.where(d != 0.0, np.where(quiescent, settled, Cin), dry), 0.0)
+
+
+def phosphorus(Cin, Qin, t, B1, Ceq0, k, L, A, E):
+    """
+    LI & DAVIS BIORETENTION CELL TOTAL PHOSPHOURS MODEL (2016)
+    t     = time elapsed since water entered the node (SI/US: s)
+    B1    = coefficient related to the rate at which Ceq approaches Co (SI/US: 1/s)
+    Ceq0  = initial DP or PP equilibrium concentration value for an event (SI/US: mg/L)
+    k     = reaction rate constant (SI/US: 1/s)
+    L     = depth of soil media (length of pathway) (SI: m, US: ft)
+    A     = cross-sectional area (SI: m^2, US: ft^2)
+    E     = filter bed porosity (unitless)
+    """
+    wet = Qin >= 0.01
+    with np.errstate(divide="ignore", invalid="ignore", over="ignore"):
+        decay = np.exp((-k*L*A*E)/Qin)
+    Cnew = (Cin*decay)+(Ceq0*np.exp(B1*t))*(1-decay)
+    return Cnew, wet
+
+
+def phosphorus_event(state, Cin, Qin, dt, B1, Ceq0, k, L, A, E):
+    """
+    LI & DAVIS BIORETENTION CELL TOTAL PHOSPHOURS MODEL (2016)
+    Phosphorus with the time elapsed since water entered each node kept in
+    state.event_time: it builds up over wet steps and is reset to zero
+    when the node is dry.
+    """
+    state.event_time = np.where(Qin >= 0.01, state.event_time + dt, 0.0)
+    return phosphorus(Cin, Qin, state.event_time, B1, Ceq0, k, L, A, E)
+
+
+def cstr_tank(t, C, Qin, Cin, Qout, V, k, n):
+    """
+    UNSTEADY CONTINUOUSLY STIRRED TANK REACTOR (CSTR)
+    Right-hand side of the CSTR mass balance for a vector of tanks.
+    """
+    return (Qin*Cin - Qout*C)/V + k*C**n
+
+
+def cstr_jacobian(t, C, Qin, Cin, Qout, V, k, n):
+    """
+    Jacobian of cstr_tank. The tanks are independent, so the Jacobian is
+    diagonal and is returned in banded storage (one row, one entry per tank).
+    """
+    return (-Qout/V + k*n*C**(n-1)).reshape(1, -1)
+
+
+def cstr_sparse_jacobian(t, C, Qin, Cin, Qout, V, k, n):
+    """
+    Jacobian of cstr_tank as a sparse diagonal matrix, for the solve_ivp
+    BDF and Radau integrators.
+    """
+    return diags(cstr_jacobian(t, C, Qin, Cin, Qout, V, k, n)[0])
+
+
+def cstr_exact(C, Qin, Cin, Qout, V, k, n, dt):
+    """
+    Exact CSTR update over dt for zero- and first-order reactions (n = 0
+    or n = 1) with inflow, outflow and volume held constant. The mass
+    balance is then linear, dC/dt = s - lam*C, with
+
+        n = 1:  s = Qin*Cin/V,      lam = Qout/V - k
+        n = 0:  s = Qin*Cin/V + k,  lam = Qout/V
+
+    and C(dt) = C + (s - lam*C)*dt*phi(lam*dt), phi(z) = (1 - exp(-z))/z,
+    which is evaluated with expm1 so it stays accurate as lam*dt -> 0.
+    """
+    first = n == 1
+    s = Qin*Cin/V + np.where(first, 0.0, k)
+    lam = Qout/V - np.where(first, k, 0.0)
+    z = lam*dt
+    with np.errstate(divide="ignore", invalid="ignore"):
+        phi = np.where(z != 0.0, -np.expm1(-z)/z, 1.0)
+    return C + (s - lam*C)*dt*phi
+
+
+# Integrators available for CSTR tanks that have no exact solution:
+# scipy.integrate.ode integrators (name, set_integrator options) ...
+# The internal step limit is raised well above scipy's default of 500 so
+# stiff tanks are not silently left part way through a step.
+ODE_INTEGRATORS = {
+    "vode": ("vode", {"nsteps": 50000}),
+    "vode-bdf": ("vode", {"method": "bdf", "nsteps": 50000}),
+    "lsoda": ("lsoda", {"nsteps": 50000}),
+    }
+# ... and scipy.integrate.solve_ivp methods for stiff systems
+IVP_INTEGRATORS = ("BDF", "Radau", "LSODA")
+
+# Solver options a CSTR config entry may set in its parameters, with defaults
+CSTR_OPTIONS = {"integrator": "vode", "rtol": 1e-6, "atol": 1e-12, "V_min": 0.0}
+
+
+# Per-asset state record of the stateful methods: the reactor
+# concentration (CSTR), the time elapsed since the current event started
+# (Phosphorus) and the time of the last update (seconds since the start of
+# the simulation)
+STATE_DTYPE = np.dtype([("C", "f8"), ("event_time", "f8"), ("last_update", "f8")])
+
+
+def state_array(n):
+    """
+    Returns n zeroed state records.
+    """
+    return np.zeros(n, dtype=STATE_DTYPE)
+
+
+class AssetState:
+    """
+    Per-asset state of a group of assets. The fields of the state records
+    are exposed as arrays (views of the records), so kernels read and
+    assign them like plain arrays while the state of every asset stays in
+    one STATE_DTYPE array that is snapshotted in one copy.
+
+    n       = number of assets
+    records = STATE_DTYPE array of n records to keep the state in (default:
+              new records)
+    """
+
+    def __init__(self, n, records=None):
+        if records is None:
+            records = state_array(n)
+        elif len(records) != n:
+            raise ValueError("state of {} assets needs {} records, got {}".format(n, n, len(records)))
+        self.records = records
+
+    @property
+    def C(self):
+        return self.records["C"]
+
+    @C.setter
+    def C(self, value):
+        self.records["C"] = value
+
+    @property
+    def event_time(self):
+        return self.records["event_time"]
+
+    @event_time.setter
+    def event_time(self, value):
+        self.records["event_time"] = value
+
+    @property
+    def last_update(self):
+        return self.records["last_update"]
+
+    @last_update.setter
+    def last_update(self, value):
+        self.records["last_update"] = value
+
+    def __len__(self):
+        return len(self.records)
+
+
+class CSTRState(AssetState):
+    """
+    Reactor concentrations and solver clock of a group of CSTR assets. All
+    tanks are integrated together as one vector ODE with a diagonal
+    (zero-bandwidth) analytic Jacobian, so one solver call advances every
+    tank.
+
+    c0         = intital concentration inside each reactor (SI/US: mg/L)
+    integrator = one of ODE_INTEGRATORS or IVP_INTEGRATORS
+    rtol, atol = solver relative and absolute tolerances
+    V_min      = tanks with a volume at or below V_min are treated as empty
+                 (SI: m^3, US: ft^3)
+    records    = STATE_DTYPE records to keep the concentrations in
+    rhs, jacobian, exact = right-hand side, its Jacobian and the exact
+                 update (defaults: cstr_tank, cstr_jacobian, cstr_exact; see
+                 StormReactor.jit for compiled versions)
+    """
+
+    def __init__(self, c0, integrator="vode", rtol=1e-6, atol=1e-12, V_min=0.0, records=None,
+                 rhs=cstr_tank, jacobian=cstr_jacobian, exact=cstr_exact):
+        c0 = np.array(c0, dtype=float, ndmin=1)
+        super().__init__(len(c0), records)
+        self.C = c0
+        self.t = 0.0
+        self.rhs = rhs
+        self.jacobian = jacobian
+        self.exact = exact
+        self.integrator = integrator
+        self.rtol = rtol
+        self.atol = atol
+        self.V_min = V_min
+        # Right-hand side and Jacobian evaluations made by the solver
+        self.nfev = 0
+        self.njev = 0
+        if integrator in ODE_INTEGRATORS:
+            name, options = ODE_INTEGRATORS[integrator]
+            self.solver = ode(self._rhs, self._jacobian)
+            self.solver.set_integrator(name, rtol=rtol, atol=atol, lband=0, uband=0, **options)
+        elif integrator in IVP_INTEGRATORS:
+            self.solver = None
+        else:
+            raise ValueError("unknown CSTR integrator {!r}, choose from {}".format(
+                integrator, ", ".join(list(ODE_INTEGRATORS) + list(IVP_INTEGRATORS))))
+
+    def _rhs(self, t, C, *params):
+        self.nfev += 1
+        return self.rhs(t, C, *params)
+
+    def _jacobian(self, t, C, *params):
+        self.njev += 1
+        return self.jacobian(t, C, *params)
+
+    def _sparse_jacobian(self, t, C, *params):
+        self.njev += 1
+        return diags(self.jacobian(t, C, *params)[0])
+
+    def integrate(self, C, dt, params):
+        """
+        Integrates the tanks in C from the state time over dt with the
+        given (Qin, Cin, Qout, V, k, n) arrays and returns the new C.
+        """
+        if self.solver is not None:
+            self.solver.set_f_params(*params)
+            self.solver.set_jac_params(*params)
+            self.solver.set_initial_value(C, self.t)
+            self.solver.integrate(self.t+dt)
+            return self.solver.y
+        if self.integrator == "LSODA":
+            jac, options = self._jacobian, {"lband": 0, "uband": 0}
+        else:
+            jac, options = self._sparse_jacobian, {}
+        solution = solve_ivp(self._rhs, (self.t, self.t+dt), C, method=self.integrator, jac=jac,
+                             args=params, rtol=self.rtol, atol=self.atol, **options)
+        return solution.y[:, -1]
+
+
+def cstr(state, Cin, Qin, Qout, V, dt, k, n):
+    """
+    UNSTEADY CONTINUOUSLY STIRRED TANK REACTOR (CSTR) SOLVER
+    Integrates every tank in the group over dt with inflow, outflow and
+    volume held at their current values. Zero- and first-order tanks use
+    the exact solution (cstr_exact); the others share one solver call.
+
+    k   = reaction rate constant (SI/US: 1/s)
+    n   = reaction order (first order, second order, etc.) (unitless)
+    """
+    # Empty and near-empty tanks are too stiff to integrate; their
+    # concentration follows the inflow concentration
+    wet = V > state.V_min
+    C = np.where(wet, state.C, Cin)
+    # Zero- and first-order tanks have an exact solution
+    exact = wet & ((n == 0) | (n == 1))
+    if exact.any():
+        C[exact] = state.exact(C[exact], Qin[exact], Cin[exact], Qout[exact],
+                               V[exact], k[exact], n[exact], dt)
+    # All other tanks are integrated together as one vector ODE
+    wet = wet & ~exact
+    if wet.any():
+        C[wet] = state.integrate(C[wet], dt, (Qin[wet], Cin[wet], Qout[wet], V[wet], k[wet], n[wet]))
+    state.C = C
+    state.t = state.t+dt
+    return C
+
+
+def cstr_state(parameters, options, records=None):
+    return CSTRState(parameters["c0"], records=records, **options)
+
+
+def event_state(parameters, options, records=None):
+    return AssetState(len(next(iter(parameters.values()))), records)
+
+
+def asset_state(parameters, options, records=None):
+    # State of registered methods (see waterQuality.register_method), which
+    # may have no parameters to count the assets from
+    n = len(records) if records is not None else len(next(iter(parameters.values())))
+    return AssetState(n, records)
+
+
+# Batch kernel specification: the kernel function, the inputs it reads
+# (SWMM states named after the node toolkit quantities, "dt" for the
+# model dt and "routing_step" for the SWMM routing step, in seconds), the
+# method parameters it takes, for stateful
+# kernels a function that creates the group state from the parameter
+# arrays, options and (optionally) the records to keep it in, and the
+# non-numeric options (with defaults) that a
+# config entry may set (None for no options). Assets are only grouped
+# together when their options are equal. Inputs come first in the kernel
+# signature, followed by the parameters.
+Kernel = namedtuple("Kernel", ["func", "inputs", "parameters", "state", "options"], defaults=(None, None))
+
+BATCH_KERNELS = {
+    "EventMeanConc": Kernel(event_mean_conc, (), ("C",)),
+    "ConstantRemoval": Kernel(constant_removal, ("inflowQual",), ("R",)),
+    "CoRemoval": Kernel(co_removal, ("inflowQual",), ("R1", "R2")),
+    "ConcDependRemoval": Kernel(conc_depend_removal, ("inflowQual",), ("R_l", "BC", "R_u")),
+    "NthOrderReaction": Kernel(nth_order_reaction, ("reactorQual", "dt", "routing_step"), ("k", "n")),
+    "kCModel": Kernel(kc_model, ("inflowQual", "newDepth", "hyd_res_time"), ("k", "C_s")),
+    "GravitySettling": Kernel(gravity_settling, ("inflowQual", "totalinflow", "newDepth", "dt"), ("k", "C_s")),
+    "CSTR": Kernel(cstr, ("inflowQual", "totalinflow", "outflow", "newVolume", "dt"), ("k", "n"), cstr_state, CSTR_OPTIONS),
+    "Phosphorus": Kernel(phosphorus_event, ("inflowQual", "totalinflow", "dt"), ("B1", "Ceq0", "k", "L", "A", "E"),
+                         event_state),
+    }
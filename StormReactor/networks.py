@@ -0,0 +1,214 @@
+"""
+Synthetic SWMM networks for scaling tests.
+
+generate_network writes a valid SWMM .inp file with N storage nodes joined
+by conduits in a tree, chain or star topology, M pollutants and variable
+inflow timeseries. Every treated element gets the [TREATMENT] entries
+StormReactor needs, and the matching waterQuality configuration
+dictionary is returned and saved next to the .inp file as JSON.
+
+Example:
+    from StormReactor.networks import generate_network
+    config = generate_network("network.inp", 10000, pollutants=3, topology="tree")
+    with Simulation("network.inp") as sim:
+        WQ = waterQuality(sim, config)
+"""
+
+import json
+import os
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from StormReactor.waterQuality import NODE_ONLY_METHODS
+
+# Default parameters for each water quality method
+METHOD_PARAMETERS = {
+    "EventMeanConc": {"C": 5.0},
+    "ConstantRemoval": {"R": 0.5},
+    "CoRemoval": {"R1": 0.75, "R2": 0.15},
+    "ConcDependRemoval": {"R_l": 0.50, "BC": 10.0, "R_u": 0.75},
+    "NthOrderReaction": {"k": 0.01, "n": 2.0},
+    "kCModel": {"k": 0.01, "C_s": 10.0},
+    "GravitySettling": {"k": 0.01, "C_s": 10.0},
+    "Phosphorus": {"B1": 0.0000333, "Ceq0": 0.0081, "k": 0.00320, "L": 0.91, "A": 100, "E": 0.44},
+    "CSTR": {"k": -0.2, "n": 1.0, "c0": 10.0},
+    }
+
+TOPOLOGIES = ("tree", "chain", "star")
+
+START = datetime(2020, 1, 1)
+
+
+def _clock(seconds):
+    """
+    Formats a duration in seconds as H:MM:SS (hours may exceed 24).
+    """
+
+    seconds = int(round(seconds))
+    return "{}:{:02d}:{:02d}".format(seconds//3600, seconds % 3600//60, seconds % 60)
+
+
+def _parents(n_assets, topology, branching):
+    """
+    Returns the index of the node each node drains to (-1 is the outfall).
+    """
+
+    if topology not in TOPOLOGIES:
+        raise ValueError("Unknown topology '{}'. Valid topologies are: {}".format(
+            topology, ", ".join(TOPOLOGIES)))
+    index = np.arange(n_assets)
+    if topology == "star":
+        return np.full(n_assets, -1)
+    if topology == "chain":
+        branching = 1
+    return np.where(index == 0, -1, (index - 1)//branching)
+
+
+def _hydrographs(n_series, duration, peak_flow, rng):
+    """
+    Builds triangular storm hydrographs with random timing and peaks, as
+    lists of (hours, flow) pairs.
+    """
+
+    series = []
+    hours = duration/3600.0
+    for k in range(n_series):
+        start = rng.uniform(0.0, 0.5)*hours
+        rise = rng.uniform(0.05, 0.25)*hours
+        fall = rng.uniform(0.1, 0.5)*hours
+        peak = rng.uniform(0.2, 1.0)*peak_flow
+        points = [(0.0, 0.0), (start, 0.0), (start + rise, peak), (start + rise + fall, 0.0)]
+        if start + rise + fall < hours:
+            points.append((hours, 0.0))
+        series.append(points)
+    return series
+
+
+def generate_network(path, n_assets, pollutants=1, topology="tree", branching=2,
+                     methods=("ConstantRemoval",), parameters=None, treat="nodes",
+                     duration=3600, routing_step=1, report_step=3600, n_series=4,
+                     peak_flow=1.0, seed=0, config_path=None):
+    """
+    Writes a synthetic SWMM model and returns the matching water quality
+    configuration dictionary.
+
+    path = path of the .inp file to write
+    n_assets = number of storage nodes (each drains through one conduit)
+    pollutants = number of pollutants (named P1, P2, ...) or a list of names
+    topology = "tree" (each node drains to node (i-1)//branching), "chain"
+        (a single line of nodes) or "star" (every node drains to the outfall)
+    branching = number of upstream nodes per node in a tree
+    methods = water quality method, or list of methods cycled over the
+        treated elements (node-only methods are skipped for conduits)
+    parameters = dictionary of parameters per method, overriding the defaults
+        in METHOD_PARAMETERS
+    treat = treated elements, "nodes", "links" or "both"
+    duration = simulation length (seconds)
+    routing_step = routing step (seconds)
+    report_step = reporting step (seconds)
+    n_series = number of inflow timeseries shared among the nodes
+    peak_flow = largest peak inflow of a timeseries (CMS)
+    seed = random seed for the inflows and pollutant concentrations
+    config_path = where to save the configuration as JSON (default is path
+        with a .json extension)
+    """
+
+    if isinstance(pollutants, int):
+        pollutants = ["P{}".format(p+1) for p in range(pollutants)]
+    if isinstance(methods, str):
+        methods = [methods]
+    if treat not in ("nodes", "links", "both"):
+        raise ValueError("treat must be 'nodes', 'links' or 'both', not '{}'".format(treat))
+    method_parameters = dict(METHOD_PARAMETERS, **(parameters or {}))
+    link_methods = [method for method in methods if method not in NODE_ONLY_METHODS]
+    if treat != "nodes" and not link_methods:
+        raise ValueError("None of the methods {} can treat conduits".format(list(methods)))
+
+    rng = np.random.default_rng(seed)
+    parents = _parents(n_assets, topology, branching)
+    levels = np.ones(n_assets, dtype=int)
+    for i in range(n_assets):
+        if parents[i] >= 0:
+            levels[i] = levels[parents[i]] + 1
+    nodes = ["Tank{}".format(i) for i in range(n_assets)]
+    links = ["Pipe{}".format(i) for i in range(n_assets)]
+    series = _hydrographs(n_series, duration, peak_flow, rng)
+    node_series = rng.integers(0, n_series, n_assets)
+    concentrations = rng.uniform(1.0, 20.0, (n_assets, len(pollutants)))
+    end = START + timedelta(seconds=duration)
+
+    lines = ["[TITLE]",
+             "Synthetic {} network of {} storage nodes".format(topology, n_assets),
+             "",
+             "[OPTIONS]",
+             "FLOW_UNITS CMS",
+             "FLOW_ROUTING KINWAVE",
+             "START_DATE {}".format(START.strftime("%m/%d/%Y")),
+             "START_TIME {}".format(START.strftime("%H:%M:%S")),
+             "REPORT_START_DATE {}".format(START.strftime("%m/%d/%Y")),
+             "REPORT_START_TIME {}".format(START.strftime("%H:%M:%S")),
+             "END_DATE {}".format(end.strftime("%m/%d/%Y")),
+             "END_TIME {}".format(end.strftime("%H:%M:%S")),
+             "REPORT_STEP {}".format(_clock(min(report_step, duration))),
+             "WET_STEP {}".format(_clock(routing_step)),
+             "DRY_STEP {}".format(_clock(routing_step)),
+             "ROUTING_STEP {}".format(_clock(routing_step)),
+             "",
+             "[OUTFALLS]",
+             "Outfall 0 FREE NO",
+             "",
+             "[STORAGE]"]
+    # Storage bottoms step down by 0.5 m per level toward the outfall
+    lines += ["{} {:.1f} 5 0 FUNCTIONAL 100 0 0 0 0".format(node, 0.5*level)
+              for node, level in zip(nodes, levels)]
+    lines += ["", "[CONDUITS]"]
+    lines += ["{} {} {} 100 0.01 0 0 0 0".format(link, node, "Outfall" if parent < 0 else nodes[parent])
+              for link, node, parent in zip(links, nodes, parents)]
+    lines += ["", "[XSECTIONS]"]
+    lines += ["{} CIRCULAR 1 0 0 0 1".format(link) for link in links]
+    lines += ["", "[POLLUTANTS]"]
+    lines += ["{} MG/L 0.0 0.0 0 0.0 NO * 0.0 0.0 0".format(pollutant) for pollutant in pollutants]
+    lines += ["", "[INFLOWS]"]
+    for i, node in enumerate(nodes):
+        lines.append('{} FLOW TS{} FLOW 1.0 1.0'.format(node, node_series[i]))
+        lines += ['{} {} "" CONCENTRATION 1.0 1.0 {:.3f}'.format(node, pollutant, concentrations[i, p])
+                  for p, pollutant in enumerate(pollutants)]
+    lines += ["", "[TIMESERIES]"]
+    for k, points in enumerate(series):
+        lines += ["TS{} {:.6f} {:.6f}".format(k, hours, flow) for hours, flow in points]
+
+    config = {}
+    if treat in ("nodes", "both"):
+        for i, node in enumerate(nodes):
+            config[node] = _asset_config("node", methods[i % len(methods)], pollutants, method_parameters)
+    if treat in ("links", "both"):
+        for i, link in enumerate(links):
+            config[link] = _asset_config("link", link_methods[i % len(link_methods)], pollutants, method_parameters)
+
+    # SWMM only lets StormReactor set the quality of nodes with a treatment
+    lines += ["", "[TREATMENT]"]
+    lines += ["{} {} C = {}".format(node, pollutant, pollutant)
+              for node in nodes if node in config for pollutant in pollutants]
+    lines += ["", "[REPORT]", "NODES NONE", "LINKS NONE", ""]
+
+    with open(path, "w") as f:
+        f.write("\n".join(lines))
+    config_path = config_path or os.path.splitext(path)[0] + ".json"
+    with open(config_path, "w") as f:
+        json.dump(config, f, indent=1)
+    return config
+
+
+def _asset_config(element_type, method, pollutants, method_parameters):
+    """
+    Builds the configuration of one treated element, applying the method to
+    every pollutant.
+    """
+
+    if len(pollutants) == 1:
+        return {"type": element_type, "pollutant": pollutants[0], "method": method,
+                "parameters": dict(method_parameters[method])}
+    return {"type": element_type, "treatments": [
+        {"pollutant": pollutant, "method": method, "parameters": dict(method_parameters[method])}
+        for pollutant in pollutants]}
@@ -0,0 +1,302 @@
+"""
+Columnar results recorder for StormReactor.
+
+A Recorder attaches to a waterQuality object and, at the end of every
+updateWQState call, samples a chosen set of node/link quantities into a
+preallocated NumPy block (one row per sample, one column per channel).
+Full blocks are kept in memory or spilled to disk, so memory stays
+bounded on multi-year runs:
+
+    "npy"  one .npy file that grows block by block; read it back with
+           load() as a memory-mapped array (zero-copy)
+    "npz"  one .npz archive with one entry per block; load() copies the
+           blocks into one array, so it must fit in memory
+
+Without a path, blocks are kept in memory up to max_memory bytes, after
+which they are moved to a temporary .npy file that is memory-mapped by
+recording() and removed with the recorder.
+
+Example:
+    with Simulation(inp) as sim:
+        WQ = waterQuality(sim, config)
+        recorder = Recorder(WQ, [("Tank", "concentration", "P1"), ("Tank", "flow")], path="run.npy")
+        for step in sim:
+            WQ.updateWQState()
+        recorder.close()
+    results = load("run.npy")
+    results.column("Tank", "concentration", "P1")
+"""
+
+import io
+import json
+import os
+import struct
+import tempfile
+import zipfile
+
+import numpy as np
+import pyswmm.toolkitapi as tka
+
+from StormReactor.waterQuality import ElementType
+
+# Recordable quantities and the state cache input each is read from
+QUANTITIES = {
+    "concentration": "quality",
+    "flow": "totalinflow",
+    "outflow": "outflow",
+    "depth": "newDepth",
+    "volume": "newVolume",
+    }
+
+FORMATS = ("npy", "npz")
+
+# Fixed .npy header size, so the header can be rewritten in place as the
+# file grows
+HEADER_SIZE = 128
+
+
+def _npy_header(rows, columns):
+    header = "{{'descr': '<f8', 'fortran_order': False, 'shape': ({}, {}), }}".format(rows, columns)
+    header = header.ljust(HEADER_SIZE - 11) + "\n"
+    return np.lib.format.magic(1, 0) + struct.pack("<H", len(header)) + header.encode("latin1")
+
+
+def _column_name(ID, quantity, pollutant=None):
+    return "{}:{}".format(ID, quantity) if pollutant is None else "{}:{}:{}".format(ID, quantity, pollutant)
+
+
+def _columns_path(path):
+    return os.path.splitext(path)[0] + ".columns.json"
+
+
+class Recording:
+    """
+    Recorded samples: data has one row per sample, with the time (seconds
+    since the simulation start) in column 0 and one column per channel.
+    """
+
+    def __init__(self, data, columns):
+        self.data = data
+        self.columns = list(columns)
+        self.index = {name: i for i, name in enumerate(self.columns)}
+
+    @property
+    def times(self):
+        return self.data[:, 0]
+
+    def column(self, ID, quantity, pollutant=None):
+        """
+        Returns the samples of one channel (a view of data).
+        """
+        return self.data[:, self.index[_column_name(ID, quantity, pollutant)]]
+
+    def __len__(self):
+        return len(self.data)
+
+
+def load(path):
+    """
+    Loads a recording saved by a Recorder. .npy recordings are
+    memory-mapped; the blocks of .npz recordings are copied into one array.
+    """
+
+    if path.endswith(".npz"):
+        with np.load(path) as archive:
+            columns = list(archive["columns"])
+            blocks = sorted(name for name in archive.files if name.startswith("block_"))
+            data = np.concatenate([archive[name] for name in blocks]) if blocks \
+                else np.empty((0, len(columns)))
+        return Recording(data, columns)
+    with open(_columns_path(path)) as f:
+        columns = json.load(f)
+    return Recording(np.load(path, mmap_mode="r"), columns)
+
+
+class Recorder:
+    """
+    Samples node/link quantities at the end of every waterQuality step.
+
+    WQ = waterQuality object to attach to
+    channels = list of (ID, quantity) or (ID, "concentration", pollutant)
+        tuples, quantity being one of QUANTITIES ("flow" is the total
+        inflow of a node or the flow of a link). Default is the
+        concentration of every treated pollutant and the flow of every
+        treated asset.
+    block_size = samples held in memory before a block is spilled
+    path = file to spill to (.npy or .npz); without a path blocks are
+        kept in memory
+    every = sample every this many steps
+    max_memory = bytes of samples kept in memory without a path; beyond
+        it they are spilled to a temporary .npy file (None for no limit)
+    """
+
+    def __init__(self, WQ, channels=None, block_size=4096, path=None, every=1, max_memory=2**28):
+        self.WQ = WQ
+        self.block_size = block_size
+        self.path = path
+        self.every = every
+        self.max_memory = max_memory
+        if channels is None:
+            channels = [(t.ID, "concentration", t.pollutant) for t in WQ.plan]
+            channels += [(ID, "flow") for ID in dict.fromkeys(t.ID for t in WQ.plan)]
+        self.columns = ["time"]
+        self.sources = self._compileChannels(channels)
+        self.block = np.empty((block_size, len(self.columns)))
+        self.n = 0
+        self.rows = 0
+        self.steps = 0
+        self.blocks = []
+        self.file = None
+        self.spill = None
+        self.format = None
+        if path is not None:
+            self.format = os.path.splitext(path)[1].lstrip(".")
+            if self.format not in FORMATS:
+                raise ValueError("Recorder path must end in .npy or .npz, not '{}'".format(path))
+            if self.format == "npy":
+                self._open(path)
+                with open(_columns_path(path), "w") as f:
+                    json.dump(self.columns, f)
+            else:
+                self.file = zipfile.ZipFile(path, "w", zipfile.ZIP_STORED)
+        WQ.recorders.append(self)
+
+    def _open(self, path):
+        self.npy_path = path
+        self.file = open(path, "wb")
+        self.file.write(_npy_header(self.rows, len(self.columns)))
+
+    def _spillBlocks(self):
+        """
+        Moves the in-memory blocks to a temporary .npy file, which is then
+        used as the spill file.
+        """
+
+        self.spill = tempfile.TemporaryDirectory(prefix="stormreactor_recording_")
+        self.format = "npy"
+        self._open(os.path.join(self.spill.name, "recording.npy"))
+        for block in self.blocks:
+            self.file.write(block.astype("<f8").tobytes())
+        self.file.flush()
+        self.blocks = []
+
+    def _compileChannels(self, channels):
+        """
+        Locates every channel in the waterQuality state cache and returns
+        (buffer, rows, pollutant columns, block columns) per cache buffer.
+        """
+
+        model = self.WQ.sim._model
+        sources = {}
+        for channel in channels:
+            ID, quantity = channel[0], channel[1]
+            pollutant = channel[2] if len(channel) > 2 else None
+            if quantity not in QUANTITIES:
+                raise ValueError("Unknown quantity '{}'. Valid quantities are: {}".format(
+                    quantity, ", ".join(QUANTITIES)))
+            if (quantity == "concentration") != (pollutant is not None):
+                raise ValueError("Channel {} needs a pollutant only for concentration".format(channel))
+            if ID in self.WQ.config:
+                element_type = ElementType.Nodes if self.WQ.config[ID]["type"] == "node" else ElementType.Links
+            elif model.ObjectIDexist(tka.ObjectType.NODE.value, ID):
+                element_type = ElementType.Nodes
+            elif model.ObjectIDexist(tka.ObjectType.LINK.value, ID):
+                element_type = ElementType.Links
+            else:
+                raise ValueError("'{}' is not a node or link of the SWMM model".format(ID))
+            buffer = self.WQ.cache.buffer(element_type, QUANTITIES[quantity])
+            source = sources.setdefault(id(buffer), [buffer, [], [], []])
+            source[1].append(ID)
+            if pollutant is not None:
+                source[2].append(model.getObjectIDIndex(tka.ObjectType.POLLUT, pollutant))
+            source[3].append(len(self.columns))
+            self.columns.append(_column_name(ID, quantity, pollutant))
+
+        compiled = []
+        for buffer, IDs, pollutants, targets in sources.values():
+            rows = buffer.rows(IDs)
+            compiled.append((buffer, rows, np.array(pollutants, dtype=int) if pollutants else None,
+                             np.array(targets, dtype=int)))
+        return compiled
+
+    def sample(self):
+        """
+        Records the current state (called by waterQuality at the end of
+        every step).
+        """
+
+        self.steps += 1
+        if (self.steps - 1) % self.every:
+            return
+        row = self.block[self.n]
+        row[0] = (self.WQ.sim.current_time - self.WQ.start_time).total_seconds()
+        for buffer, rows, columns, targets in self.sources:
+            row[targets] = self.WQ.cache.read(buffer, rows, columns)
+        self.n += 1
+        if self.n == self.block_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Moves the samples held in the current block to the spill file (or
+        to the in-memory block list).
+        """
+
+        if self.n == 0:
+            return
+        block = self.block[:self.n]
+        if self.format is None:
+            self.blocks.append(block.copy())
+        elif self.format == "npy":
+            self.file.write(block.astype("<f8").tobytes())
+            # Rewrite the header with the new number of rows
+            self.file.seek(0)
+            self.file.write(_npy_header(self.rows + self.n, len(self.columns)))
+            self.file.seek(0, os.SEEK_END)
+            self.file.flush()
+        else:
+            data = io.BytesIO()
+            np.lib.format.write_array(data, block)
+            self.file.writestr("block_{:08d}.npy".format(self.rows), data.getvalue())
+        self.rows += self.n
+        self.n = 0
+        if self.format is None and self.max_memory is not None \
+                and self.rows*len(self.columns)*8 > self.max_memory:
+            self._spillBlocks()
+
+    def close(self):
+        """
+        Writes the remaining samples, closes the spill file and detaches
+        from waterQuality.
+        """
+
+        self.flush()
+        if self.file is not None:
+            if self.format == "npz":
+                data = io.BytesIO()
+                np.lib.format.write_array(data, np.array(self.columns))
+                self.file.writestr("columns.npy", data.getvalue())
+            self.file.close()
+            self.file = None
+        if self in self.WQ.recorders:
+            self.WQ.recorders.remove(self)
+
+    def recording(self):
+        """
+        Returns the samples recorded so far as a Recording. Spilled .npy
+        recordings are memory-mapped; call close() first for .npz files.
+        """
+
+        if self.format is None:
+            data = np.concatenate(self.blocks + [self.block[:self.n]])
+            return Recording(data, self.columns)
+        if self.format == "npy":
+            self.flush()
+            return Recording(np.load(self.npy_path, mmap_mode="r"), self.columns)
+        return load(self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
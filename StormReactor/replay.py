@@ -0,0 +1,322 @@
+"""
+Hydraulic replay: run treatment kernels offline against recorded hydraulics.
+
+The hydraulics at a treated node (total inflow, outflow, volume, depth,
+hydraulic residence time) and its inflow quality do not depend on the
+node's own treatment parameters. They can be recorded once during a real
+SWMM run, and the batch kernels (StormReactor.kernels) can then be
+replayed against the recording in NumPy, without SWMM, for any
+parameters.
+
+Replay is exact for node treatments whose kernels read only these inputs
+(replayable_methods(), which includes methods added with
+register_method). Treatments upstream of a replayed node are held as
+they were in the recorded run. NthOrderReaction and all link treatments
+read the element's own mixed concentration, which depends on the
+treatment, so they cannot be replayed.
+
+replay returns the concentration each kernel sets at every step. SWMM
+applies a set concentration in its next routing step, so the
+concentration it reports lags the replayed one by one step.
+
+Example:
+    recording = record_hydraulics("model.inp", config)
+    recording.save("hydraulics.npz")
+    C = replay(recording, {"Tank": {"type": "node", "pollutant": "P1",
+                                    "method": "GravitySettling", "parameters": {"k": 0.05, "C_s": 2.0}}})
+"""
+
+import numpy as np
+from pyswmm import Simulation
+
+from StormReactor.kernels import BATCH_KERNELS
+from StormReactor.waterQuality import (ElementType, POLLUTANT_INPUTS, REQUIRED_PARAMETERS,
+                                       TreatmentGroup, Treatment, waterQuality)
+
+# SWMM states recorded for every treated (node, pollutant)
+RECORDED_INPUTS = ("inflowQual", "totalinflow", "outflow", "newVolume", "newDepth", "hyd_res_time")
+
+
+def replayable_methods():
+    """
+    Returns the methods whose kernels read only recorded inputs and dt,
+    including the methods registered so far.
+    """
+    return tuple(method for method, kernel in BATCH_KERNELS.items()
+                 if set(kernel.inputs) <= set(RECORDED_INPUTS + ("dt",)))
+
+
+class HydraulicRecording:
+    """
+    Recorded inputs of the treated (node, pollutant) columns.
+
+    keys = list of (ID, pollutant), one per column
+    dt = model dt of every step (seconds)
+    inputs = {name: array (steps, columns)} for every RECORDED_INPUTS name
+    quality = concentration SWMM reported after treatment (steps, columns)
+    """
+
+    def __init__(self, keys, dt, inputs, quality):
+        self.keys = [tuple(key) for key in keys]
+        self.column = {key: i for i, key in enumerate(self.keys)}
+        self.dt = np.asarray(dt, dtype=float)
+        self.inputs = inputs
+        self.quality = quality
+
+    @property
+    def times(self):
+        return np.cumsum(self.dt)
+
+    def __len__(self):
+        return len(self.dt)
+
+    def save(self, path):
+        np.savez(path, keys=np.array(self.keys, dtype=str), dt=self.dt, quality=self.quality,
+                 **{"input_" + name: values for name, values in self.inputs.items()})
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            inputs = {name[len("input_"):]: data[name] for name in data.files if name.startswith("input_")}
+            return cls([tuple(key) for key in data["keys"]], data["dt"], inputs, data["quality"])
+
+
+class HydraulicRecorder:
+    """
+    Records the replay inputs of treated nodes at the end of every
+    waterQuality step, reading them through the step cache (values the
+    kernels already read are not read again).
+
+    WQ = waterQuality object to attach to
+    assets = node IDs to record (default: every treated node)
+    """
+
+    def __init__(self, WQ, assets=None):
+        self.WQ = WQ
+        self.keys = [(t.ID, t.pollutant) for t in WQ.plan if t.element_type == ElementType.Nodes
+                     and (assets is None or t.ID in assets)]
+        IDs = [ID for ID, pollutant in self.keys]
+        columns = np.array([WQ.pollutant_index[pollutant] for ID, pollutant in self.keys], dtype=int)
+        self.sources = {}
+        for name in RECORDED_INPUTS + ("quality",):
+            buffer = WQ.cache.buffer(ElementType.Nodes, name)
+            self.sources[name] = (buffer, buffer.rows(IDs), columns if name in POLLUTANT_INPUTS else None)
+        self.dt = []
+        self.samples = {name: [] for name in self.sources}
+        WQ.recorders.append(self)
+
+    def sample(self):
+        self.dt.append(self.WQ.dt)
+        for name, source in self.sources.items():
+            self.samples[name].append(self.WQ.cache.read(*source))
+
+    def recording(self):
+        values = {name: np.array(samples).reshape(len(self.dt), len(self.keys))
+                  for name, samples in self.samples.items()}
+        quality = values.pop("quality")
+        return HydraulicRecording(self.keys, self.dt, values, quality)
+
+    def close(self):
+        if self in self.WQ.recorders:
+            self.WQ.recorders.remove(self)
+
+
+def record_hydraulics(inp, config, assets=None, steps=None):
+    """
+    Runs a SWMM simulation with StormReactor and returns the
+    HydraulicRecording of the treated nodes (or of the given assets).
+    """
+
+    with Simulation(inp) as sim:
+        WQ = waterQuality(sim, config)
+        recorder = HydraulicRecorder(WQ, assets)
+        for index, step in enumerate(sim):
+            WQ.updateWQState()
+            if steps is not None and index+1 >= steps:
+                break
+        recorder.close()
+    return recorder.recording()
+
+
+def compile_replay(recording, config):
+    """
+    Validates a replay config against a recording and returns the
+    treatment groups, each with the recording columns it reads.
+    """
+
+    groups = {}
+    for asset_ID, asset_info in config.items():
+        if asset_info.get("type", "node") != "node":
+            raise ValueError("'{}': only node treatments can be replayed".format(asset_ID))
+        for treatment in asset_info.get("treatments", [asset_info]):
+            method = treatment.get("method")
+            key = (asset_ID, treatment.get("pollutant"))
+            replayable = replayable_methods()
+            if method not in replayable:
+                raise ValueError("'{}': {} cannot be replayed. Replayable methods are: {}".format(
+                    asset_ID, method, ", ".join(replayable)))
+            if key not in recording.column:
+                raise ValueError("{} was not recorded".format(key))
+            parameters = treatment.get("parameters", {})
+            missing = [p for p in REQUIRED_PARAMETERS[method] if p not in parameters]
+            if missing:
+                raise ValueError("'{}': {} requires parameters {}".format(asset_ID, method, ", ".join(missing)))
+            kernel = BATCH_KERNELS[method]
+            options = tuple((o, parameters.get(o, default)) for o, default in (kernel.options or {}).items())
+            groups.setdefault((method, options), []).append(
+                Treatment(asset_ID, key[1], recording.column[key], method, parameters,
+                          ElementType.Nodes, kernel.func, False))
+    return [TreatmentGroup(method, ElementType.Nodes, BATCH_KERNELS[method], dict(options), treatments)
+            for (method, options), treatments in groups.items()]
+
+
+def replay_group(recording, group):
+    """
+    Replays one treatment group over the whole recording and returns the
+    treated concentrations (steps, assets). Steps where a kernel leaves an
+    asset untouched (its mask is False) keep the recorded concentration.
+    """
+
+    columns = np.array([recording.column[(ID, pollutant)] for ID, pollutant in zip(group.IDs, group.pollutants)])
+    inputs = {name: recording.inputs[name][:, columns] for name in group.kernel.inputs if name != "dt"}
+    parameters = [group.parameters[p] for p in group.kernel.parameters]
+    group.resetState()
+    C = recording.quality[:, columns].copy()
+    for t in range(len(recording)):
+        args = [recording.dt[t] if name == "dt" else inputs[name][t] for name in group.kernel.inputs]
+        if group.state is not None:
+            args.insert(0, group.state)
+        Cnew = group.kernel.func(*args, *parameters)
+        if isinstance(Cnew, tuple):
+            Cnew, update = Cnew
+            C[t, update] = Cnew[update]
+        else:
+            C[t] = Cnew
+    return C
+
+
+def replay(recording, config):
+    """
+    Replays the treatments in config against a HydraulicRecording without
+    SWMM and returns {(ID, pollutant): concentrations}, one value per
+    recorded step.
+    """
+
+    results = {}
+    for group in compile_replay(recording, config):
+        C = replay_group(recording, group)
+        for i, key in enumerate(zip(group.IDs, group.pollutants)):
+            results[key] = C[:, i]
+    return results
+
+
+class SweepResult:
+    """
+    Summary metrics of a parameter sweep, one value per parameter set,
+    shaped like the broadcast parameter grid.
+
+    parameters = {name: grid array}
+    inflow_load = sum of Qin*Cin*dt (the same for every set)
+    outflow_load = sum of Qout*C*dt
+    load_reduction = 1 - outflow_load/inflow_load
+    peak, mean = highest and time-weighted mean treated concentration
+    rmse = root mean square error against the reference series (NaN
+        without a reference)
+    """
+
+    def __init__(self, parameters, inflow_load, outflow_load, peak, mean, rmse):
+        self.parameters = parameters
+        self.inflow_load = inflow_load
+        self.outflow_load = outflow_load
+        self.peak = peak
+        self.mean = mean
+        self.rmse = rmse
+
+    @property
+    def load_reduction(self):
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return 1 - self.outflow_load/self.inflow_load
+
+    def best(self, metric="rmse"):
+        """
+        Returns the parameters of the set with the lowest metric (or the
+        highest load_reduction).
+        """
+        values = getattr(self, metric)
+        index = np.nanargmax(values) if metric == "load_reduction" else np.nanargmin(values)
+        index = np.unravel_index(index, values.shape)
+        return {name: float(grid[index]) for name, grid in self.parameters.items()}
+
+
+def sweep(recording, ID, pollutant, method, parameters, reference=None, options=None):
+    """
+    Replays one treated node for many parameter sets at once. The
+    parameter sets are a vector axis of the kernel (and of its state for
+    CSTR), so the whole sweep advances through time as one array
+    operation per step. Only running totals are kept, so memory grows
+    with the number of parameter sets, not with the number of steps.
+
+    recording = HydraulicRecording that includes (ID, pollutant)
+    method = one of replayable_methods()
+    parameters = {name: value or array}; arrays are broadcast together,
+        e.g. {"k": k[:, None], "C_s": C_s[None, :]} sweeps a k x C_s grid
+    reference = observed or reference concentration at every recorded
+        step, for the RMSE (NaN steps are skipped)
+    options = kernel options, e.g. {"integrator": "BDF"} for CSTR
+    """
+
+    replayable = replayable_methods()
+    if method not in replayable:
+        raise ValueError("{} cannot be replayed. Replayable methods are: {}".format(
+            method, ", ".join(replayable)))
+    if (ID, pollutant) not in recording.column:
+        raise ValueError("{} was not recorded".format((ID, pollutant)))
+    missing = [p for p in REQUIRED_PARAMETERS[method] if p not in parameters]
+    if missing:
+        raise ValueError("{} requires parameters {}".format(method, ", ".join(missing)))
+
+    kernel = BATCH_KERNELS[method]
+    names = list(parameters)
+    grids = np.broadcast_arrays(*[np.asarray(parameters[name], dtype=float) for name in names])
+    shape = grids[0].shape if grids else ()
+    flat = {name: np.ascontiguousarray(grid).ravel() for name, grid in zip(names, grids)}
+    P = max(int(np.prod(shape)), 1)
+    options = dict(kernel.options or {}, **(options or {}))
+    state = kernel.state(flat, options) if kernel.state is not None else None
+    arguments = [flat[p] for p in kernel.parameters]
+
+    column = recording.column[(ID, pollutant)]
+    inputs = {name: recording.inputs[name][:, column] for name in RECORDED_INPUTS}
+    quality = recording.quality[:, column]
+    if reference is not None:
+        reference = np.asarray(reference, dtype=float)
+    inflow_load = 0.0
+    outflow_load = np.zeros(P)
+    peak = np.full(P, -np.inf)
+    mass = np.zeros(P)
+    squared_error = np.zeros(P)
+    n_reference = 0
+    for t in range(len(recording)):
+        dt = recording.dt[t]
+        args = [dt if name == "dt" else np.full(P, inputs[name][t]) for name in kernel.inputs]
+        if state is not None:
+            args.insert(0, state)
+        C = kernel.func(*args, *arguments)
+        if isinstance(C, tuple):
+            C, update = C
+            C = np.where(update, C, quality[t])
+        C = np.broadcast_to(C, (P,))
+        inflow_load += inputs["totalinflow"][t]*inputs["inflowQual"][t]*dt
+        outflow_load += inputs["outflow"][t]*C*dt
+        np.maximum(peak, C, out=peak)
+        mass += C*dt
+        if reference is not None and not np.isnan(reference[t]):
+            squared_error += (C - reference[t])**2
+            n_reference += 1
+
+    duration = recording.dt.sum()
+    mean = mass/duration if duration > 0 else np.full(P, np.nan)
+    rmse = np.sqrt(squared_error/n_reference) if n_reference else np.full(P, np.nan)
+    grid = {name: flat[name].reshape(shape) for name in names}
+    return SweepResult(grid, inflow_load, outflow_load.reshape(shape), peak.reshape(shape),
+                       mean.reshape(shape), rmse.reshape(shape))
@@ -0,0 +1,163 @@
+"""
+What-if scenarios forked from a running StormReactor simulation.
+
+A ScenarioPool checkpoints a running Simulation + waterQuality at the
+current time (a SWMM hotstart file plus the water quality state, see
+waterQuality.save_state) and runs one scenario per worker process from
+that point to a horizon. A scenario can change link settings, apply a
+control function every step and override treatment parameters. Each
+scenario returns reduced water quality metrics (by default the mass
+balance of every treated asset over the horizon), so the scenarios can
+be compared directly. The main simulation is only read: it continues
+from where it was forked once the scenarios are done.
+
+Example:
+    scenarios = [Scenario("as is"), Scenario("close valve", settings={"Valve": 0.0})]
+    if __name__ == "__main__":
+        with ScenarioPool("model.inp", config) as pool, Simulation("model.inp") as sim:
+            WQ = waterQuality(sim, config)
+            for step in sim:
+                WQ.updateWQState()
+                if sim.current_time == decision_time:
+                    for outcome in pool.fork(WQ, scenarios, horizon=6*3600):
+                        print(outcome.scenario.name, outcome.result[("Tank", "P1")]["outflow"])
+
+Scripts that fork scenarios need the if __name__ == "__main__" guard
+because workers are started with the "spawn" method by default.
+"""
+
+import os
+from collections import namedtuple
+from datetime import timedelta
+
+import pyswmm.toolkitapi as tka
+from pyswmm import Simulation
+
+from StormReactor.ensemble import EnsemblePool, apply_overrides, summarize
+from StormReactor.waterQuality import waterQuality
+
+# One what-if scenario. settings = {link_ID: setting} applied when the
+# scenario starts; control = function (sim, WQ) called before every water
+# quality update, e.g. a control rule (it must be importable by the
+# workers); overrides = treatment parameter overrides (see
+# ensemble.apply_overrides).
+Scenario = namedtuple("Scenario", ["name", "settings", "control", "overrides"],
+                      defaults=(None, None, None))
+
+# Result of one scenario. error is None if the scenario succeeded,
+# otherwise the traceback or the reason its worker died.
+ScenarioResult = namedtuple("ScenarioResult", ["scenario", "result", "error"])
+
+
+def _run_scenario(inp, config, task, reducer, reportfile, outputfile, steps):
+    """
+    Ensemble runner for scenarios: task is (scenario, checkpoint, end
+    time). The scenario starts from the checkpoint and runs to the end
+    time.
+    """
+
+    scenario, checkpoint, end_time = task
+    config = apply_overrides(config, scenario.overrides or {})
+    with Simulation(inp, reportfile, outputfile) as sim:
+        WQ = waterQuality(sim, config, mass_balance=True)
+        WQ.load_state(checkpoint)
+        # SWMM can stop a step short of its end time, so run a little past
+        # the horizon and stop there
+        sim.end_time = min(end_time + timedelta(seconds=2*WQ.routing_step), sim.end_time)
+        for index, step in enumerate(sim):
+            if index == 0:
+                # Settings made before the simulation starts are ignored
+                for ID, setting in (scenario.settings or {}).items():
+                    sim._model.setLinkSetting(ID, setting)
+            if scenario.control is not None:
+                scenario.control(sim, WQ)
+            WQ.updateWQState()
+            if sim.current_time >= end_time or (steps is not None and index+1 >= steps):
+                break
+        return reducer(WQ)
+
+
+class ScenarioPool:
+    """
+    Pool of worker processes that run scenarios forked from a running
+    simulation of one model. The workers are kept alive between forks, so
+    a control study that forks at every decision time only starts them
+    once.
+
+    inp = path of the SWMM model
+    config = water quality config of the running simulation
+    reducer = function of the finished waterQuality object that returns
+        the (picklable) result of a scenario; it must be importable by the
+        workers. The default (summarize) returns the mass balance over
+        the horizon.
+    workers = number of worker processes (default: one per core)
+    timeout = seconds after which a scenario is stopped and reported failed
+    workdir = directory for the checkpoints and the scenarios' .rpt/.out
+        files (default: a temporary directory that is removed on close)
+    keep_files = keep the checkpoints and .rpt/.out files
+    context = multiprocessing start method
+    """
+
+    def __init__(self, inp, config, reducer=summarize, workers=None, timeout=None, workdir=None,
+                 keep_files=False, context="spawn"):
+        self.keep_files = keep_files
+        self.pool = EnsemblePool(inp, config, reducer, workers, None, timeout, workdir, keep_files,
+                                 context, runner=_run_scenario)
+        self.forks = 0
+
+    def fork(self, WQ, scenarios, horizon):
+        """
+        Checkpoints WQ and its simulation at the current time, runs every
+        scenario from there for horizon seconds (or to the end of the
+        simulation) and returns a ScenarioResult per scenario, in order.
+        Call it after WQ.updateWQState(). Link settings take effect from
+        the second routing step of a scenario, as a setting made in the
+        main simulation at this time would.
+
+        WQ = waterQuality object of the running simulation
+        scenarios = list of Scenarios
+        horizon = seconds to simulate after the fork
+        """
+
+        scenarios = [Scenario(*scenario) for scenario in scenarios]
+        model = WQ.sim._model
+        for scenario in scenarios:
+            for ID in scenario.settings or {}:
+                if not model.ObjectIDexist(tka.ObjectType.LINK.value, ID):
+                    raise ValueError("Scenario '{}': '{}' is not a link of the SWMM model".format(scenario.name, ID))
+
+        checkpoint = os.path.join(self.pool.workdir, "fork_{}.npz".format(self.forks))
+        hotstart = WQ.save_state(checkpoint)
+        self.forks += 1
+        end_time = min(WQ.sim.current_time + timedelta(seconds=horizon), WQ.sim.end_time)
+        results = [None]*len(scenarios)
+        try:
+            tasks = ((scenario, checkpoint, end_time) for scenario in scenarios)
+            for member in self.pool.stream(tasks):
+                results[member.index] = ScenarioResult(scenarios[member.index], member.result, member.error)
+        finally:
+            if not self.keep_files:
+                for path in (checkpoint, hotstart):
+                    if os.path.exists(path):
+                        os.remove(path)
+        return results
+
+    def close(self):
+        self.pool.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def fork_scenarios(inp, WQ, scenarios, horizon, **options):
+    """
+    Forks scenarios from a running simulation once (see ScenarioPool) and
+    returns a ScenarioResult per scenario, in order. options are passed
+    to ScenarioPool.
+    """
+
+    with ScenarioPool(inp, WQ.config, **options) as pool:
+        return pool.fork(WQ, scenarios, horizon)
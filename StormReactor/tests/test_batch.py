@@ -0,0 +1,180 @@
+from StormReactor import waterQuality, WaterQualityConfigError
+from StormReactor.recorder import Recorder
+from pyswmm import Simulation
+import numpy as np
+import pytest
+
+from StormReactor.tests.inps import (model_constantinflow_constanteffluent,
+                                     model_twotanks_constantinflow_constanteffluent,
+                                     LinkTest_variableinflow)
+
+"""
+Batch kernels:
+For each method, check the concentrations computed by the batch kernels
+(vectorize=True) match the per-asset methods (vectorize=False) at every
+step of the simulation, to within 1e-12 relative tolerance (the batch
+np.exp may differ from the scalar one by one ulp).
+"""
+
+NODE_CONFIGS = {
+    'EventMeanConc': {'C': 5.0},
+    'ConstantRemoval': {'R': 0.5},
+    'CoRemoval': {'R1': 0.75, 'R2': 0.15},
+    'ConcDependRemoval': {'R_l': 0.50, 'BC': 10.0, 'R_u': 0.75},
+    'NthOrderReaction': {'k': 0.01, 'n': 2.0},
+    'kCModel': {'k': 0.01, 'C_s': 10.0},
+    'GravitySettling': {'k': 0.01, 'C_s': 10.0},
+    'Phosphorus': {'B1': 0.0000333, 'Ceq0': 0.0081, 'k': 0.00320, 'L': 0.91, 'A': 100, 'E': 0.44},
+    }
+
+LINK_CONFIGS = {method: NODE_CONFIGS[method] for method in
+                ('EventMeanConc', 'ConstantRemoval', 'CoRemoval', 'ConcDependRemoval',
+                 'NthOrderReaction', 'GravitySettling')}
+
+
+def run_model(model, config, vectorize, pollutants=('P1',)):
+    with Simulation(model) as sim:
+        WQ = waterQuality(sim, config, vectorize=vectorize)
+        recorder = Recorder(WQ, [(ID, 'concentration', p) for ID in config for p in pollutants])
+        for step in sim:
+            WQ.updateWQState()
+    return recorder.recording().data[:, 1:]
+
+
+@pytest.mark.parametrize("method", sorted(NODE_CONFIGS))
+def test_batch_matches_per_asset_nodes(method):
+    dict1 = {'Tank': {'type': 'node', 'pollutant': 'P1', 'method': method, 'parameters': NODE_CONFIGS[method]}}
+    batch = run_model(model_constantinflow_constanteffluent, dict1, True)
+    scalar = run_model(model_constantinflow_constanteffluent, dict1, False)
+    np.testing.assert_allclose(batch, scalar, rtol=1e-12, atol=0.0)
+
+
+@pytest.mark.parametrize("method", sorted(LINK_CONFIGS))
+def test_batch_matches_per_asset_links(method):
+    dict1 = {'Culvert': {'type': 'link', 'pollutant': 'P1', 'method': method, 'parameters': LINK_CONFIGS[method]}}
+    batch = run_model(LinkTest_variableinflow, dict1, True)
+    scalar = run_model(LinkTest_variableinflow, dict1, False)
+    np.testing.assert_allclose(batch, scalar, rtol=1e-12, atol=0.0)
+
+
+def test_batch_group_with_different_parameters():
+    dict1 = {'Tank1': {'type': 'node', 'pollutant': 'P1', 'method': 'GravitySettling', 'parameters': {'k': 0.01, 'C_s': 10.0}},
+             'Tank2': {'type': 'node', 'pollutant': 'P1', 'method': 'GravitySettling', 'parameters': {'k': 0.05, 'C_s': 2.0}},
+             'Link1': {'type': 'link', 'pollutant': 'P1', 'method': 'ConstantRemoval', 'parameters': {'R': 0.3}}}
+    batch = run_model(model_twotanks_constantinflow_constanteffluent, dict1, True)
+    scalar = run_model(model_twotanks_constantinflow_constanteffluent, dict1, False)
+    np.testing.assert_allclose(batch, scalar, rtol=1e-12, atol=0.0)
+
+
+def test_extra_parameter_keys_are_ignored(capsys):
+    plain = {'Tank1': {'type': 'node', 'pollutant': 'P1', 'method': 'GravitySettling',
+                       'parameters': {'k': 0.01, 'C_s': 2.0}}}
+    extra = {'Tank1': dict(plain['Tank1'], parameters={'k': 0.01, 'C_s': 2.0, 'note': 'inlet bay'})}
+    for vectorize in (True, False):
+        np.testing.assert_array_equal(run_model(model_twotanks_constantinflow_constanteffluent, extra, vectorize),
+                                      run_model(model_twotanks_constantinflow_constanteffluent, plain, vectorize))
+    assert "GravitySettling ignores unknown parameters 'note'" in capsys.readouterr().out
+
+
+def test_non_numeric_parameter():
+    config = {'Tank1': {'type': 'node', 'pollutant': 'P1', 'method': 'GravitySettling',
+                        'parameters': {'k': 'fast', 'C_s': 2.0}}}
+    with Simulation(model_twotanks_constantinflow_constanteffluent) as sim:
+        with pytest.raises(ValueError, match="'k' must be a number.*'Tank1'"):
+            waterQuality(sim, config)
+
+
+# CSTR: each tank owns its state, and all tanks are integrated as one
+# vector ODE, so results match the per-asset solver to solver tolerance.
+CSTR_CONFIG = {'Tank1': {'type': 'node', 'pollutant': 'P1', 'method': 'CSTR', 'parameters': {'k': -0.2, 'n': 1.0, 'c0': 10.0}},
+               'Tank2': {'type': 'node', 'pollutant': 'P1', 'method': 'CSTR', 'parameters': {'k': -0.01, 'n': 2.0, 'c0': 0.0}}}
+
+def test_batch_CSTR_matches_per_asset():
+    batch = run_model(model_twotanks_constantinflow_constanteffluent, CSTR_CONFIG, True)
+    scalar = run_model(model_twotanks_constantinflow_constanteffluent, CSTR_CONFIG, False)
+    assert np.all(np.isfinite(batch))
+    np.testing.assert_allclose(batch, scalar, rtol=1e-5, atol=1e-8)
+
+
+def test_CSTR_tanks_are_independent():
+    both = run_model(model_twotanks_constantinflow_constanteffluent, CSTR_CONFIG, True)
+    alone = run_model(model_twotanks_constantinflow_constanteffluent, {'Tank1': CSTR_CONFIG['Tank1']}, True)
+    np.testing.assert_allclose(both[:, 0], alone[:, 0], rtol=1e-5, atol=1e-8)
+
+
+@pytest.mark.parametrize("integrator", ["vode-bdf", "lsoda", "LSODA"])
+def test_CSTR_integrator_choice(integrator):
+    config = {ID: {'type': 'node', 'pollutant': 'P1', 'method': 'CSTR',
+                   'parameters': dict(info['parameters'], n=2.0, integrator=integrator)}
+              for ID, info in CSTR_CONFIG.items()}
+    default = {ID: {'type': 'node', 'pollutant': 'P1', 'method': 'CSTR',
+                    'parameters': dict(info['parameters'], n=2.0)}
+               for ID, info in CSTR_CONFIG.items()}
+    chosen = run_model(model_twotanks_constantinflow_constanteffluent, config, True)
+    reference = run_model(model_twotanks_constantinflow_constanteffluent, default, True)
+    np.testing.assert_allclose(chosen, reference, rtol=1e-3, atol=1e-6)
+
+
+# Stacked treatments: several pollutants per asset, each with its own method
+STACKED_CONFIG = {'Tank1': {'type': 'node', 'treatments': [
+    {'pollutant': 'P1', 'method': 'GravitySettling', 'parameters': {'k': 0.01, 'C_s': 2.0}},
+    {'pollutant': 'P2', 'method': 'ConstantRemoval', 'parameters': {'R': 0.4}}]}}
+
+@pytest.mark.parametrize("vectorize", [True, False])
+def test_stacked_treatments_match_single_treatments(vectorize):
+    stacked = run_model(model_twotanks_constantinflow_constanteffluent, STACKED_CONFIG, vectorize, ('P1', 'P2'))
+    for column, treatment in enumerate(STACKED_CONFIG['Tank1']['treatments']):
+        single = {'Tank1': dict(treatment, type='node')}
+        alone = run_model(model_twotanks_constantinflow_constanteffluent, single, vectorize, ('P1', 'P2'))
+        np.testing.assert_array_equal(stacked[:, column], alone[:, column])
+
+
+@pytest.mark.parametrize("vectorize", [True, False])
+def test_stacked_treatments_read_pollutants_once(vectorize):
+    calls = []
+    with Simulation(model_twotanks_constantinflow_constanteffluent) as sim:
+        getNodePollut = sim._model.getNodePollut
+        def counted(ID, quantity):
+            calls.append((ID, quantity))
+            return getNodePollut(ID, quantity)
+        sim._model.getNodePollut = counted
+        WQ = waterQuality(sim, STACKED_CONFIG, vectorize=vectorize)
+        for index, step in enumerate(sim):
+            WQ.updateWQState()
+            if index == 9:
+                break
+    assert len(calls) == 10
+
+
+def test_stacked_treatments_duplicate_pollutant():
+    dict1 = {'Tank1': {'type': 'node', 'treatments': [
+        {'pollutant': 'P1', 'method': 'ConstantRemoval', 'parameters': {'R': 0.4}},
+        {'pollutant': 'P1', 'method': 'EventMeanConc', 'parameters': {'C': 1.0}}]}}
+    with Simulation(model_twotanks_constantinflow_constanteffluent) as sim:
+        with pytest.raises(WaterQualityConfigError, match="treated more than once"):
+            waterQuality(sim, dict1)
+
+
+@pytest.mark.parametrize("vectorize", [True, False])
+def test_state_cache_counters(vectorize):
+    # Tank1 and Tank2 both read totalinflow and newDepth for P1 and P2, and
+    # all four treatments read the inflowQual vector of their tank, with
+    # the batch kernels or the per-asset methods
+    dict1 = {ID: {'type': 'node', 'treatments': [
+                {'pollutant': 'P1', 'method': 'GravitySettling', 'parameters': {'k': 0.01, 'C_s': 2.0}},
+                {'pollutant': 'P2', 'method': 'GravitySettling', 'parameters': {'k': 0.02, 'C_s': 1.0}}]}
+             for ID in ('Tank1', 'Tank2')}
+    with Simulation(model_twotanks_constantinflow_constanteffluent) as sim:
+        WQ = waterQuality(sim, dict1, vectorize=vectorize)
+        # Every row is registered when the plan is compiled, so the
+        # buffers are allocated once
+        values = {key: buffer.values for key, buffer in WQ.cache.buffers.items()}
+        assert len(values) == 3
+        for index, step in enumerate(sim):
+            WQ.updateWQState()
+            if index == 9:
+                break
+        assert all(WQ.cache.buffers[key].values is values[key] for key in values)
+        assert WQ.cache.calls == 10*3*2
+        assert WQ.cache.requests == 10*3*4
+        assert WQ.cache.avoided == 10*3*2
@@ -0,0 +1,37 @@
+from StormReactor.benchmark import benchmark_method, run_benchmarks, save_results, load_results, compare_results
+import os
+import tempfile
+
+"""
+Benchmark suite:
+Check a small benchmark run reports per-step timings and toolkit call
+counts, that results round-trip through JSON, that a slower run is
+flagged as a regression against a baseline, and that runs without a
+workdir remove their temporary files.
+"""
+
+
+def test_benchmark_record(tmp_path):
+    record = benchmark_method("GravitySettling", 3, steps=5, workdir=str(tmp_path))
+    assert record["steps"] == 5
+    assert record["engine"] == "batch"
+    assert record["wq_per_step_s"] > 0.0
+    # Inflow quality, total inflow and depth are read for every tank
+    assert record["toolkit_gets_per_step"] == 3*3
+    assert record["toolkit_sets_per_step"] == 3
+
+
+def test_benchmark_regression(tmp_path):
+    record = benchmark_method("ConstantRemoval", 2, steps=3, vectorize=False, workdir=str(tmp_path))
+    baseline = save_results([record], str(tmp_path / "baseline.json"))
+    assert load_results(str(tmp_path / "baseline.json"))["records"] == [record]
+    slower = dict(record, wq_per_step_s=2*record["wq_per_step_s"])
+    assert compare_results(baseline, {"records": [record]}) == []
+    assert compare_results(baseline, {"records": [slower]}) == [(record, slower)]
+
+
+def test_benchmark_removes_temporary_files(tmp_path, monkeypatch):
+    monkeypatch.setattr(tempfile, "tempdir", str(tmp_path))
+    benchmark_method("ConstantRemoval", 2, steps=3)
+    run_benchmarks(["ConstantRemoval"], sizes=(2,), steps=3, verbose=False)
+    assert os.listdir(str(tmp_path)) == []
@@ -0,0 +1,84 @@
+from StormReactor.calibration import Calibration, Objective, Observation, calibrate
+from StormReactor.replay import record_hydraulics
+import numpy as np
+import pytest
+
+from StormReactor.tests.inps import model_constantinflow_constanteffluent
+
+"""
+Calibration:
+Generate a "observed" series with known parameters, then check the
+optimizers recover them from bounds alone, in this process and with
+workers, that repeated candidates come from the cache, and that trials
+worse than the best so far are stopped early and simulated again when
+they are repeated.
+"""
+
+
+def observed(method, parameters, steps=300, every=10):
+    config = {'Tank': {'type': 'node', 'pollutant': 'P1', 'method': method, 'parameters': parameters}}
+    recording = record_hydraulics(model_constantinflow_constanteffluent, config, steps=steps)
+    index = np.arange(every, steps, every)
+    return [Observation('Tank', 'P1', recording.times[index], recording.quality[index, 0])]
+
+
+def config(method, parameters):
+    return {'Tank': {'type': 'node', 'pollutant': 'P1', 'method': method, 'parameters': parameters}}
+
+
+def test_calibrate_serial():
+    observations = observed('ConstantRemoval', {'R': 0.3})
+    result = calibrate(model_constantinflow_constanteffluent, config('ConstantRemoval', {'R': 0.5}),
+                       observations, {'Tank': {'R': (0.0, 1.0)}}, method='Nelder-Mead', workers=0,
+                       options={'xatol': 1e-6, 'fatol': 1e-12})
+    assert result.parameters['Tank']['R'] == pytest.approx(0.3, abs=1e-4)
+    assert result.config['Tank']['parameters']['R'] == result.parameters['Tank']['R']
+    assert result.error < 1e-6
+    assert result.pruned > 0
+
+
+def test_calibrate_workers():
+    observations = observed('kCModel', {'k': 0.02, 'C_s': 4.0})
+    free = {'Tank': {'k': (0.001, 0.1), 'C_s': (0.0, 8.0)}}
+    with Calibration(model_constantinflow_constanteffluent, config('kCModel', {'k': 0.01, 'C_s': 1.0}),
+                     observations, free, workers=2) as calibration:
+        result = calibration.fit(seed=1, popsize=8, maxiter=30, tol=0)
+        assert result.parameters['Tank']['k'] == pytest.approx(0.02, rel=0.1)
+        assert result.parameters['Tank']['C_s'] == pytest.approx(4.0, rel=0.1)
+        assert result.pruned > 0
+        # Evaluating the best candidate again is answered from the cache
+        hits = calibration.cache_hits
+        x = [result.parameters['Tank']['k'], result.parameters['Tank']['C_s']]
+        assert calibration.evaluate([x, x]) == [result.error, result.error]
+        assert calibration.cache_hits == hits + 2
+        assert calibration.evaluations == result.evaluations
+
+
+def test_objective_prunes():
+    observations = observed('ConstantRemoval', {'R': 0.3})
+    objective = Objective(observations)
+    error, complete = objective.run(model_constantinflow_constanteffluent, config('ConstantRemoval', {'R': 0.3}))
+    assert complete and error == pytest.approx(0.0, abs=1e-12)
+    error, complete = objective.run(model_constantinflow_constanteffluent, config('ConstantRemoval', {'R': 0.9}),
+                                    threshold=1.0)
+    assert not complete and error > 1.0
+
+
+def test_pruned_trials_not_cached():
+    with Calibration(model_constantinflow_constanteffluent, config('ConstantRemoval', {'R': 0.5}),
+                     observed('ConstantRemoval', {'R': 0.3}), {'Tank': {'R': (0.0, 1.0)}}, workers=0) as calibration:
+        assert calibration([0.3]) == pytest.approx(0.0, abs=1e-12)
+        error = calibration([0.9])
+        assert calibration.pruned == 1 and (0.9,) not in calibration.cache
+        # A pruned candidate is simulated again, not answered from the cache
+        assert calibration([0.9]) == error
+        assert calibration.pruned == 2
+        assert calibration.evaluations == 3 and calibration.cache_hits == 0
+        assert calibration([0.3]) == pytest.approx(0.0, abs=1e-12)
+        assert calibration.cache_hits == 1
+
+
+def test_calibration_rejects_unknown_asset():
+    with pytest.raises(KeyError):
+        Calibration(model_constantinflow_constanteffluent, config('ConstantRemoval', {'R': 0.5}),
+                    observed('ConstantRemoval', {'R': 0.3}), {'Pond': {'R': (0.0, 1.0)}}, workers=0)
@@ -0,0 +1,112 @@
+from StormReactor import waterQuality, WaterQualityStateError
+from pyswmm import Simulation
+import numpy as np
+import pytest
+
+from StormReactor.tests.inps import model_constantinflow_constanteffluent
+
+"""
+Checkpoint and hot-start:
+Check that a run resumed from save_state()/load_state() and the paired
+SWMM hotstart file continues like the uninterrupted run (CSTR reactor
+concentrations, solver clocks, event clocks and the water quality
+clock), for both engines, that a state loaded without a hotstart keeps
+the simulation's clock, and that states saved for other assets or
+loaded after the simulation started are rejected.
+"""
+
+CONFIG = {'Tank': {'type': 'node', 'pollutant': 'P1', 'method': 'CSTR',
+                   'parameters': {'k': -0.01, 'n': 2.0, 'c0': 0.0}},
+          'Valve': {'type': 'link', 'pollutant': 'P1', 'method': 'ConstantRemoval', 'parameters': {'R': 0.5}}}
+PHOSPHORUS = {'Tank': {'type': 'node', 'pollutant': 'P1', 'method': 'Phosphorus',
+                       'parameters': {'B1': 0.0000333, 'Ceq0': 0.0081, 'k': 0.00320, 'L': 0.91, 'A': 100, 'E': 0.44}}}
+
+
+def run(config, vectorize=True, save=None, load=None, stop=None):
+    with Simulation(model_constantinflow_constanteffluent) as sim:
+        WQ = waterQuality(sim, config, vectorize=vectorize)
+        if load is not None:
+            WQ.load_state(load)
+        states = {}
+        for index, step in enumerate(sim):
+            WQ.updateWQState()
+            states[sim.current_time] = (WQ.states.copy(), sim._model.getNodePollut('Tank', 0)[0])
+            if index == stop:
+                WQ.save_state(save)
+                break
+        return states, WQ
+
+
+@pytest.mark.parametrize("vectorize", [True, False])
+@pytest.mark.parametrize("config", [CONFIG, PHOSPHORUS])
+def test_resume_matches_uninterrupted(tmp_path, vectorize, config):
+    path = str(tmp_path / "spinup.npz")
+    full, _ = run(config, vectorize)
+    spinup, saved = run(config, vectorize, save=path, stop=599)
+    assert (tmp_path / "spinup.hsf").exists()
+    resumed, WQ = run(config, vectorize, load=path)
+    # The resumed run starts where the spin-up stopped
+    assert min(resumed) == max(spinup) + (max(spinup) - sorted(spinup)[-2])
+    assert WQ.start_time == saved.start_time
+    assert WQ.step_index == saved.step_index + len(resumed)
+    for time in resumed:
+        for field in ('C', 'event_time', 'last_update'):
+            np.testing.assert_allclose(resumed[time][0][field], full[time][0][field], rtol=1e-6, atol=1e-9)
+        # SWMM applies the concentrations set by StormReactor one step later
+        if time > min(resumed):
+            assert resumed[time][1] == pytest.approx(full[time][1], rel=1e-6)
+
+
+def test_solver_clock_resumes(tmp_path):
+    path = str(tmp_path / "spinup")
+    _, saved = run(CONFIG, save=path, stop=599)
+    with Simulation(model_constantinflow_constanteffluent) as sim:
+        WQ = waterQuality(sim, CONFIG)
+        WQ.load_state(path)
+        assert WQ.groups[0].state.t == saved.groups[0].state.t == 600.0
+        assert WQ.last_timestep == saved.last_timestep
+
+
+def test_load_state_errors(tmp_path):
+    path = str(tmp_path / "spinup.npz")
+    run(CONFIG, save=path, stop=10)
+    with Simulation(model_constantinflow_constanteffluent) as sim:
+        WQ = waterQuality(sim, PHOSPHORUS)
+        with pytest.raises(WaterQualityStateError):
+            WQ.load_state(path)
+    with Simulation(model_constantinflow_constanteffluent) as sim:
+        WQ = waterQuality(sim, CONFIG)
+        for step in sim:
+            WQ.updateWQState()
+            break
+        with pytest.raises(WaterQualityStateError):
+            WQ.load_state(path)
+        # The water quality state alone can be loaded mid-run
+        WQ.load_state(path, hotstart=False)
+        assert WQ.step_index == 1
+
+
+@pytest.mark.parametrize("started", [False, True])
+def test_load_state_without_hotstart(tmp_path, started):
+    path = str(tmp_path / "spinup.npz")
+    full, _ = run(CONFIG)
+    largest = max(states['C'][0] for states, _ in full.values())
+    _, saved = run(CONFIG, save=path, stop=599)
+    with Simulation(model_constantinflow_constanteffluent) as sim:
+        WQ = waterQuality(sim, CONFIG)
+        concentrations = []
+        for index, step in enumerate(sim):
+            if index == int(started):
+                # The saved state is 600 steps ahead of this simulation
+                WQ.load_state(path, hotstart=False)
+                assert WQ.last_timestep <= sim.current_time
+                assert WQ.states['C'][0] == saved.states['C'][0]
+            WQ.updateWQState()
+            assert WQ.dt > 0.0
+            concentrations.append(WQ.states['C'][0])
+            if index == 10:
+                break
+    concentrations = np.array(concentrations)
+    assert np.all(np.isfinite(concentrations))
+    # The reactor continues from the loaded concentration without blowing up
+    assert np.all((concentrations >= 0.0) & (concentrations <= 2*largest))
@@ -0,0 +1,93 @@
+from StormReactor import waterQuality, WaterQualityConfigError
+from pyswmm import Simulation
+import numpy as np
+import pytest
+
+from StormReactor.tests.inps import model_constantinflow_constanteffluent
+
+"""
+Update decimation:
+Check that groups with an update interval are updated once per interval
+and hold in between, that the CSTR reactor state caught up over 60 s
+matches a run updated every routing step, that the decimated
+concentrations stay within the documented bound of the every-step
+results, that intervals can be set per method and per asset, and the
+messages and errors.
+"""
+
+CSTR_CONFIG = {'Tank': {'type': 'node', 'pollutant': 'P1', 'method': 'CSTR',
+                        'parameters': {'k': -0.01, 'n': 2.0, 'c0': 0.0}}}
+KC_CONFIG = {'Tank': {'type': 'node', 'pollutant': 'P1', 'method': 'kCModel',
+                      'parameters': {'k': 0.02, 'C_s': 4.0}}}
+NTH_CONFIG = {'Tank': {'type': 'node', 'pollutant': 'P1', 'method': 'NthOrderReaction',
+                       'parameters': {'k': 0.01, 'n': 1.0}}}
+
+
+def run(config, update_interval=None):
+    with Simulation(model_constantinflow_constanteffluent) as sim:
+        WQ = waterQuality(sim, config, update_interval=update_interval)
+        concentrations = {}
+        states = {}
+        for step in sim:
+            WQ.updateWQState()
+            time = (sim.current_time - WQ.start_time).total_seconds()
+            concentrations[time] = sim._model.getNodePollut('Tank', 0)[0]
+            if WQ.groups[0].state is not None:
+                states[time] = WQ.groups[0].state.C[0]
+        return concentrations, states, WQ
+
+
+def test_decimation_counts():
+    concentrations, states, WQ = run(KC_CONFIG, update_interval=60)
+    report = WQ.decimation()[('Tank', 'P1')]
+    assert report['interval'] == 60.0
+    assert report['updates'] == 30
+    assert report['updates'] + report['held'] == len(concentrations)
+
+
+def test_decimation_CSTR_catch_up():
+    every_step, every_state, _ = run(CSTR_CONFIG)
+    decimated, decimated_state, WQ = run(CSTR_CONFIG, update_interval=60)
+    # The reactor state is only integrated at updates, over the whole interval
+    assert decimated_state[62] == decimated_state[120] != decimated_state[121]
+    for time in (601, 1201, 1741):
+        assert decimated_state[time] == pytest.approx(every_state[time], rel=1e-4)
+
+
+@pytest.mark.parametrize("config", [KC_CONFIG, CSTR_CONFIG])
+def test_decimation_hold_bound(config):
+    # A held concentration lags the every-step result by at most the change
+    # of the every-step result over one interval
+    every_step, _, _ = run(config)
+    decimated, _, _ = run(config, update_interval=60)
+    times = np.array(sorted(every_step))
+    values = np.array([every_step[t] for t in times])
+    for time, value in zip(times, values):
+        window = values[(times >= time - 61) & (times <= time)]
+        assert abs(decimated[time] - value) <= window.max() - window.min() + 1e-4
+
+
+def test_decimation_reaction_bound():
+    # NthOrderReaction stays within one interval of reaction of the
+    # every-step result
+    every_step, _, _ = run(NTH_CONFIG)
+    decimated, _, WQ = run(NTH_CONFIG, update_interval=60)
+    max_change = WQ.decimation()[('Tank', 'P1')]['max_change']
+    assert max(abs(decimated[t] - every_step[t]) for t in every_step) <= max_change
+
+
+def test_decimation_per_method_and_asset():
+    config = {'Tank': dict(KC_CONFIG['Tank'], update_interval=120)}
+    _, _, WQ = run(config, update_interval={'kCModel': 60})
+    assert WQ.groups[0].interval == 120.0
+    _, _, WQ = run(KC_CONFIG, update_interval={'CSTR': 60})
+    assert WQ.groups[0].interval is None
+    assert WQ.groups[0].holds == 0
+
+
+def test_decimation_errors(capsys):
+    with pytest.raises(WaterQualityConfigError):
+        run(KC_CONFIG, update_interval=-1)
+    _, _, WQ = run(KC_CONFIG)
+    assert WQ.decimation() is None
+    assert "No update interval is set" in capsys.readouterr().out
@@ -0,0 +1,54 @@
+from StormReactor.ensemble import run_ensemble, run_member, apply_overrides, summarize
+import os
+import pytest
+
+from StormReactor.tests.inps import model_constantinflow_constanteffluent
+
+"""
+Ensemble runner:
+Check members run in worker processes give the same results as a serial
+run, that a member that raises or kills its worker is reported as failed
+while the other members finish, and that overrides target the right
+treatments.
+"""
+
+CONFIG = {'Tank': {'type': 'node', 'pollutant': 'P1', 'method': 'ConstantRemoval', 'parameters': {'R': 0.5}}}
+STEPS = 200
+
+
+def crashing_reducer(WQ):
+    # Kills the worker for one member, like a crash inside SWMM would
+    if WQ.config['Tank']['parameters']['R'] == 0.3:
+        os._exit(3)
+    return summarize(WQ)
+
+
+def test_ensemble_matches_serial():
+    overrides = [{'Tank': {'R': R}} for R in (0.1, 0.5, 0.9)]
+    members = run_ensemble(model_constantinflow_constanteffluent, CONFIG, overrides, workers=2, steps=STEPS)
+    assert [m.index for m in members] == [0, 1, 2]
+    for member in members:
+        assert member.error is None
+        serial = run_member(model_constantinflow_constanteffluent, apply_overrides(CONFIG, member.overrides), steps=STEPS)
+        assert member.result == serial
+    assert members[0].result[('Tank', 'P1')]['outflow'] > members[2].result[('Tank', 'P1')]['outflow']
+
+
+def test_ensemble_survives_failed_members():
+    overrides = [{'Tank': {'R': 0.1}}, {'Tank': {'R': 0.3}}, {'Missing': {'R': 0.1}}, {'Tank': {'R': 0.7}}]
+    members = run_ensemble(model_constantinflow_constanteffluent, CONFIG, iter(overrides), workers=2,
+                           steps=STEPS, reducer=crashing_reducer)
+    assert [m.error is None for m in members] == [True, False, False, True]
+    assert "exit code 3" in members[1].error
+    assert "KeyError" in members[2].error
+
+
+def test_apply_overrides():
+    config = {'Tank': {'type': 'node', 'treatments': [
+        {'pollutant': 'P1', 'method': 'GravitySettling', 'parameters': {'k': 0.01, 'C_s': 2.0}},
+        {'pollutant': 'P2', 'method': 'GravitySettling', 'parameters': {'k': 0.01, 'C_s': 2.0}}]}}
+    new = apply_overrides(config, {('Tank', 'P2'): {'k': 0.5}})
+    assert [t['parameters']['k'] for t in new['Tank']['treatments']] == [0.01, 0.5]
+    assert config['Tank']['treatments'][1]['parameters']['k'] == 0.01
+    with pytest.raises(KeyError):
+        apply_overrides(config, {('Tank', 'P3'): {'k': 0.5}})
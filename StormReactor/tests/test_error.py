@@ -1,31 +1,32 @@
 import pytest
-from StormReactor import waterQuality, PySWMMStepAdvanceNotSupported
+from StormReactor import waterQuality, WaterQualityConfigError
 from pyswmm import Simulation, Nodes
 
-from StormReactor.tests.inps import (model_constantinflow_constanteffluent)
+from StormReactor.tests.inps import (model_constantinflow_constanteffluent,
+                                     LinkTest_variableinflow)
 
-def test_step_advnace_exception_updateWQState():
-    with pytest.raises(PySWMMStepAdvanceNotSupported):
-        dict1 = {'Tank': {'type': 'node',
-                          'pollutant': 'P1',
-                          'method': 'EventMeanConc',
-                          'parameters': {'C': 5.0}}}
-        with Simulation(model_constantinflow_constanteffluent) as sim:
-            EMC = waterQuality(sim, dict1)
-            sim.step_advance(300)
-            for step in sim:
-                EMC.updateWQState()
+@pytest.mark.parametrize("asset_info, reason", [
+    ({'type': 'node', 'pollutant': 'P1', 'method': 'Unknown', 'parameters': {}}, "unknown water quality method"),
+    ({'type': 'node', 'pollutant': 'P1', 'method': 'GravitySettling', 'parameters': {'k': 0.01}}, "requires parameters C_s"),
+    ({'type': 'node', 'pollutant': 'PX', 'method': 'EventMeanConc', 'parameters': {'C': 5.0}}, "pollutant 'PX' does not exist"),
+    ({'type': 'pipe', 'pollutant': 'P1', 'method': 'EventMeanConc', 'parameters': {'C': 5.0}}, "type must be 'node' or 'link'"),
+    ({'type': 'node', 'pollutant': 'P1', 'method': 'CSTR', 'parameters': {'k': -0.2, 'n': 2.0, 'c0': 10.0, 'integrator': 'euler'}}, "unknown CSTR integrator"),
+    ])
+def test_config_validation(asset_info, reason):
+    with Simulation(model_constantinflow_constanteffluent) as sim:
+        with pytest.raises(WaterQualityConfigError, match=reason):
+            waterQuality(sim, {'Tank': asset_info})
 
 
-def test_step_advnace_exception_updateWQState_CSTR():
-    with pytest.raises(PySWMMStepAdvanceNotSupported):
-        dict1 = {'Tank': {'type': 'node',
-                          'pollutant': 'P1',
-                          'method': 'CSTR',
-                          'parameters': {'k': -0.2, 'n': 1.0, 'c0': 10.0}}}
+def test_config_validation_missing_asset():
+    dict1 = {'NoTank': {'type': 'node', 'pollutant': 'P1', 'method': 'EventMeanConc', 'parameters': {'C': 5.0}}}
+    with Simulation(model_constantinflow_constanteffluent) as sim:
+        with pytest.raises(WaterQualityConfigError, match="does not exist in the SWMM model"):
+            waterQuality(sim, dict1)
 
-        with Simulation(model_constantinflow_constanteffluent) as sim:
-            CS = waterQuality(sim, dict1)
-            sim.step_advance(300)
-            for index,step in enumerate(sim):
-                CS.updateWQState_CSTR(index)
+
+def test_config_validation_node_only_method():
+    dict1 = {'Culvert': {'type': 'link', 'pollutant': 'P1', 'method': 'kCModel', 'parameters': {'k': 0.01, 'C_s': 10.0}}}
+    with Simulation(LinkTest_variableinflow) as sim:
+        with pytest.raises(WaterQualityConfigError, match="does not work for links"):
+            waterQuality(sim, dict1)
@@ -0,0 +1,73 @@
+from StormReactor import waterQuality
+from StormReactor.networks import generate_network
+from StormReactor.waterQuality import ToolkitCounter
+from pyswmm import Simulation
+import numpy as np
+import pytest
+
+from StormReactor.tests.inps import model_constantinflow_constanteffluent
+
+"""
+Activity gating:
+On a synthetic network whose tanks are dry until their storm arrives,
+check that gated assets are skipped while dry, that the concentrations
+are the same as without gating at every step, that fewer toolkit reads
+are made, and that methods without hydraulic inputs and Phosphorus,
+which leaves dry nodes unset, are not gated.
+"""
+
+METHODS = ("GravitySettling", "kCModel", "Phosphorus", "ConstantRemoval")
+
+
+def run(inp, config, gating):
+    with Simulation(inp) as sim:
+        with ToolkitCounter(sim) as counter:
+            WQ = waterQuality(sim, config, gating=gating)
+            conc = []
+            for step in sim:
+                WQ.updateWQState()
+                conc.append([sim._model.getNodePollut(ID, 0)[0] for ID in config])
+        return np.array(conc), counter.gets, WQ.activity()
+
+
+def test_gating_matches_ungated(tmp_path):
+    inp = str(tmp_path / "network.inp")
+    config = generate_network(inp, 12, topology="star", methods=METHODS, duration=3600, seed=3)
+    conc, gets, _ = run(inp, config, False)
+    gated_conc, gated_gets, activity = run(inp, config, True)
+    np.testing.assert_array_equal(gated_conc, conc)
+    assert gated_gets < gets
+    steps = len(conc)
+    for ID, info in config.items():
+        if info["method"] in ("ConstantRemoval", "Phosphorus"):
+            assert (ID, "P1") not in activity
+        else:
+            counts = activity[(ID, "P1")]
+            assert counts["evaluated"] + counts["skipped"] == steps
+    assert sum(counts["skipped"] for counts in activity.values()) > 0
+
+
+def test_activity_off(capsys):
+    config = {'Tank': {'type': 'node', 'pollutant': 'P1', 'method': 'GravitySettling', 'parameters': {'k': 0.01, 'C_s': 2.0}}}
+    with Simulation(model_constantinflow_constanteffluent) as sim:
+        WQ = waterQuality(sim, config)
+        assert WQ.activity() is None
+        waterQuality(sim, config, vectorize=False, gating=True)
+    out = capsys.readouterr().out
+    assert "gating is off" in out and "only applies to batch kernels" in out
+
+
+def test_gating_wet_then_dry(tmp_path):
+    # The storms pass and the tanks drain, so gated assets fall asleep
+    inp = str(tmp_path / "network.inp")
+    config = generate_network(inp, 6, topology="star", methods=("GravitySettling", "kCModel", "Phosphorus"),
+                              duration=6*3600, seed=3)
+    conc, _, _ = run(inp, config, False)
+    gated_conc, _, activity = run(inp, config, True)
+    np.testing.assert_array_equal(gated_conc, conc)
+    for ID, info in config.items():
+        if info["method"] == "Phosphorus":
+            # Phosphorus leaves dry nodes unset, so it is not gated
+            assert (ID, "P1") not in activity
+        else:
+            assert activity[(ID, "P1")]["skipped"] > 0
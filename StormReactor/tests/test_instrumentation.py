@@ -0,0 +1,74 @@
+from StormReactor import waterQuality
+from StormReactor.waterQuality import ToolkitCounter
+from pyswmm import Simulation
+import pytest
+
+from StormReactor.tests.inps import model_twotanks_constantinflow_constanteffluent
+
+"""
+Instrumentation:
+Check stats() reports time and calls per method, toolkit get/set counts,
+CSTR solver evaluations and the slowest assets, for both engines, and
+that a summary is printed every report_every steps. Check that stacked
+toolkit counters count each call once and restore the model's methods.
+"""
+
+CONFIG = {'Tank1': {'type': 'node', 'treatments': [
+              {'pollutant': 'P1', 'method': 'CSTR', 'parameters': {'k': -0.01, 'n': 2.0, 'c0': 10.0}},
+              {'pollutant': 'P2', 'method': 'ConstantRemoval', 'parameters': {'R': 0.4}}]},
+          'Tank2': {'type': 'node', 'pollutant': 'P1', 'method': 'ConstantRemoval', 'parameters': {'R': 0.2}}}
+
+
+def run(vectorize, steps=20, **options):
+    with Simulation(model_twotanks_constantinflow_constanteffluent) as sim:
+        WQ = waterQuality(sim, CONFIG, vectorize=vectorize, instrument=True, **options)
+        for index, step in enumerate(sim):
+            WQ.updateWQState()
+            if index == steps-1:
+                break
+        return WQ.stats(slowest=2)
+
+
+@pytest.mark.parametrize("vectorize", [True, False])
+def test_stats(vectorize):
+    stats = run(vectorize)
+    assert stats["steps"] == 20
+    assert stats["time"] > 0.0
+    assert stats["methods"]["ConstantRemoval"]["assets"] == 40
+    assert stats["methods"]["CSTR"]["assets"] == 20
+    assert stats["methods"]["CSTR"]["calls"] == 20
+    # Every treatment sets one concentration per step
+    assert stats["toolkit"]["sets"] == 60
+    assert stats["toolkit"]["gets"] > 0
+    assert stats["solver"]["nfev"] > 0
+    assert stats["solver"]["njev"] >= 0
+    assert len(stats["slowest"]) == 2
+    assert stats["slowest"][0][2] >= stats["slowest"][1][2]
+
+
+def test_periodic_summary(capsys):
+    run(True, steps=10, report_every=5)
+    assert capsys.readouterr().out.count("StormReactor: ") == 2
+
+
+def test_stats_requires_instrumentation():
+    with Simulation(model_twotanks_constantinflow_constanteffluent) as sim:
+        WQ = waterQuality(sim, CONFIG)
+        assert WQ.stats() is None
+
+
+def test_stacked_toolkit_counters():
+    with Simulation(model_twotanks_constantinflow_constanteffluent) as sim:
+        setNodePollut = sim._model.setNodePollut
+        with ToolkitCounter(sim) as counter:
+            WQ = waterQuality(sim, CONFIG, instrument=True)
+            for index, step in enumerate(sim):
+                WQ.updateWQState()
+                if index == 9:
+                    break
+            # The profiler shares the counter's wrappers
+            assert counter.sets == WQ.stats()["toolkit"]["sets"] == 30
+            assert sim._model.setNodePollut.counters == [counter, WQ.profiler.toolkit]
+        WQ.profiler.toolkit.close()
+        assert "setNodePollut" not in vars(sim._model)
+        assert sim._model.setNodePollut == setNodePollut
@@ -0,0 +1,98 @@
+from StormReactor import waterQuality, jit, kernels
+from StormReactor.benchmark import benchmark_kernels, kernel_inputs
+from pyswmm import Simulation
+import numpy as np
+import pytest
+
+from StormReactor.tests.inps import model_constantinflow_constanteffluent
+
+"""
+Compiled kernels:
+Check that the loop kernels of StormReactor.jit (compiled, or plain Python
+without Numba) agree with the NumPy kernels on inputs that cover every
+branch, that the numba backend falls back to NumPy when Numba is not
+installed and otherwise matches the NumPy backend in a simulation, and
+that the kernel benchmark times every compiled method.
+"""
+
+CONFIG = {'Tank': {'type': 'node', 'pollutant': 'P1', 'method': 'GravitySettling',
+                   'parameters': {'k': 0.01, 'C_s': 10.0}},
+          'Valve': {'type': 'link', 'pollutant': 'P1', 'method': 'ConcDependRemoval',
+                    'parameters': {'R_l': 0.5, 'BC': 10.0, 'R_u': 0.75}}}
+CSTR_CONFIG = {'Tank': {'type': 'node', 'pollutant': 'P1', 'method': 'CSTR',
+                        'parameters': {'k': -0.01, 'n': 2.0, 'c0': 0.0}}}
+
+
+@pytest.mark.parametrize("method", ["ConcDependRemoval", "GravitySettling"])
+def test_loops_match_numpy(method):
+    _, args = kernel_inputs(method, 200)
+    # Zero depth and negative concentrations take the edge branches
+    args[0][:10] = -1.0
+    if method == "GravitySettling":
+        args[2][10:20] = 0.0
+    expected = kernels.BATCH_KERNELS[method].func(*args)
+    np.testing.assert_allclose(jit.JIT_KERNELS[method].func(*args), expected, rtol=1e-14)
+
+
+def test_phosphorus_loop_matches_numpy():
+    state, args = kernel_inputs("Phosphorus", 200)
+    args[1][:10] = 0.0
+    reference = kernels.AssetState(200)
+    for step in range(3):
+        expected, expected_wet = kernels.phosphorus_event(reference, *args)
+        Cnew, wet = jit.phosphorus_event(state, *args)
+    np.testing.assert_array_equal(wet, expected_wet)
+    np.testing.assert_allclose(Cnew[wet], expected[wet], rtol=1e-14)
+    np.testing.assert_array_equal(state.event_time, reference.event_time)
+
+
+@pytest.mark.parametrize("n", [1.0, 2.0])
+def test_cstr_loops_match_numpy(n):
+    rng = np.random.default_rng(1)
+    Cin, Qin, Qout, V = (rng.uniform(0.1, 20.0, 50) for _ in range(4))
+    k = np.full(50, -0.01)
+    parameters = {'k': k, 'n': np.full(50, n), 'c0': np.ones(50)}
+    states = [kernels.cstr_state(parameters, {}), jit.cstr_state(parameters, {})]
+    C = [kernels.cstr(state, Cin, Qin, Qout, V, 60.0, k, parameters['n']) for state in states]
+    # Tanks without an exact solution agree to within the solver tolerance
+    np.testing.assert_allclose(C[1], C[0], rtol=1e-12 if n == 1.0 else 1e-6)
+    assert states[1].rhs is jit.cstr_tank
+
+
+def test_backend_fallback(capsys):
+    if jit.NUMBA_AVAILABLE:
+        pytest.skip("Numba is installed")
+    with Simulation(model_constantinflow_constanteffluent) as sim:
+        WQ = waterQuality(sim, CONFIG, backend="numba")
+        assert WQ.backend == "numpy"
+        assert WQ.kernels is kernels.BATCH_KERNELS
+    assert "Numba is not installed" in capsys.readouterr().out
+
+
+def test_unknown_backend():
+    with Simulation(model_constantinflow_constanteffluent) as sim:
+        with pytest.raises(ValueError):
+            waterQuality(sim, CONFIG, backend="cuda")
+
+
+@pytest.mark.parametrize("config", [CONFIG, CSTR_CONFIG])
+def test_numba_backend_matches_numpy(config):
+    pytest.importorskip("numba")
+    concentrations = []
+    for backend in ("numpy", "numba"):
+        with Simulation(model_constantinflow_constanteffluent) as sim:
+            WQ = waterQuality(sim, config, backend=backend)
+            conc = []
+            for step in sim:
+                WQ.updateWQState()
+                conc.append((sim._model.getNodePollut('Tank', 0)[0], sim._model.getLinkPollut('Valve', 0)[0]))
+            concentrations.append(conc)
+    # CSTR tanks of order 2 agree to within the solver tolerance
+    np.testing.assert_allclose(concentrations[1], concentrations[0], rtol=1e-6)
+
+
+def test_benchmark_kernels():
+    records = benchmark_kernels(sizes=(10,), repeat=2, verbose=False)
+    assert [record["method"] for record in records] == list(jit.JIT_KERNELS)
+    assert all(record["loop_s"] > 0.0 and record["numpy_s"] > 0.0 for record in records)
+    assert all(np.isnan(record["numba_s"]) != jit.NUMBA_AVAILABLE for record in records)
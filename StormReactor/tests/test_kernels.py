@@ -0,0 +1,119 @@
+from StormReactor.kernels import (cstr_tank, cstr_jacobian, cstr_exact, cstr, CSTRState,
+                                  nth_order_reaction, gravity_settling,
+                                  ODE_INTEGRATORS, IVP_INTEGRATORS)
+import numpy as np
+from scipy.integrate import solve_ivp
+import pytest
+
+"""
+Kernel unit tests (no SWMM simulation):
+Check the closed-form CSTR update for zero- and first-order reactions
+against a tightly converged numerical solution of the CSTR ODE, over
+large and small steps, decay and growth, and near-zero outflow.
+
+Check the analytic CSTR Jacobian against finite differences, that every
+CSTR integrator agrees on a stiff second-order problem, and that
+near-empty tanks follow the inflow concentration.
+
+Check NthOrderReaction against the ODE solution over steps far beyond
+the explicit Euler stability limit, and that it and GravitySettling never
+go negative.
+"""
+
+
+@pytest.mark.parametrize("n", [0.0, 1.0])
+@pytest.mark.parametrize("dt", [1e-3, 1.0, 300.0])
+def test_CSTR_exact_matches_ODE(n, dt):
+    C = np.array([10.0, 0.0, 5.0, 2.0])
+    Qin = np.array([5.0, 1.0, 0.0, 2.0])
+    Cin = np.array([10.0, 4.0, 0.0, 8.0])
+    Qout = np.array([5.0, 0.5, 1.0, 0.0])
+    V = np.array([1000.0, 50.0, 10.0, 400.0])
+    k = np.array([-0.2, -0.001, 0.0, 1e-4])
+    n = np.full(4, n)
+    Cnew = cstr_exact(C, Qin, Cin, Qout, V, k, n, dt)
+    for i in range(len(C)):
+        ref = solve_ivp(cstr_tank, (0.0, dt), [C[i]], method="LSODA", rtol=1e-12, atol=1e-12,
+                        args=(Qin[i], Cin[i], Qout[i], V[i], k[i], n[i]))
+        assert Cnew[i] == pytest.approx(ref.y[0, -1], rel=1e-8, abs=1e-10)
+
+
+def test_CSTR_jacobian_matches_finite_difference():
+    C = np.array([10.0, 2.0, 0.5])
+    params = (np.array([5.0, 1.0, 0.0]), np.array([10.0, 4.0, 0.0]), np.array([5.0, 0.5, 1.0]),
+              np.array([1000.0, 0.01, 10.0]), np.array([-0.2, -0.001, 0.01]), np.array([2.0, 1.5, 3.0]))
+    h = 1e-6
+    fd = (cstr_tank(0.0, C+h, *params) - cstr_tank(0.0, C-h, *params))/(2*h)
+    np.testing.assert_allclose(cstr_jacobian(0.0, C, *params)[0], fd, rtol=1e-6)
+
+
+@pytest.mark.parametrize("integrator", list(ODE_INTEGRATORS) + list(IVP_INTEGRATORS))
+def test_CSTR_integrators_agree(integrator):
+    # The second tank is small, which makes the system stiff
+    Cin = np.array([10.0, 8.0])
+    Qin = np.array([5.0, 1.0])
+    Qout = np.array([4.0, 1.0])
+    V = np.array([1000.0, 0.05])
+    k = np.array([-0.02, -0.01])
+    n = np.array([2.0, 2.0])
+    state = CSTRState([10.0, 0.0], integrator=integrator)
+    for step in range(10):
+        C = cstr(state, Cin, Qin, Qout, V, 30.0, k, n)
+    ref = solve_ivp(cstr_tank, (0.0, 300.0), [10.0, 0.0], method="Radau", rtol=1e-12, atol=1e-12,
+                    args=(Qin, Cin, Qout, V, k, n))
+    np.testing.assert_allclose(C, ref.y[:, -1], rtol=1e-4)
+    assert state.t == 300.0
+
+
+def test_CSTR_near_empty_tank_follows_inflow():
+    state = CSTRState([10.0, 10.0], V_min=1e-3)
+    C = cstr(state, np.array([4.0, 4.0]), np.array([1.0, 1.0]), np.array([1.0, 1.0]),
+             np.array([1e-6, 100.0]), 1.0, np.array([-0.01, -0.01]), np.array([2.0, 2.0]))
+    assert C[0] == 4.0
+    assert 4.0 < C[1] < 10.0
+
+
+def test_CSTR_unknown_integrator():
+    with pytest.raises(ValueError):
+        CSTRState([1.0], integrator="euler")
+
+
+@pytest.mark.parametrize("n", [0.0, 0.5, 1.0, 1.5, 2.0, 3.0])
+@pytest.mark.parametrize("dt", [1.0, 300.0, 3600.0])
+def test_nth_order_matches_ODE(n, dt):
+    C = np.array([10.0, 0.5, 0.0, 100.0])
+    k = np.array([0.01, 0.2, 0.01, 0.001])
+    Cnew = nth_order_reaction(C, dt, 1.0, k, np.full(4, n))
+    assert np.all(Cnew >= 0.0)
+    for i in range(len(C)):
+        # The exact solution reaches zero in finite time for n < 1
+        event = lambda t, y: y[0]
+        event.terminal = True
+        ref = solve_ivp(lambda t, y: -k[i]*np.maximum(y, 0.0)**n, (0.0, dt), [C[i]], method="LSODA",
+                        rtol=1e-10, atol=1e-12, events=event if C[i] > 0 else None)
+        assert Cnew[i] == pytest.approx(max(ref.y[0, -1], 0.0), rel=1e-6, abs=1e-6)
+
+
+def test_nth_order_large_steps_stay_monotone():
+    # Explicit Euler would give 10 - 0.5*100*1000 for this step
+    C = np.array([10.0, 10.0, 10.0])
+    Cnew = nth_order_reaction(C, 1000.0, 1.0, np.full(3, 0.5), np.array([1.0, 2.0, 1.5]))
+    assert np.all((Cnew >= 0.0) & (Cnew < C))
+
+
+def test_nth_order_growth_past_blow_up():
+    # Second order growth from 10 with k = -0.01 blows up after 10 s
+    Cnew = nth_order_reaction(np.array([10.0]), 20.0, 1.0, np.array([-0.01]), np.array([2.0]))
+    assert Cnew[0] > 10.0
+
+
+def test_gravity_settling_dry_and_nonnegative():
+    # At zero depth a quiescent asset keeps its inflow concentration and a
+    # flowing one gets 2*Cin - C_s, as in the original method, clamped at zero
+    Cin = np.array([10.0, 10.0, 1.0, 3.0, 1.0])
+    Q = np.array([0.0, 1.0, 0.0, 0.0, 1.0])
+    d = np.array([0.0, 0.0, 1.0, 2.0, 0.0])
+    k = np.array([0.01, 0.01, 10.0, 1e6, 0.01])
+    C_s = np.array([2.0, 2.0, -5.0, 1.0, 5.0])
+    Cnew = gravity_settling(Cin, Q, d, 3600.0, k, C_s)
+    np.testing.assert_allclose(Cnew, [10.0, 18.0, 0.0, 1.0, 0.0], atol=1e-9)
@@ -0,0 +1,67 @@
+from StormReactor import waterQuality
+from pyswmm import Simulation
+import numpy as np
+import pytest
+
+from StormReactor.tests.inps import (model_constantinflow_constanteffluent,
+                                     model_twotanks_constantinflow_constanteffluent,
+                                     LinkTest_variableinflow)
+
+"""
+Mass balance:
+Check the running per-asset loads close (inflow = outflow + removed +
+change in storage) for treated nodes and dynamic wave links, that the
+constant inflow load and the removal of ConstantRemoval are accounted
+with dt, that both engines give the same totals, and that the totals can
+be read at any time during the run.
+"""
+
+
+def run(model, config, vectorize=True, steps=None):
+    with Simulation(model) as sim:
+        WQ = waterQuality(sim, config, vectorize=vectorize, mass_balance=True)
+        for index, step in enumerate(sim):
+            WQ.updateWQState()
+            if index+1 == steps:
+                break
+        return WQ.massBalance(), WQ.continuityError()
+
+
+@pytest.mark.parametrize("vectorize", [True, False])
+def test_mass_balance_node(vectorize):
+    config = {'Tank': {'type': 'node', 'pollutant': 'P1', 'method': 'ConstantRemoval', 'parameters': {'R': 0.5}}}
+    balance, error = run(model_constantinflow_constanteffluent, config, vectorize)
+    totals = balance[('Tank', 'P1')]
+    # 5 m^3/s at 10 mg/L for 1798 one-second steps
+    assert totals['inflow'] == pytest.approx(5*10*1798)
+    assert totals['removed'] == pytest.approx(totals['inflow']/2, rel=0.01)
+    assert abs(error) < 0.1
+
+
+def test_mass_balance_engines_agree():
+    config = {'Tank1': {'type': 'node', 'pollutant': 'P1', 'method': 'CSTR', 'parameters': {'k': -0.01, 'n': 2.0, 'c0': 0.0}},
+              'Tank2': {'type': 'node', 'pollutant': 'P1', 'method': 'GravitySettling', 'parameters': {'k': 0.01, 'C_s': 2.0}}}
+    batch, batch_error = run(model_twotanks_constantinflow_constanteffluent, config, True)
+    scalar, scalar_error = run(model_twotanks_constantinflow_constanteffluent, config, False)
+    for key in batch:
+        for name in batch[key]:
+            assert batch[key][name] == pytest.approx(scalar[key][name], rel=1e-5, abs=1e-8)
+    assert abs(batch_error) < 0.1
+
+
+def test_mass_balance_link():
+    config = {'Channel': {'type': 'link', 'pollutant': 'P1', 'method': 'NthOrderReaction', 'parameters': {'k': 0.001, 'n': 1.0}},
+              'Culvert': {'type': 'link', 'pollutant': 'P1', 'method': 'ConstantRemoval', 'parameters': {'R': 0.3}}}
+    balance, error = run(LinkTest_variableinflow, config)
+    assert balance[('Channel', 'P1')]['removed'] > 0.0
+    assert abs(error) < 1e-3
+
+
+def test_mass_balance_during_run():
+    config = {'Tank': {'type': 'node', 'pollutant': 'P1', 'method': 'EventMeanConc', 'parameters': {'C': 2.0}}}
+    balance, error = run(model_constantinflow_constanteffluent, config, steps=100)
+    # The first step has dt = 0
+    assert balance[('Tank', 'P1')]['inflow'] == pytest.approx(5*10*99)
+    # The tank is still filling, so the one-step discretization error is
+    # a larger share of the load than at the end of the run
+    assert abs(error) < 1.0
@@ -0,0 +1,50 @@
+from StormReactor import waterQuality
+from StormReactor.networks import generate_network
+from pyswmm import Simulation, Nodes, Links
+import numpy as np
+import json
+import pytest
+
+"""
+Synthetic networks:
+Check generated models run in SWMM with StormReactor for each topology,
+that conduits join the nodes as the topology says, that several
+pollutants and cycled methods appear in the emitted configuration, and
+that the configuration saved as JSON matches the returned one.
+"""
+
+
+@pytest.mark.parametrize("topology,outlets", [("tree", ["Outfall", "Tank0", "Tank0", "Tank1", "Tank1", "Tank2", "Tank2"]),
+                                              ("chain", ["Outfall", "Tank0", "Tank1", "Tank2", "Tank3", "Tank4", "Tank5"]),
+                                              ("star", ["Outfall"]*7)])
+def test_network_topology(tmp_path, topology, outlets):
+    inp = str(tmp_path / "network.inp")
+    config = generate_network(inp, 7, topology=topology, methods="EventMeanConc", duration=120)
+    with Simulation(inp) as sim:
+        assert [Links(sim)["Pipe{}".format(i)].outlet_node for i in range(7)] == outlets
+        WQ = waterQuality(sim, config)
+        for step in sim:
+            WQ.updateWQState()
+        assert [Nodes(sim)["Tank{}".format(i)].pollut_quality["P1"] for i in range(7)] == [5.0]*7
+
+
+def test_network_pollutants_and_methods(tmp_path):
+    inp = str(tmp_path / "network.inp")
+    config = generate_network(inp, 6, pollutants=3, methods=["EventMeanConc", "CSTR"], treat="both", duration=60)
+    with open(str(tmp_path / "network.json")) as f:
+        assert json.load(f) == config
+    assert len(config) == 12
+    assert [t["pollutant"] for t in config["Tank1"]["treatments"]] == ["P1", "P2", "P3"]
+    assert config["Tank1"]["treatments"][0]["method"] == "CSTR"
+    # CSTR can only treat nodes, so every conduit uses EventMeanConc
+    assert {config["Pipe{}".format(i)]["treatments"][0]["method"] for i in range(6)} == {"EventMeanConc"}
+    with Simulation(inp) as sim:
+        WQ = waterQuality(sim, config)
+        for step in sim:
+            WQ.updateWQState()
+        assert Nodes(sim)["Tank0"].pollut_quality["P2"] == 5.0
+
+
+def test_network_unknown_topology(tmp_path):
+    with pytest.raises(ValueError):
+        generate_network(str(tmp_path / "network.inp"), 3, topology="ring")
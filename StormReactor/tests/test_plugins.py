@@ -0,0 +1,105 @@
+from StormReactor import waterQuality, WaterQualityConfigError, register_method, unregister_method
+from pyswmm import Simulation
+import numpy as np
+import pytest
+
+from StormReactor.tests.inps import model_constantinflow_constanteffluent
+
+"""
+Registered water quality methods:
+Check that a registered array method gives the same results as the
+built-in method it reimplements with both engines, that stateful methods
+keep their state in waterQuality.states and are not gated, and that
+invalid registrations and configs are rejected.
+"""
+
+
+def first_order_decay(C, dt, k):
+    return C*np.exp(-k*dt)
+
+
+def first_flush(state, Cin, Qin, dt, R, T):
+    # Removes a fraction R of the inflow concentration during the first T
+    # seconds of every event
+    state.event_time = np.where(Qin > 0, state.event_time + dt, 0.0)
+    return Cin*np.where(state.event_time <= T, 1 - R, 1.0)
+
+
+@pytest.fixture
+def plugins():
+    register_method("FirstOrderDecay", first_order_decay, ("reactorQual", "dt"), ("k",))
+    register_method("FirstFlush", first_flush, ("inflowQual", "totalinflow", "dt"), ("R", "T"),
+                    state=True, node_only=True)
+    yield
+    unregister_method("FirstOrderDecay")
+    unregister_method("FirstFlush")
+
+
+def run(config, vectorize=True, steps=None):
+    with Simulation(model_constantinflow_constanteffluent) as sim:
+        WQ = waterQuality(sim, config, vectorize=vectorize)
+        conc = []
+        for index, step in enumerate(sim):
+            WQ.updateWQState()
+            conc.append((sim._model.getNodePollut('Tank', 0)[0], sim._model.getLinkPollut('Valve', 0)[0]))
+            if steps is not None and index+1 >= steps:
+                break
+        return np.array(conc), WQ
+
+
+@pytest.mark.parametrize("vectorize", [True, False])
+def test_plugin_matches_builtin(plugins, vectorize):
+    builtin = {'Tank': {'type': 'node', 'pollutant': 'P1', 'method': 'NthOrderReaction',
+                        'parameters': {'k': 0.01, 'n': 1.0}},
+               'Valve': {'type': 'link', 'pollutant': 'P1', 'method': 'NthOrderReaction',
+                         'parameters': {'k': 0.002, 'n': 1.0}}}
+    plugin = {'Tank': {'type': 'node', 'pollutant': 'P1', 'method': 'FirstOrderDecay', 'parameters': {'k': 0.01}},
+              'Valve': {'type': 'link', 'pollutant': 'P1', 'method': 'FirstOrderDecay', 'parameters': {'k': 0.002}}}
+    expected, _ = run(builtin)
+    conc, WQ = run(plugin, vectorize)
+    assert {group.method for group in WQ.groups} == {'FirstOrderDecay'}
+    np.testing.assert_allclose(conc, expected, rtol=1e-12)
+
+
+def test_stateful_plugin(plugins):
+    config = {'Tank': {'type': 'node', 'pollutant': 'P1', 'method': 'FirstFlush',
+                       'parameters': {'R': 0.5, 'T': 300}}}
+    conc, WQ = run(config, steps=600)
+    assert WQ.state_keys == [('Tank', 'P1', 'FirstFlush')]
+    assert WQ.states['event_time'][0] == pytest.approx(600.0)
+    # Removal stops after the first T seconds of the event
+    removal, _ = run({'Tank': dict(config['Tank'], parameters={'R': 0.5, 'T': 1e9})}, steps=600)
+    assert conc[-1, 0] > removal[-1, 0]
+
+
+def test_register_errors(plugins):
+    with pytest.raises(ValueError):
+        register_method("CSTR", first_order_decay, ("reactorQual", "dt"), ("k",))
+    with pytest.raises(ValueError):
+        register_method("FirstOrderDecay", first_order_decay, ("reactorQual", "dt"), ("k",))
+    with pytest.raises(ValueError):
+        register_method("Other", first_order_decay, ("concentration", "dt"), ("k",))
+    with pytest.raises(ValueError):
+        register_method("Other", first_order_decay, ("hyd_res_time", "dt"), ("k",))
+    with pytest.raises(KeyError):
+        unregister_method("CSTR")
+    register_method("FirstOrderDecay", first_order_decay, ("reactorQual", "depth"), ("k",), replace=True)
+
+
+def test_plugin_config_errors(plugins):
+    with pytest.raises(WaterQualityConfigError):
+        run({'Valve': {'type': 'link', 'pollutant': 'P1', 'method': 'FirstFlush', 'parameters': {'R': 0.5, 'T': 300}}})
+    with pytest.raises(WaterQualityConfigError):
+        run({'Tank': {'type': 'node', 'pollutant': 'P1', 'method': 'FirstFlush', 'parameters': {'R': 0.5}}})
+    unregister_method("FirstOrderDecay")
+    with pytest.raises(WaterQualityConfigError):
+        run({'Tank': {'type': 'node', 'pollutant': 'P1', 'method': 'FirstOrderDecay', 'parameters': {'k': 0.01}}})
+    register_method("FirstOrderDecay", first_order_decay, ("reactorQual", "dt"), ("k",))
+
+
+def test_stateful_plugin_not_gated(plugins):
+    config = {'Tank': {'type': 'node', 'pollutant': 'P1', 'method': 'FirstFlush',
+                       'parameters': {'R': 0.5, 'T': 300}}}
+    with Simulation(model_constantinflow_constanteffluent) as sim:
+        WQ = waterQuality(sim, config, gating=True)
+        assert WQ.groups[0].gate is None
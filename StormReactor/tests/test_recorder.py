@@ -0,0 +1,81 @@
+from StormReactor import waterQuality
+from StormReactor.recorder import Recorder, load
+from pyswmm import Simulation, Nodes, Links
+import numpy as np
+import os
+import pytest
+
+from StormReactor.tests.inps import model_twotanks_constantinflow_constanteffluent
+
+"""
+Recorder:
+Check the recorder samples the same concentrations and flows as the
+pyswmm Node/Link objects at every step, in memory and when spilled to
+.npy and .npz files in blocks smaller than the run, that .npy recordings
+load memory-mapped, that in-memory recordings over max_memory spill to
+a memory-mapped temporary file, and that samples can be thinned with
+every.
+"""
+
+CONFIG = {'Tank1': {'type': 'node', 'pollutant': 'P1', 'method': 'GravitySettling', 'parameters': {'k': 0.01, 'C_s': 2.0}},
+          'Link1': {'type': 'link', 'pollutant': 'P1', 'method': 'ConstantRemoval', 'parameters': {'R': 0.3}}}
+CHANNELS = [('Tank1', 'concentration', 'P1'), ('Tank2', 'concentration', 'P2'),
+            ('Tank1', 'flow'), ('Tank2', 'depth'), ('Link1', 'flow'), ('Link1', 'concentration', 'P1')]
+
+
+def run(path=None, every=1, max_memory=2**28):
+    expected = []
+    with Simulation(model_twotanks_constantinflow_constanteffluent) as sim:
+        WQ = waterQuality(sim, CONFIG)
+        recorder = Recorder(WQ, CHANNELS, block_size=64, path=path, every=every,
+                            max_memory=max_memory)
+        tank1, tank2, link1 = Nodes(sim)['Tank1'], Nodes(sim)['Tank2'], Links(sim)['Link1']
+        for step in sim:
+            WQ.updateWQState()
+            expected.append([tank1.pollut_quality['P1'], tank2.pollut_quality['P2'], tank1.total_inflow,
+                             tank2.depth, link1.flow, link1.pollut_quality['P1']])
+        recorder.close()
+        assert WQ.recorders == []
+        return recorder, np.array(expected)
+
+
+@pytest.mark.parametrize("suffix", [None, ".npy", ".npz"])
+def test_recorder_matches_pyswmm(tmp_path, suffix):
+    path = None if suffix is None else str(tmp_path / ("run" + suffix))
+    recorder, expected = run(path)
+    results = recorder.recording() if path is None else load(path)
+    assert results.columns[0] == "time"
+    assert len(results) == len(expected)
+    np.testing.assert_array_equal(results.data[:, 1:], expected)
+    np.testing.assert_array_equal(results.column('Tank2', 'depth'), expected[:, 3])
+    assert np.all(np.diff(results.times) > 0)
+    if suffix == ".npy":
+        assert isinstance(results.data, np.memmap)
+
+
+def test_recorder_max_memory():
+    # Two 64-sample blocks of 7 columns fit, the third one spills
+    recorder, expected = run(max_memory=2*64*7*8)
+    results = recorder.recording()
+    assert recorder.blocks == []
+    assert isinstance(results.data, np.memmap)
+    np.testing.assert_array_equal(results.data[:, 1:], expected)
+    spill = recorder.spill.name
+    del recorder, results
+    assert not os.path.exists(spill)
+
+
+def test_recorder_every(tmp_path):
+    recorder, expected = run(str(tmp_path / "run.npy"), every=10)
+    results = load(str(tmp_path / "run.npy"))
+    np.testing.assert_array_equal(results.data[:, 1:], expected[::10])
+
+
+def test_recorder_default_channels():
+    with Simulation(model_twotanks_constantinflow_constanteffluent) as sim:
+        WQ = waterQuality(sim, CONFIG)
+        recorder = Recorder(WQ)
+        assert recorder.columns == ["time", "Tank1:concentration:P1", "Link1:concentration:P1",
+                                    "Tank1:flow", "Link1:flow"]
+        with pytest.raises(ValueError):
+            Recorder(WQ, [('Tank1', 'temperature')])
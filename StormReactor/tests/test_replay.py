@@ -0,0 +1,111 @@
+from StormReactor import register_method, unregister_method
+from StormReactor.replay import record_hydraulics, replay, sweep, HydraulicRecording, replayable_methods
+import numpy as np
+import pytest
+
+from StormReactor.tests.inps import model_twotanks_constantinflow_constanteffluent
+
+"""
+Hydraulic replay:
+Record the hydraulics of both tanks once, then replay each replayable
+method with other parameters and check the result matches a real SWMM
+run with those parameters. SWMM applies a concentration set during a
+step in its next routing step, so the concentration SWMM reports lags
+the replayed one by one step. Methods added with register_method are
+replayable once registered.
+"""
+
+RECORD_CONFIG = {ID: {'type': 'node', 'pollutant': 'P1', 'method': 'ConstantRemoval', 'parameters': {'R': 0.0}}
+                 for ID in ('Tank1', 'Tank2')}
+
+REPLAY_PARAMETERS = {
+    'EventMeanConc': {'C': 5.0},
+    'ConstantRemoval': {'R': 0.5},
+    'CoRemoval': {'R1': 0.75, 'R2': 0.15},
+    'ConcDependRemoval': {'R_l': 0.50, 'BC': 5.0, 'R_u': 0.75},
+    'kCModel': {'k': 0.01, 'C_s': 2.0},
+    'GravitySettling': {'k': 0.05, 'C_s': 2.0},
+    'Phosphorus': {'B1': 0.0000333, 'Ceq0': 0.0081, 'k': 0.00320, 'L': 0.91, 'A': 100, 'E': 0.44},
+    'CSTR': {'k': -0.01, 'n': 2.0, 'c0': 3.0},
+    }
+
+
+@pytest.fixture(scope="module")
+def recording():
+    return record_hydraulics(model_twotanks_constantinflow_constanteffluent, RECORD_CONFIG)
+
+
+@pytest.mark.parametrize("method", sorted(REPLAY_PARAMETERS))
+def test_replay_matches_swmm(recording, method):
+    # Tank2 is downstream of Tank1, so only Tank1 changes its inflow quality
+    config = {'Tank1': {'type': 'node', 'pollutant': 'P1', 'method': method, 'parameters': REPLAY_PARAMETERS[method]}}
+    replayed = replay(recording, config)[('Tank1', 'P1')]
+    swmm = record_hydraulics(model_twotanks_constantinflow_constanteffluent, dict(RECORD_CONFIG, **config))
+    np.testing.assert_allclose(replayed[:-1], swmm.quality[1:, 0], rtol=1e-6, atol=1e-10)
+
+
+def first_flush(state, Cin, Qin, dt, R, T):
+    state.event_time = np.where(Qin > 0, state.event_time + dt, 0.0)
+    return Cin*np.where(state.event_time <= T, 1 - R, 1.0)
+
+
+def test_replay_registered_method(recording):
+    register_method("FirstFlush", first_flush, ("inflowQual", "totalinflow", "dt"), ("R", "T"),
+                    state=True, node_only=True)
+    try:
+        assert "FirstFlush" in replayable_methods()
+        config = {'Tank1': {'type': 'node', 'pollutant': 'P1', 'method': 'FirstFlush',
+                            'parameters': {'R': 0.5, 'T': 600.0}}}
+        replayed = replay(recording, config)[('Tank1', 'P1')]
+        swmm = record_hydraulics(model_twotanks_constantinflow_constanteffluent, dict(RECORD_CONFIG, **config))
+    finally:
+        unregister_method("FirstFlush")
+    assert "FirstFlush" not in replayable_methods()
+    np.testing.assert_allclose(replayed[:-1], swmm.quality[1:, 0], rtol=1e-6, atol=1e-10)
+
+
+def test_replay_save_load(recording, tmp_path):
+    recording.save(str(tmp_path / "hydraulics.npz"))
+    loaded = HydraulicRecording.load(str(tmp_path / "hydraulics.npz"))
+    assert loaded.keys == recording.keys
+    config = {'Tank2': {'type': 'node', 'pollutant': 'P1', 'method': 'GravitySettling', 'parameters': {'k': 0.05, 'C_s': 2.0}}}
+    np.testing.assert_array_equal(replay(loaded, config)[('Tank2', 'P1')], replay(recording, config)[('Tank2', 'P1')])
+
+
+def test_replay_rejects_unreplayable(recording):
+    assert 'NthOrderReaction' not in replayable_methods()
+    with pytest.raises(ValueError):
+        replay(recording, {'Tank1': {'type': 'node', 'pollutant': 'P1', 'method': 'NthOrderReaction', 'parameters': {'k': 0.1, 'n': 1.0}}})
+    with pytest.raises(ValueError):
+        replay(recording, {'Tank1': {'type': 'node', 'pollutant': 'P2', 'method': 'ConstantRemoval', 'parameters': {'R': 0.1}}})
+
+
+# Parameter sweeps: every parameter set of the sweep must match a replay
+# of that set alone
+@pytest.mark.parametrize("method,parameters", [
+    ('GravitySettling', {'k': np.array([0.01, 0.05, 0.2])[:, None], 'C_s': np.array([0.5, 2.0])[None, :]}),
+    ('CSTR', {'k': np.array([-0.1, -0.01, -0.001]), 'n': np.array([1.0, 2.0, 2.0]), 'c0': 0.0}),
+    ('Phosphorus', dict(REPLAY_PARAMETERS['Phosphorus'], k=np.array([0.001, 0.0032, 0.01]))),
+    ])
+def test_sweep_matches_replay(recording, method, parameters):
+    reference = recording.quality[:, 0]
+    result = sweep(recording, 'Tank1', 'P1', method, parameters, reference=reference)
+    shape = np.broadcast(*[np.asarray(v) for v in parameters.values()]).shape
+    assert result.rmse.shape == shape
+    for index in np.ndindex(shape):
+        single = {name: float(grid[index]) for name, grid in result.parameters.items()}
+        config = {'Tank1': {'type': 'node', 'pollutant': 'P1', 'method': method, 'parameters': single}}
+        C = replay(recording, config)[('Tank1', 'P1')]
+        assert result.peak[index] == pytest.approx(C.max(), rel=1e-5)
+        assert result.rmse[index] == pytest.approx(np.sqrt(np.mean((C - reference)**2)), rel=1e-5, abs=1e-9)
+        assert result.outflow_load[index] == pytest.approx(np.sum(recording.inputs['outflow'][:, 0]*C*recording.dt), rel=1e-5)
+
+
+def test_sweep_best(recording):
+    # The recorded run used ConstantRemoval with R = 0, so R = 0 fits best
+    result = sweep(recording, 'Tank1', 'P1', 'ConstantRemoval', {'R': np.linspace(0.0, 0.9, 10)},
+                   reference=np.r_[recording.quality[1:, 0], np.nan])
+    assert result.best() == {'R': 0.0}
+    assert result.best('load_reduction') == {'R': 0.9}
+    # Tank1 fills during the run, so part of the load is stored even for R = 0
+    assert np.all(np.diff(result.load_reduction) > 0)
@@ -0,0 +1,73 @@
+from StormReactor import waterQuality
+from StormReactor.scenarios import Scenario, ScenarioPool
+from pyswmm import Simulation
+import pytest
+
+from StormReactor.tests.inps import model_constantinflow_constanteffluent
+
+"""
+Scenario forking:
+Check that a scenario forked without changes reproduces the loads of the
+main simulation over the horizon, that settings, control functions and
+parameter overrides change the outcome, that the main simulation
+continues exactly as it would without forking, and that unknown links
+are rejected before forking.
+"""
+
+CONFIG = {'Tank': {'type': 'node', 'pollutant': 'P1', 'method': 'CSTR',
+                   'parameters': {'k': -0.01, 'n': 2.0, 'c0': 0.0}}}
+FORK = 599
+HORIZON = 300
+
+
+def close_valve(sim, WQ):
+    sim._model.setLinkSetting('Valve', 0.0)
+
+
+def run(pool=None, scenarios=()):
+    with Simulation(model_constantinflow_constanteffluent) as sim:
+        WQ = waterQuality(sim, CONFIG, mass_balance=True)
+        concentrations = []
+        outcomes = None
+        for index, step in enumerate(sim):
+            WQ.updateWQState()
+            concentrations.append(sim._model.getNodePollut('Tank', 0)[0])
+            if index == FORK:
+                at_fork = WQ.massBalance()[('Tank', 'P1')]
+                if pool is not None:
+                    outcomes = pool.fork(WQ, scenarios, HORIZON)
+            if index == FORK + HORIZON:
+                at_horizon = WQ.massBalance()[('Tank', 'P1')]
+        return concentrations, at_fork, at_horizon, outcomes
+
+
+def test_fork_scenarios():
+    scenarios = [Scenario('as is'),
+                 Scenario('close valve', settings={'Valve': 0.0}),
+                 Scenario('close valve rule', control=close_valve),
+                 Scenario('faster decay', overrides={'Tank': {'k': -0.05}})]
+    unforked, at_fork, at_horizon, _ = run()
+    with ScenarioPool(model_constantinflow_constanteffluent, CONFIG, workers=2) as pool:
+        concentrations, _, _, outcomes = run(pool, scenarios)
+        # The main simulation is not disturbed by forking
+        assert concentrations == unforked
+    assert [outcome.scenario.name for outcome in outcomes] == [s.name for s in scenarios]
+    assert all(outcome.error is None for outcome in outcomes)
+    results = [outcome.result[('Tank', 'P1')] for outcome in outcomes]
+    # Without changes the scenario repeats the main run over the horizon
+    assert results[0]['outflow'] == pytest.approx(at_horizon['outflow'] - at_fork['outflow'], rel=1e-3)
+    assert results[1]['outflow'] < results[0]['outflow']
+    assert results[2]['outflow'] == pytest.approx(results[1]['outflow'], rel=1e-6)
+    assert results[3]['outflow'] < results[0]['outflow']
+
+
+def test_fork_unknown_link(tmp_path):
+    with ScenarioPool(model_constantinflow_constanteffluent, CONFIG, workers=1, workdir=str(tmp_path)) as pool:
+        with Simulation(model_constantinflow_constanteffluent) as sim:
+            WQ = waterQuality(sim, CONFIG)
+            for step in sim:
+                WQ.updateWQState()
+                break
+            with pytest.raises(ValueError):
+                pool.fork(WQ, [Scenario('missing', settings={'Gate': 0.0})], HORIZON)
+    assert not list(tmp_path.glob('fork_*'))
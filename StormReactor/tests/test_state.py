@@ -0,0 +1,83 @@
+from StormReactor import waterQuality
+from StormReactor.kernels import AssetState, CSTRState, phosphorus, phosphorus_event, state_array
+from pyswmm import Simulation
+import numpy as np
+import pytest
+
+from StormReactor.tests.inps import model_constantinflow_constanteffluent
+
+"""
+Per-asset state store:
+Check that the Phosphorus event clock builds up over wet steps and is
+reset when an asset is dry, in the kernel and in both engines, that the
+group states are views of waterQuality.states, and that a copy of
+waterQuality.states is a snapshot of every asset's state.
+"""
+
+PHOSPHORUS = {'B1': 0.0000333, 'Ceq0': 0.0081, 'k': 0.00320, 'L': 0.91, 'A': 100, 'E': 0.44}
+CONFIG = {'Tank': {'type': 'node', 'pollutant': 'P1', 'method': 'Phosphorus', 'parameters': PHOSPHORUS},
+          'Valve': {'type': 'link', 'pollutant': 'P1', 'method': 'ConstantRemoval', 'parameters': {'R': 0.5}}}
+CSTR_CONFIG = {'Tank': {'type': 'node', 'pollutant': 'P1', 'method': 'CSTR',
+                        'parameters': {'k': -0.01, 'n': 2.0, 'c0': 0.0}}}
+
+
+def test_phosphorus_event_clock():
+    state = AssetState(3)
+    Cin = np.array([1.0, 1.0, 1.0])
+    parameters = [np.full(3, PHOSPHORUS[p]) for p in ('B1', 'Ceq0', 'k', 'L', 'A', 'E')]
+    for Qin in ([1.0, 1.0, 0.0], [1.0, 0.0, 0.0], [1.0, 1.0, 1.0]):
+        Cnew, wet = phosphorus_event(state, Cin, np.array(Qin), 60.0, *parameters)
+    np.testing.assert_array_equal(state.event_time, [180.0, 60.0, 60.0])
+    expected, _ = phosphorus(Cin, np.ones(3), state.event_time, *parameters)
+    np.testing.assert_array_equal(Cnew, expected)
+
+
+@pytest.mark.parametrize("vectorize", [True, False])
+def test_phosphorus_clock_builds_up(vectorize):
+    with Simulation(model_constantinflow_constanteffluent) as sim:
+        WQ = waterQuality(sim, CONFIG, vectorize=vectorize)
+        # Only the Phosphorus asset has a state record
+        assert len(WQ.states) == 1
+        wet = 0.0
+        for index, step in enumerate(sim):
+            WQ.updateWQState()
+            wet = wet + WQ.dt if sim._model.getNodeResult('Tank', 0) >= 0.01 else 0.0
+            if index == 600:
+                break
+        time = (sim.current_time - WQ.start_time).total_seconds()
+        assert WQ.states['event_time'][0] == pytest.approx(wet)
+        assert WQ.states['event_time'][0] > 500.0
+        assert WQ.states['last_update'][0] == time
+
+
+def test_engines_agree():
+    concentrations = []
+    for vectorize in (True, False):
+        with Simulation(model_constantinflow_constanteffluent) as sim:
+            WQ = waterQuality(sim, CONFIG, vectorize=vectorize)
+            conc = []
+            for step in sim:
+                WQ.updateWQState()
+                conc.append(sim._model.getNodePollut('Tank', 0)[0])
+            concentrations.append(conc)
+    np.testing.assert_allclose(concentrations[0], concentrations[1], rtol=1e-12)
+
+
+@pytest.mark.parametrize("vectorize", [True, False])
+def test_state_snapshot(vectorize):
+    with Simulation(model_constantinflow_constanteffluent) as sim:
+        WQ = waterQuality(sim, CSTR_CONFIG, vectorize=vectorize)
+        for index, step in enumerate(sim):
+            WQ.updateWQState()
+            if index == 300:
+                snapshot = WQ.states.copy()
+            if index == 600:
+                break
+        state = WQ.groups[0].state if vectorize else WQ.CSTR_state[('Tank', 'P1')]
+        assert isinstance(state, CSTRState)
+        # The state is kept in waterQuality.states
+        assert WQ.states['C'][0] == state.C[0]
+        assert np.shares_memory(state.records, WQ.states)
+        assert snapshot.dtype == state_array(0).dtype
+        assert snapshot['last_update'][0] < WQ.states['last_update'][0]
+        assert snapshot['C'][0] != WQ.states['C'][0]
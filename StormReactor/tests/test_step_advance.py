@@ -0,0 +1,86 @@
+from StormReactor import waterQuality
+from StormReactor.kernels import nth_order_reaction
+from pyswmm import Simulation
+import numpy as np
+import pytest
+
+from StormReactor.tests.inps import model_constantinflow_constanteffluent
+
+"""
+sim.step_advance:
+Check that both update methods run when SWMM advances several routing
+steps per call, that the concentrations SWMM reports and the CSTR
+reactor concentration match a run updated every routing step, that one
+long NthOrderReaction step equals many routing steps, and that both
+engines agree.
+"""
+
+CSTR_CONFIG = {'Tank': {'type': 'node', 'pollutant': 'P1', 'method': 'CSTR',
+                        'parameters': {'k': -0.01, 'n': 2.0, 'c0': 0.0}}}
+
+
+def run(config, advance=None, vectorize=True, cstr=False):
+    with Simulation(model_constantinflow_constanteffluent) as sim:
+        WQ = waterQuality(sim, config, vectorize=vectorize)
+        if advance:
+            sim.step_advance(advance)
+        states = {}
+        for index, step in enumerate(sim):
+            if cstr:
+                WQ.updateWQState_CSTR(index)
+            else:
+                WQ.updateWQState()
+            # dt, the concentration in SWMM and the reactor concentration
+            # of CSTR (kept by StormReactor)
+            time = (sim.current_time - WQ.start_time).total_seconds()
+            C = WQ.states['C'][0] if len(WQ.states) else None
+            states[time] = (WQ.dt, sim._model.getNodePollut('Tank', 0)[0], C)
+        return states
+
+
+@pytest.mark.parametrize("cstr", [False, True])
+def test_step_advance_CSTR(cstr):
+    every_step = run(CSTR_CONFIG, cstr=cstr)
+    advanced = run(CSTR_CONFIG, advance=60, cstr=cstr)
+    assert len(advanced) == 29
+    # The first call covers the whole first interval, later calls follow
+    # the routing steps run in between
+    assert [dt for dt, _, _ in advanced.values()][:2] == [60.0, 1.0]
+    for time in (600, 1200, 1740):
+        assert advanced[time][1] == pytest.approx(every_step[time][1], rel=1e-9)
+        assert advanced[time][2] == pytest.approx(every_step[time][2], rel=1e-9)
+
+
+@pytest.mark.parametrize("vectorize", [True, False])
+@pytest.mark.parametrize("method, parameters", [("ConstantRemoval", {'R': 0.5}),
+                                                ("kCModel", {'k': 0.01, 'C_s': 2.0})])
+def test_step_advance_matches_every_step(method, parameters, vectorize):
+    config = {'Tank': {'type': 'node', 'pollutant': 'P1', 'method': method, 'parameters': parameters}}
+    every_step = run(config, vectorize=vectorize)
+    advanced = run(config, advance=60, vectorize=vectorize)
+    untreated = run({}, advance=60)
+    # Treatment starts with the first call, at the end of the first interval
+    for time in list(advanced)[1:]:
+        assert advanced[time][1] == pytest.approx(every_step[time][1], rel=1e-12)
+    assert advanced[600][1] < untreated[600][1]
+
+
+def test_nth_order_long_steps():
+    # One 60 s step gives the same result as 60 one-second steps
+    C = np.array([10.0, 2.0, 4.0])
+    k = np.array([0.01, 0.05, 0.002])
+    n = np.array([1.0, 2.0, 1.5])
+    stepped = C.copy()
+    for _ in range(60):
+        stepped = nth_order_reaction(stepped, 1.0, 1.0, k, n)
+    np.testing.assert_allclose(nth_order_reaction(C, 60.0, 1.0, k, n), stepped, rtol=1e-12)
+
+
+def test_step_advance_engines_agree():
+    config = {'Tank': {'type': 'node', 'pollutant': 'P1', 'method': 'NthOrderReaction',
+                       'parameters': {'k': 0.01, 'n': 1.0}}}
+    batch = run(config, advance=60)
+    per_asset = run(config, advance=60, vectorize=False)
+    assert batch.keys() == per_asset.keys()
+    for time in batch:
+        assert batch[time][1] == pytest.approx(per_asset[time][1], rel=1e-12)
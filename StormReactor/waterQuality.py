@@ -1,23 +1,661 @@
 from pyswmm import Simulation, Nodes, Links
 import pyswmm.toolkitapi as tka
 import numpy as np
-from scipy.integrate import ode
+import os
+from datetime import timedelta
 from enum import Enum
+from collections import namedtuple
+from time import perf_counter
+from StormReactor.jit import JIT_KERNELS, NUMBA_AVAILABLE
+from StormReactor.kernels import (BATCH_KERNELS, CSTR_OPTIONS, CSTRState, Kernel, asset_state, cstr,
+                                  nth_order_reaction, state_array, ODE_INTEGRATORS, IVP_INTEGRATORS)
 
 # List of Exception Classes
 class PySWMMStepAdvanceNotSupported(Exception):
     """
-    Exception raised for impossible network trace.
+    Exception raised when sim.step_advance() was not supported. It is no
+    longer raised and is kept so existing imports keep working.
     """
     def __init__(self):
         self.message = "PySWMM sim.step_advance() feature is currently unsuppprted."
         super().__init__(self.message)
 
 
+class WaterQualityConfigError(Exception):
+    """
+    Exception raised when the water quality configuration dictionary
+    cannot be compiled into an execution plan.
+    """
+    def __init__(self, asset_ID, reason):
+        self.message = "Invalid water quality configuration for '{}': {}".format(asset_ID, reason)
+        super().__init__(self.message)
+
+
+class WaterQualityStateError(Exception):
+    """
+    Raised when a saved water quality state cannot be loaded.
+    """
+
+    def __init__(self, path, reason):
+        self.message = "Cannot load water quality state '{}': {}".format(path, reason)
+        super().__init__(self.message)
+
+
 class ElementType(Enum):
     Nodes = 0
     Links = 1
 
+
+# Parameters each water quality method requires in its config entry
+REQUIRED_PARAMETERS = {
+    "EventMeanConc": ("C",),
+    "ConstantRemoval": ("R",),
+    "CoRemoval": ("R1", "R2"),
+    "ConcDependRemoval": ("R_l", "BC", "R_u"),
+    "NthOrderReaction": ("k", "n"),
+    "kCModel": ("k", "C_s"),
+    "GravitySettling": ("k", "C_s"),
+    "CSTR": ("k", "n", "c0"),
+    "Phosphorus": ("B1", "Ceq0", "k", "L", "A", "E"),
+    }
+
+# Methods that can only be simulated in nodes
+NODE_ONLY_METHODS = ("kCModel", "CSTR", "Phosphorus")
+
+# Methods that take the simulation step index as their first argument
+STEP_INDEXED_METHODS = ("CSTR", "Phosphorus")
+
+# Toolkit quantities that batch kernel inputs are read from, as
+# (node quantity, link quantity). Links have no inflow quality, so the
+# link reactor quality is used, as in the per-asset methods. "quality" is
+# the concentration reported by SWMM (and read by recorders).
+POLLUTANT_INPUTS = {
+    "inflowQual": (tka.NodePollut.inflowQual.value, tka.LinkPollut.reactorQual.value),
+    "reactorQual": (tka.NodePollut.reactorQual.value, tka.LinkPollut.reactorQual.value),
+    "quality": (tka.NodePollut.nodeQual.value, tka.LinkPollut.linkQual.value),
+    }
+RESULT_INPUTS = {
+    "totalinflow": (tka.NodeResults.totalinflow.value, tka.LinkResults.newFlow.value),
+    "outflow": (tka.NodeResults.outflow.value, tka.LinkResults.newFlow.value),
+    "newDepth": (tka.NodeResults.newDepth.value, tka.LinkResults.newDepth.value),
+    "newVolume": (tka.NodeResults.newVolume.value, tka.LinkResults.newVolume.value),
+    "hyd_res_time": (tka.NodeResults.hyd_res_time.value, None),
+    "overflow": (tka.NodeResults.overflow.value, None),
+    }
+
+# Hydraulic states that must all be zero for an asset to sleep when
+# activity gating is on
+GATE_INPUTS = ("totalinflow", "newDepth", "newVolume")
+
+# Water quality methods added with register_method, as {name: node_only}
+PLUGINS = {}
+
+# Input names register_method accepts besides the kernel input names
+INPUT_ALIASES = {"depth": "newDepth", "volume": "newVolume"}
+
+
+def register_method(name, func, inputs, parameters, state=False, node_only=False, options=None, replace=False):
+    """
+    Registers a water quality method that works on whole arrays, so configs
+    can use it by name like the built-in methods. Every step, waterQuality
+    gathers the inputs of all assets that use the method, calls func once
+    for all of them and sets the new concentrations in SWMM (with
+    vectorize=True or False).
+
+    name       = method name used in configs
+    func       = function of the input arrays, followed by the parameter
+                 arrays (one entry per asset), that returns the new
+                 concentrations, or (Cnew, mask) to only set the assets
+                 where mask is True
+    inputs     = names of the inputs func reads, in order: "inflowQual",
+                 "reactorQual", "totalinflow", "outflow", "depth",
+                 "volume", "hyd_res_time", "overflow", "dt" (model dt) or
+                 "routing_step" (all in seconds)
+    parameters = names of the parameters func takes, in order; all of them
+                 are required in the config
+    state      = True to pass func an AssetState (reactor concentration,
+                 event time and last update time of every asset, kept in
+                 waterQuality.states) as its first argument, or a function
+                 (parameters, options, records) that creates the state.
+                 Stateful methods are never gated (see gating in
+                 waterQuality), since their state must advance every step.
+    node_only  = the method only works for nodes
+    options    = non-numeric config options {name: default}; assets are
+                 only batched together when their options are equal
+    replace    = replace a method registered before under the same name
+    """
+
+    if name not in PLUGINS and (name in BATCH_KERNELS or name in REQUIRED_PARAMETERS):
+        raise ValueError("'{}' is a built-in water quality method".format(name))
+    if name in PLUGINS and not replace:
+        raise ValueError("'{}' is already registered; pass replace=True to replace it".format(name))
+    if not callable(func):
+        raise ValueError("func of '{}' must be callable".format(name))
+    inputs = tuple(INPUT_ALIASES.get(i, i) for i in inputs)
+    unknown = [i for i in inputs if i not in POLLUTANT_INPUTS and i not in RESULT_INPUTS
+               and i not in ("dt", "routing_step")]
+    if unknown:
+        raise ValueError("'{}' reads unknown inputs {}".format(name, ", ".join(map(repr, unknown))))
+    if not node_only and any(RESULT_INPUTS.get(i, (None, True))[1] is None for i in inputs):
+        raise ValueError("'{}' reads node-only inputs, so it must be registered with node_only=True".format(name))
+    if state is True:
+        state = asset_state
+    BATCH_KERNELS[name] = Kernel(func, inputs, tuple(parameters), state or None, dict(options or {}))
+    REQUIRED_PARAMETERS[name] = tuple(parameters)
+    PLUGINS[name] = node_only
+
+
+def unregister_method(name):
+    """
+    Removes a water quality method added with register_method.
+    """
+
+    if name not in PLUGINS:
+        raise KeyError("'{}' is not a registered water quality method".format(name))
+    del BATCH_KERNELS[name], REQUIRED_PARAMETERS[name], PLUGINS[name]
+
+
+# Compiled config entry for one asset and pollutant
+Treatment = namedtuple("Treatment", ["ID", "pollutant", "pollutant_index", "method",
+                                     "parameters", "element_type", "func", "step_indexed",
+                                     "update_interval"], defaults=(None,))
+
+
+def _isNumber(value):
+    try:
+        float(value)
+    except (TypeError, ValueError):
+        return False
+    return True
+
+
+class TreatmentGroup:
+    """
+    All assets of one element type that share a water quality method with
+    a batch kernel and the same kernel options. Parameters are stored as
+    arrays with one entry per asset so the kernel is evaluated for the
+    whole group in one call. Stateful kernels keep their per-asset state
+    in self.state, in self.records when waterQuality allocated them.
+    """
+
+    def __init__(self, method, element_type, kernel, options, treatments, interval=None):
+        self.method = method
+        self.element_type = element_type
+        self.kernel = kernel
+        self.options = options
+        self.IDs = [t.ID for t in treatments]
+        self.pollutants = [t.pollutant for t in treatments]
+        self.pollutant_index = np.array([t.pollutant_index for t in treatments], dtype=int)
+        # Only the numeric parameters of the method are stored; other
+        # config keys are left to the per-asset methods
+        names = dict.fromkeys(tuple(kernel.parameters) + REQUIRED_PARAMETERS.get(method, ()))
+        self.parameters = {}
+        for p in names:
+            values = [t.parameters[p] for t in treatments]
+            try:
+                self.parameters[p] = np.array(values, dtype=float)
+            except (TypeError, ValueError):
+                bad = [t.ID for t, value in zip(treatments, values) if not _isNumber(value)]
+                raise ValueError("{} parameter {!r} must be a number, got a non-numeric value for {}".format(
+                    method, p, ", ".join(map(repr, bad)))) from None
+        self.state = None
+        self.records = None
+        # Activity gating (see waterQuality._wakeGroup): the hydraulic
+        # sources it reads, which assets are awake, the last concentration
+        # set and the steps each asset was evaluated or skipped
+        self.gate = None
+        self.awake = np.ones(len(self.IDs), dtype=bool)
+        self.last = np.full(len(self.IDs), np.nan)
+        self.evaluated = np.zeros(len(self.IDs), dtype=int)
+        self.skipped = np.zeros(len(self.IDs), dtype=int)
+        # Update decimation (see waterQuality._runGroup): the update
+        # interval (seconds), the time and dt of the last update, the
+        # updates and held steps, and the largest change of each asset's
+        # concentration at an update
+        self.interval = interval
+        self.last_update = None
+        self.dt = 0.0
+        self.updates = 0
+        self.holds = 0
+        self.max_change = np.zeros(len(self.IDs))
+
+    def resetState(self):
+        """
+        Creates the initial state of a stateful kernel.
+        """
+        if self.kernel.state is not None:
+            self.state = self.kernel.state(self.parameters, self.options, self.records)
+
+    def __len__(self):
+        return len(self.IDs)
+
+class StateBuffer:
+    """
+    Values of one SWMM quantity for every element that a batch kernel
+    reads it from. Pollutant quantities hold the whole pollutant vector of
+    each element (one row per element, one column per pollutant).
+    """
+
+    def __init__(self, getter, quantity, n_pollutants=None):
+        self.getter = getter
+        self.quantity = quantity
+        self.n_pollutants = n_pollutants
+        self.IDs = []
+        self.row = {}
+        self.values = np.empty((0,) if n_pollutants is None else (0, n_pollutants))
+        # Rows read from SWMM since the last invalidation
+        self.fresh = np.zeros(0, dtype=bool)
+
+    def rows(self, IDs):
+        """
+        Adds elements to the buffer and returns their row indices. The
+        values are allocated by allocate().
+        """
+        for ID in IDs:
+            if ID not in self.row:
+                self.row[ID] = len(self.IDs)
+                self.IDs.append(ID)
+        return np.array([self.row[ID] for ID in IDs], dtype=int)
+
+    def allocate(self):
+        """
+        Sizes the values for every element added so far, keeping the rows
+        already read in this step. All elements are normally added when
+        the plan is compiled, so this allocates once.
+        """
+        n = len(self.fresh)
+        if n == len(self.IDs):
+            return
+        shape = (len(self.IDs),) if self.n_pollutants is None else (len(self.IDs), self.n_pollutants)
+        values = np.zeros(shape)
+        values[:n] = self.values[:n]
+        fresh = np.zeros(len(self.IDs), dtype=bool)
+        fresh[:n] = self.fresh
+        self.values, self.fresh = values, fresh
+
+    def invalidate(self):
+        self.fresh[:] = False
+
+    def fill(self, rows):
+        """
+        Reads the quantity from SWMM for the given rows, one toolkit call
+        each, and returns the number of calls made.
+        """
+        for i in rows:
+            self.values[i] = self.getter(self.IDs[i], self.quantity)
+        self.fresh[rows] = True
+        return len(rows)
+
+
+class StateCache:
+    """
+    Per-step cache of the SWMM states read by the batch kernels. Each
+    (element, quantity) pair is read from the toolkit at most once per
+    step into a NumPy buffer, no matter how many kernels use it, and all
+    buffers are invalidated when the simulation time advances.
+
+    Counters
+    ________
+    calls
+        toolkit reads made
+    requests
+        element values handed to kernels; without the cache each one
+        would be a toolkit read
+    avoided
+        requests - calls
+    """
+
+    def __init__(self, sim):
+        self.sim = sim
+        self.buffers = {}
+        self.stamp = None
+        self.calls = 0
+        self.requests = 0
+
+    def buffer(self, element_type, name):
+        """
+        Returns the buffer of a kernel input for nodes or links.
+        """
+        nodes = element_type == ElementType.Nodes
+        pollutant = name in POLLUTANT_INPUTS
+        quantity = (POLLUTANT_INPUTS if pollutant else RESULT_INPUTS)[name][0 if nodes else 1]
+        # Keyed by toolkit quantity, so inputs that map to the same quantity
+        # (inflowQual and reactorQual of links) share a buffer
+        key = (element_type, pollutant, quantity)
+        if key not in self.buffers:
+            model = self.sim._model
+            if pollutant:
+                getter = model.getNodePollut if nodes else model.getLinkPollut
+                n_pollutants = model.getProjectSize(tka.ObjectType.POLLUT.value)
+                self.buffers[key] = StateBuffer(getter, quantity, n_pollutants)
+            else:
+                getter = model.getNodeResult if nodes else model.getLinkResult
+                self.buffers[key] = StateBuffer(getter, quantity)
+        return self.buffers[key]
+
+    def allocate(self):
+        for buffer in self.buffers.values():
+            buffer.allocate()
+
+    def invalidate(self):
+        for buffer in self.buffers.values():
+            buffer.invalidate()
+
+    def read(self, buffer, rows, columns=None):
+        """
+        Returns the buffered values at rows (and pollutant columns), reading
+        the rows that were not read yet in this step from SWMM first.
+        """
+        if self.sim.current_time != self.stamp:
+            self.invalidate()
+            self.stamp = self.sim.current_time
+        if len(buffer.fresh) < len(buffer.IDs):
+            # Elements added after the plan was compiled
+            buffer.allocate()
+        stale = rows[~buffer.fresh[rows]]
+        if len(stale):
+            self.calls += buffer.fill(np.unique(stale))
+        self.requests += len(rows)
+        if columns is None:
+            return buffer.values[rows]
+        return buffer.values[rows, columns]
+
+    @property
+    def avoided(self):
+        return self.requests - self.calls
+
+
+class MassBalance:
+    """
+    Running, dt-weighted pollutant mass balance of every treated (asset,
+    pollutant), updated in place each step with O(1) memory per asset.
+    Loads are in concentration x volume units (mg/L x m^3 = g for SI).
+
+    inflow    = sum of Qin*Cin*dt
+    outflow   = sum of (Qout + flooding)*C*dt, with C the treated
+                concentration
+    removed   = mass taken out (> 0) or generated (< 0) by the method:
+                sum of (C_before - C)*(V + Qout*dt), where C_before is
+                the concentration SWMM computed before treatment
+    stored    = V*C at the end of the last step (stored0 at the start)
+    error     = inflow - outflow - removed - (stored - stored0)
+    peak      = highest treated concentration so far
+
+    Node inflow loads use the node inflow quality reported by SWMM. A
+    link's flow is its outflow; its inflow volume is Q*dt plus the change
+    in link volume, at the concentration of its upstream node, and it has
+    no flooding. This closes for dynamic wave routing; kinematic wave link
+    volumes are not continuity-consistent, so link errors are larger there.
+    """
+
+    def __init__(self, WQ):
+        self.cache = WQ.cache
+        self.keys = [(t.ID, t.pollutant) for t in WQ.plan]
+        n = len(self.keys)
+        self.inflow = np.zeros(n)
+        self.outflow = np.zeros(n)
+        self.removed = np.zeros(n)
+        self.stored = np.zeros(n)
+        self.stored0 = None
+        self.volume = np.zeros(n)
+        self.peak = np.full(n, -np.inf)
+        self.parts = []
+        for element_type in ElementType:
+            index = np.array([i for i, t in enumerate(WQ.plan) if t.element_type == element_type], dtype=int)
+            if len(index) == 0:
+                continue
+            IDs = [WQ.plan[i].ID for i in index]
+            columns = np.array([WQ.plan[i].pollutant_index for i in index], dtype=int)
+            sources = {}
+            for name in ("reactorQual", "quality", "totalinflow", "outflow", "newVolume"):
+                buffer = self.cache.buffer(element_type, name)
+                sources[name] = (buffer, buffer.rows(IDs), columns if name in POLLUTANT_INPUTS else None)
+            if element_type == ElementType.Nodes:
+                for name in ("inflowQual", "overflow"):
+                    buffer = self.cache.buffer(element_type, name)
+                    sources[name] = (buffer, buffer.rows(IDs), columns if name in POLLUTANT_INPUTS else None)
+            else:
+                upstream = [WQ.sim._model.getLinkConnections(ID)[0] for ID in IDs]
+                buffer = self.cache.buffer(ElementType.Nodes, "quality")
+                sources["inflowQual"] = (buffer, buffer.rows(upstream), columns)
+            self.parts.append((index, sources, element_type == ElementType.Links))
+        self.state = []
+
+    def before(self, dt):
+        """
+        Reads the states SWMM computed for the step, before treatment.
+        """
+
+        self.state = []
+        for index, sources, link in self.parts:
+            state = {name: self.cache.read(*source) for name, source in sources.items() if name != "quality"}
+            state.setdefault("overflow", 0.0)
+            V = state["newVolume"]
+            if self.stored0 is None:
+                # Storage at the start of the run, from the concentration
+                # before the first step and the volume before the inflow
+                if not link:
+                    V = np.maximum(V - (state["totalinflow"] - state["outflow"] - state["overflow"])*dt, 0.0)
+                self.stored[index] = V*self.cache.read(*sources["quality"])
+                self.volume[index] = V
+            if link:
+                state["totalinflow"] = state["outflow"] + ((state["newVolume"] - self.volume[index])/dt if dt > 0 else 0.0)
+            self.state.append(state)
+        if self.stored0 is None:
+            self.stored0 = self.stored.copy()
+        for index, sources, link in self.parts:
+            sources["quality"][0].invalidate()
+
+    def after(self, dt):
+        """
+        Adds the step's loads once every treatment has been set.
+        """
+
+        for (index, sources, link), state in zip(self.parts, self.state):
+            C = self.cache.read(*sources["quality"])
+            Qout = state["outflow"]
+            self.inflow[index] += state["totalinflow"]*state["inflowQual"]*dt
+            self.outflow[index] += (Qout + state["overflow"])*C*dt
+            self.removed[index] += (state["reactorQual"] - C)*(state["newVolume"] + Qout*dt)
+            self.stored[index] = state["newVolume"]*C
+            self.volume[index] = state["newVolume"]
+            self.peak[index] = np.maximum(self.peak[index], C)
+
+    @property
+    def error(self):
+        return self.inflow - self.outflow - self.removed - (self.stored - self.stored0)
+
+
+class ToolkitCounter:
+    """
+    Counts the toolkit get/set calls made on a simulation's model by
+    wrapping its getters and setters. Create it before anything binds
+    the model's methods (e.g. before waterQuality compiles its plan).
+
+    Counters created on the same model share one wrapper, so each call is
+    made once and counted by every counter. close() (or leaving a with
+    block) stops counting, and the last counter closed restores the
+    model's methods.
+    """
+
+    GETTERS = ("getNodePollut", "getLinkPollut", "getNodeResult", "getLinkResult")
+    SETTERS = ("setNodePollut", "setLinkPollut")
+
+    def __init__(self, sim):
+        self.model = sim._model
+        self.gets = 0
+        self.sets = 0
+        self.wrappers = {}
+        for name in self.GETTERS + self.SETTERS:
+            wrapper = getattr(self.model, name)
+            if not hasattr(wrapper, "counters"):
+                wrapper = self._wrap(name, "gets" if name in self.GETTERS else "sets")
+                setattr(self.model, name, wrapper)
+            wrapper.counters.append(self)
+            self.wrappers[name] = wrapper
+
+    def _wrap(self, name, counter):
+        call = getattr(self.model, name)
+        counters = []
+        def counted(*args):
+            for toolkit in counters:
+                setattr(toolkit, counter, getattr(toolkit, counter) + 1)
+            return call(*args)
+        counted.counters = counters
+        # The model's own attribute, if the method was already replaced
+        counted.original = vars(self.model).get(name)
+        return counted
+
+    def close(self):
+        for name, wrapper in self.wrappers.items():
+            wrapper.counters.remove(self)
+            if not wrapper.counters and vars(self.model).get(name) is wrapper:
+                if wrapper.original is None:
+                    delattr(self.model, name)
+                else:
+                    setattr(self.model, name, wrapper.original)
+        self.wrappers = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class Profiler:
+    """
+    Opt-in instrumentation of a waterQuality run (instrument=True).
+
+    Records cumulative time and call counts per method and per asset,
+    toolkit get/set counts, CSTR solver function and Jacobian evaluations
+    and the time spent in updateWQState. Batch groups are timed as a
+    whole, and their time is shared equally among the group's assets.
+    """
+
+    def __init__(self, sim):
+        self.toolkit = ToolkitCounter(sim)
+        self.steps = 0
+        self.time = 0.0
+        self.method_time = {}
+        self.method_calls = {}
+        self.method_assets = {}
+        self.group_time = {}
+        self.asset_time = {}
+        self.nfev = 0
+        self.njev = 0
+
+    def _method(self, method, seconds, assets):
+        self.method_time[method] = self.method_time.get(method, 0.0) + seconds
+        self.method_calls[method] = self.method_calls.get(method, 0) + 1
+        self.method_assets[method] = self.method_assets.get(method, 0) + assets
+
+    def _solver(self, state, before):
+        # States are recreated on the first step; a new state counts from zero
+        nfev, njev, previous = before
+        if previous is not state:
+            nfev = njev = 0
+        self.nfev += state.nfev - nfev
+        self.njev += state.njev - njev
+
+    def runGroup(self, WQ, group, index):
+        state = group.state
+        before = (getattr(state, "nfev", 0), getattr(state, "njev", 0), state)
+        start = perf_counter()
+        WQ._runGroup(group, index)
+        seconds = perf_counter() - start
+        self._method(group.method, seconds, len(group))
+        self.group_time[group] = self.group_time.get(group, 0.0) + seconds
+        if hasattr(group.state, "nfev"):
+            self._solver(group.state, before)
+
+    def runTreatment(self, WQ, t, index):
+        state = WQ.CSTR_state.get((t.ID, t.pollutant))
+        before = (getattr(state, "nfev", 0), getattr(state, "njev", 0), state)
+        start = perf_counter()
+        if t.step_indexed:
+            t.func(index, t.ID, t.pollutant, t.parameters, t.element_type)
+        else:
+            t.func(t.ID, t.pollutant, t.parameters, t.element_type)
+        seconds = perf_counter() - start
+        self._method(t.method, seconds, 1)
+        key = (t.ID, t.pollutant)
+        self.asset_time[key] = self.asset_time.get(key, 0.0) + seconds
+        if t.method == "CSTR":
+            self._solver(WQ.CSTR_state[key], before)
+
+    def assetTimes(self):
+        """
+        Returns the cumulative time of every treated (asset, pollutant).
+        """
+        times = dict(self.asset_time)
+        for group, seconds in self.group_time.items():
+            for ID, pollutantID in zip(group.IDs, group.pollutants):
+                times[(ID, pollutantID)] = times.get((ID, pollutantID), 0.0) + seconds/len(group)
+        return times
+
+    def stats(self, WQ, slowest=10):
+        times = self.assetTimes()
+        methods = {t.method for t in WQ.plan}
+        return {
+            "steps": self.steps,
+            "time": self.time,
+            "time_per_step": self.time/self.steps if self.steps else 0.0,
+            "methods": {method: {"time": self.method_time.get(method, 0.0),
+                                 "calls": self.method_calls.get(method, 0),
+                                 "assets": self.method_assets.get(method, 0)}
+                        for method in sorted(methods)},
+            "toolkit": {"gets": self.toolkit.gets,
+                        "sets": self.toolkit.sets,
+                        "cached_reads": WQ.cache.calls,
+                        "avoided_reads": WQ.cache.avoided},
+            "solver": {"nfev": self.nfev, "njev": self.njev},
+            "slowest": sorted(((ID, pollutantID, seconds) for (ID, pollutantID), seconds in times.items()),
+                              key=lambda asset: -asset[2])[:slowest],
+            }
+
+    def summary(self, WQ, slowest=5):
+        stats = self.stats(WQ, slowest)
+        lines = ["StormReactor: {} steps, {:.3f} s in updateWQState ({:.3e} s/step)".format(
+                    stats["steps"], stats["time"], stats["time_per_step"])]
+        for method, info in stats["methods"].items():
+            lines.append("  {:<18} {:10.3f} s {:10d} calls {:12d} asset updates".format(
+                method, info["time"], info["calls"], info["assets"]))
+        lines.append("  toolkit gets {gets}, sets {sets}, reads avoided by cache {avoided_reads}".format(**stats["toolkit"]))
+        if stats["solver"]["nfev"]:
+            lines.append("  CSTR solver evaluations: {nfev} function, {njev} Jacobian".format(**stats["solver"]))
+        lines.append("  slowest: " + ", ".join("{} {} {:.3e} s".format(*asset) for asset in stats["slowest"]))
+        return "\n".join(lines)
+
+
+class RoutingStride:
+    """
+    Replaces SWMM's stride on a simulation's model, which sim.step_advance()
+    uses to run several routing steps per Python call. The routing steps of
+    an interval are run one at a time, and the water quality methods of
+    every waterQuality of the simulation are applied before each of them,
+    because SWMM only keeps a set concentration for one routing step.
+    Treatment starts with the first updateWQState call, as without
+    step_advance.
+    """
+
+    def __init__(self, sim):
+        self.sim = sim
+        self.models = []
+        self.stride = sim._model.swmm_stride
+        sim._model.swmm_stride = self
+
+    def __call__(self, advance_seconds):
+        end = self.sim.current_time + timedelta(seconds=advance_seconds)
+        while True:
+            time = self.sim._model.swmm_step()
+            if time <= 0.0 or self.sim.current_time >= end:
+                return time
+            for WQ in self.models:
+                if WQ.step_index > 0:
+                    WQ._runPlan(WQ.step_index)
+
+
 class waterQuality:
     """
     Water quality module for SWMM
@@ -40,24 +678,113 @@ class waterQuality:
             'Link2': {'type': 'link', 'pollutant': 'P1', 'method': 'ConstantRemoval', 'parameters': {"R": 5}}
             }
 
+        An asset can treat several pollutants, each with its own method,
+        by listing them under 'treatments':
+        config = {
+            'Tank': {'type': 'node', 'treatments': [
+                {'pollutant': 'TSS', 'method': 'GravitySettling', 'parameters': {"k": 0.01, "C_s": 10}},
+                {'pollutant': 'TP', 'method': 'ConstantRemoval', 'parameters': {"R": 0.3}}]}
+            }
+
     Methods
     _______
     updateWQState
         Updates the pollutant concentration during a SWMM simulation for
-        all methods except CSTR.
-
-    updateCSTRWQState
-        Updates the pollutant concentration during a SWMM simulation for
-        a CSTR.
+        all methods, including CSTR.
+
+    updateWQState_CSTR
+        Same as updateWQState, with the simulation step index passed in
+        explicitly (index 0 resets the CSTR reactor concentrations to c0).
+
+    The config is compiled into an execution plan when the class is
+    initialized: element types, pollutant indices and method callables are
+    resolved once, and a WaterQualityConfigError is raised for unknown
+    assets, pollutants or methods and for missing method parameters.
+
+    With vectorize=True (default), assets sharing a method with a batch
+    kernel (see StormReactor.kernels) are evaluated together in one NumPy
+    call per step. With vectorize=False every asset calls its per-asset
+    method, which is the reference implementation of each method.
+    Methods added with register_method are always evaluated as batch
+    groups. backend="numba" evaluates ConcDependRemoval, GravitySettling,
+    Phosphorus and CSTR batch groups with compiled loops (see
+    StormReactor.jit) instead of NumPy; without Numba installed it falls
+    back to NumPy.
+
+    Batch kernels read SWMM states through self.cache (a StateCache), which
+    reads each (element, quantity) pair from the toolkit once per step and
+    counts the toolkit calls it avoided.
+
+    With gating=True, assets of batch groups whose kernel reads the
+    hydraulics and keeps no state (kCModel, GravitySettling) go to sleep
+    while they are dry: once an asset has no inflow, depth or
+    volume and its treated concentration stops changing, each step only
+    reads its inflow and sets the held concentration until water arrives
+    again. activity() returns the steps each asset was evaluated and
+    skipped.
+
+    update_interval (seconds, or {method: seconds}) updates batch groups
+    only every so often; a treatment may set its own 'update_interval' in
+    the config. The next update integrates the method over the whole time
+    since the previous one. In between, methods of the inflow concentration
+    hold their result (every asset sets its last concentration again), so
+    the held concentration lags the every-step result by at most its change
+    over one interval. NthOrderReaction lets SWMM mix the untreated inflow
+    in between and reacts over the whole interval at the update (operator
+    splitting), which leaves a sawtooth of at most one interval of reaction
+    around the every-step result. decimation() reports the largest change
+    of every asset's concentration at an update.
+
+    With sim.step_advance(), the methods are applied before every routing
+    step of an interval (see RoutingStride), so the concentrations are the
+    same as when updateWQState is called every routing step.
+
+    save_state() checkpoints the state of every method and the water
+    quality clock next to a SWMM hotstart file, and load_state() resumes
+    from it in a new simulation, so spin-up runs only have to be done once.
+
+    With instrument=True the run is profiled (see Profiler): stats()
+    returns time and call counts per method, toolkit get/set counts, CSTR
+    solver evaluations and the slowest assets, and a summary is printed
+    every report_every steps if it is given.
     """
 
     # Initialize class
-    def __init__(self, sim, config):
+    def __init__(self, sim, config, vectorize=True, instrument=False, report_every=None, mass_balance=False,
+                 gating=False, update_interval=None, backend="numpy"):
         self.sim = sim
         self.config = config
+        self.vectorize = vectorize
+        if backend not in ("numpy", "numba"):
+            raise ValueError("unknown backend {!r}, choose 'numpy' or 'numba'".format(backend))
+        if backend == "numba" and not NUMBA_AVAILABLE:
+            print("Numba is not installed; using the NumPy kernels (pip install numba).")
+            backend = "numpy"
+        elif backend == "numba" and not vectorize:
+            print("The numba backend only applies to batch kernels (vectorize=True).")
+        self.backend = backend
+        # Batch kernels by method; the numba backend swaps in compiled ones
+        self.kernels = dict(BATCH_KERNELS, **JIT_KERNELS) if backend == "numba" else BATCH_KERNELS
+        self.gating = gating
+        if gating and not vectorize:
+            print("Activity gating only applies to batch kernels (vectorize=True).")
+        self.update_interval = update_interval
+        self.report_every = report_every
+        # The profiler wraps the toolkit getters before the plan binds them
+        self.profiler = Profiler(sim) if instrument else None
         self.start_time = self.sim.start_time
         self.last_timestep = self.start_time
-        self.solver = ode(self._CSTR_tank)
+        self.dt = 0.0
+        # Routing step (seconds); time-dependent methods sub-step at it
+        # when dt is longer (the first sim.step_advance() interval)
+        self.routing_step = self.sim._model.getSimAnalysisSetting(tka.SimulationParameters.RouteStep.value)
+        self.step_index = 0
+        # Node inflow quality saved with a loaded state, for the first step
+        # after a hot start (see load_state)
+        self.resume_inflow = None
+        self.CSTR_state = {}
+        # Recorders sampled at the end of every step (see StormReactor.recorder)
+        self.recorders = []
 
         # Water quality methods
         self.method = {
@@ -73,53 +800,687 @@ class waterQuality:
             "Phosphorus": self._Phosphorus,
             }
 
+        # Compile the config into an execution plan
+        self.plan = self._compilePlan()
+        self.cache = StateCache(self.sim)
+        self.groups, self.scalar_plan = self._compileGroups(self.plan)
+        self._allocateStates()
+        self.balance = MassBalance(self) if mass_balance else None
 
-    def updateWQState(self):
-        """
-        Runs the selected water quality method (except CSTR) and updates
-        the pollutant concentration during a SWMM simulation.
+        # Treat every routing step of a sim.step_advance() interval
+        stride = self.sim._model.swmm_stride
+        if not isinstance(stride, RoutingStride):
+            stride = RoutingStride(self.sim)
+        stride.models.append(self)
+
+
+    def _compilePlan(self):
         """
+        Validates the config dictionary and resolves everything that does
+        not change during a simulation: element types, pollutant indices
+        and the water quality method callables.
 
-        if self.sim._advance_seconds:
-            raise(PySWMMStepAdvanceNotSupported)
+        Returns a list of Treatment tuples, in config order.
+        """
 
-        # Parse all the elements and their parameters in the config dictionary
+        plan = []
+        self.pollutant_index = {}
         for asset_ID, asset_info in self.config.items():
-            attribute = self.config[asset_ID]['method']
-            element_type = self.config[asset_ID]['type']
+            # Resolve element type
+            element_type = asset_info.get('type')
             if element_type == "node":
                 element_type = ElementType.Nodes
-            else:
+                object_type = tka.ObjectType.NODE.value
+            elif element_type == "link":
                 element_type = ElementType.Links
-            # Call the water quality method for each element
-            self.method[attribute](asset_ID, self.config[asset_ID]['pollutant'], self.config[asset_ID]['parameters'], element_type)
+                object_type = tka.ObjectType.LINK.value
+            else:
+                raise WaterQualityConfigError(asset_ID, "type must be 'node' or 'link', got {!r}".format(element_type))
+            if not self.sim._model.ObjectIDexist(object_type, asset_ID):
+                raise WaterQualityConfigError(asset_ID, "{} does not exist in the SWMM model".format(asset_info['type']))
+
+            # An asset has a list of treatments, or a single treatment
+            # given directly in its config entry
+            treated = set()
+            for treatment in asset_info.get('treatments', [asset_info]):
+                plan.append(self._compileTreatment(asset_ID, element_type, treatment))
+                if plan[-1].pollutant in treated:
+                    raise WaterQualityConfigError(asset_ID, "pollutant {!r} is treated more than once".format(plan[-1].pollutant))
+                treated.add(plan[-1].pollutant)
+        return plan
+
+
+    def _compileTreatment(self, asset_ID, element_type, treatment):
+        """
+        Validates one (pollutant, method, parameters) treatment of an asset
+        and resolves its pollutant index and method callable.
+        """
+
+        # Resolve water quality method
+        attribute = treatment.get('method')
+        if attribute not in self.method and attribute not in PLUGINS:
+            raise WaterQualityConfigError(asset_ID, "unknown water quality method {!r}".format(attribute))
+        if element_type == ElementType.Links and (attribute in NODE_ONLY_METHODS or PLUGINS.get(attribute)):
+            raise WaterQualityConfigError(asset_ID, "{} does not work for links".format(attribute))
+        parameters = treatment.get('parameters', {})
+        missing = [p for p in REQUIRED_PARAMETERS.get(attribute, ()) if p not in parameters]
+        if missing:
+            raise WaterQualityConfigError(asset_ID, "{} requires parameters {}".format(attribute, ", ".join(missing)))
+        known = set(REQUIRED_PARAMETERS.get(attribute, ()))
+        if attribute in BATCH_KERNELS:
+            known |= set(BATCH_KERNELS[attribute].parameters) | set(BATCH_KERNELS[attribute].options or {})
+        unknown = [p for p in parameters if p not in known]
+        if unknown:
+            print("{}: {} ignores unknown parameters {}".format(asset_ID, attribute, ", ".join(map(repr, unknown))))
+        if attribute == "CSTR":
+            integrator = parameters.get("integrator", CSTR_OPTIONS["integrator"])
+            if integrator not in ODE_INTEGRATORS and integrator not in IVP_INTEGRATORS:
+                raise WaterQualityConfigError(asset_ID, "unknown CSTR integrator {!r}".format(integrator))
+
+        # Resolve pollutant index
+        pollutantID = treatment.get('pollutant')
+        if pollutantID not in self.pollutant_index:
+            if not self.sim._model.ObjectIDexist(tka.ObjectType.POLLUT.value, pollutantID):
+                raise WaterQualityConfigError(asset_ID, "pollutant {!r} does not exist in the SWMM model".format(pollutantID))
+            self.pollutant_index[pollutantID] = self.sim._model.getObjectIDIndex(tka.ObjectType.POLLUT, pollutantID)
+
+        # Resolve update interval
+        interval = self.update_interval
+        if isinstance(interval, dict):
+            interval = interval.get(attribute)
+        interval = treatment.get('update_interval', interval)
+        if interval is not None:
+            if isinstance(interval, bool) or not isinstance(interval, (int, float)) or interval < 0:
+                raise WaterQualityConfigError(asset_ID, "update_interval must be a number of seconds >= 0, got {!r}".format(interval))
+            if not self._batched(attribute):
+                print("{}: update_interval only applies to batch kernels (vectorize=True).".format(asset_ID))
+            interval = float(interval) or None
+
+        return Treatment(asset_ID, pollutantID, self.pollutant_index[pollutantID], attribute,
+                         parameters, element_type, self.method.get(attribute),
+                         attribute in STEP_INDEXED_METHODS, interval)
+
+
+    def _batched(self, method):
+        """
+        Whether a method runs in a batch group. Registered methods have no
+        per-asset implementation, so they are batched even when vectorize
+        is False.
+        """
+        return method in BATCH_KERNELS and (self.vectorize or method in PLUGINS)
+
+
+    def _compileGroups(self, plan):
+        """
+        Splits the execution plan into batch groups, one per method and
+        element type with a batch kernel, and the remaining treatments that
+        are run with their per-asset method.
+        """
+
+        groups = {}
+        scalar_plan = []
+        for treatment in plan:
+            if self._batched(treatment.method):
+                kernel = self.kernels[treatment.method]
+                options = tuple((o, treatment.parameters.get(o, default)) for o, default in (kernel.options or {}).items())
+                key = (treatment.method, treatment.element_type, options, treatment.update_interval)
+                groups.setdefault(key, []).append(treatment)
+            else:
+                scalar_plan.append(treatment)
+        groups = [TreatmentGroup(method, element_type, self.kernels[method], dict(options), treatments, interval)
+                  for (method, element_type, options, interval), treatments in groups.items()]
+        for group in groups:
+            # Locate each kernel input of the group in the state cache
+            group.sources = {}
+            for name in group.kernel.inputs:
+                if name in ("dt", "routing_step"):
+                    continue
+                buffer = self.cache.buffer(group.element_type, name)
+                columns = group.pollutant_index if name in POLLUTANT_INPUTS else None
+                group.sources[name] = (buffer, buffer.rows(group.IDs), columns)
+            # Only kernels that read the hydraulics save work by sleeping;
+            # stateful kernels must advance their state every step, and
+            # kernels that leave dry assets unset (Phosphorus) must not
+            # have a held concentration set for them
+            if self.gating and group.kernel.state is None \
+                    and set(GATE_INPUTS) & set(group.kernel.inputs):
+                # Check the quantities the kernel already read first
+                names = sorted(GATE_INPUTS, key=lambda name: name not in group.kernel.inputs)
+                group.gate = {}
+                for name in names:
+                    buffer = self.cache.buffer(group.element_type, name)
+                    group.gate[name] = (buffer, buffer.rows(group.IDs))
+        # Register the inputs of the per-asset methods too, so the cache
+        # is allocated once
+        for treatment in scalar_plan:
+            for name in BATCH_KERNELS[treatment.method].inputs:
+                if name not in ("dt", "routing_step"):
+                    self.cache.buffer(treatment.element_type, name).rows([treatment.ID])
+        self.cache.allocate()
+        return groups, scalar_plan
+
+
+    def _allocateStates(self):
+        """
+        Allocates one state record (see kernels.STATE_DTYPE) per asset of a
+        stateful method in self.states. Each stateful group keeps its state
+        in a contiguous slice (a view), so the state of every asset is
+        snapshotted with self.states.copy().
+        """
+
+        groups = [group for group in self.groups if group.kernel.state is not None]
+        scalar = [t for t in self.scalar_plan if t.method in STEP_INDEXED_METHODS]
+        self.states = state_array(sum(len(group) for group in groups) + len(scalar))
+        start = 0
+        for group in groups:
+            group.records = self.states[start:start+len(group)]
+            group.resetState()
+            start += len(group)
+        self.state_rows = {(t.ID, t.pollutant): start+i for i, t in enumerate(scalar)}
+        self.state_keys = [(ID, pollutant, group.method) for group in groups
+                           for ID, pollutant in zip(group.IDs, group.pollutants)]
+        self.state_keys += [(t.ID, t.pollutant, t.method) for t in scalar]
+
+
+    def _gatherInput(self, group, name, active=None):
+        """
+        Reads one batch kernel input for every asset in a group (or the
+        active ones) from the per-step state cache.
+        """
+
+        if name == "dt":
+            return group.dt
+        if name == "routing_step":
+            return self.routing_step
+        buffer, rows, columns = group.sources[name]
+        if active is not None:
+            rows = rows[active]
+            columns = columns[active] if columns is not None else None
+        return self.cache.read(buffer, rows, columns)
+
+
+    def _wakeGroup(self, group):
+        """
+        Wakes the sleeping assets of a gated group that have inflow again
+        and returns the mask of assets to evaluate this step. Assets that
+        stay asleep set their last concentration again, since SWMM only
+        keeps a set concentration for one routing step.
+        """
+
+        asleep = np.flatnonzero(~group.awake)
+        if len(asleep):
+            buffer, rows = group.gate["totalinflow"]
+            Q = self.cache.read(buffer, rows[asleep])
+            group.awake[asleep[Q != 0.0]] = True
+            self._setHeld(group, asleep[Q == 0.0])
+        active = group.awake.copy()
+        group.evaluated[active] += 1
+        group.skipped[~active] += 1
+        return active
+
+
+    def _setHeld(self, group, indices):
+        """
+        Sets the last concentration of the given assets again, since SWMM
+        only keeps a set concentration for one routing step.
+        """
+
+        setter = self.sim._model.setNodePollut if group.element_type == ElementType.Nodes \
+            else self.sim._model.setLinkPollut
+        for i in indices:
+            if not np.isnan(group.last[i]):
+                setter(group.IDs[i], group.pollutants[i], float(group.last[i]))
+
+
+    def _sleepGroup(self, group, indices, unchanged):
+        """
+        Puts evaluated assets to sleep when they are dry (no inflow, depth
+        or volume) and their concentration did not change.
+        """
+
+        # Assets that never had a concentration set have none to hold
+        candidates = indices[unchanged & ~np.isnan(group.last[indices])]
+        for name, (buffer, rows) in group.gate.items():
+            if not len(candidates):
+                return
+            candidates = candidates[self.cache.read(buffer, rows[candidates]) == 0.0]
+        group.awake[candidates] = False
+
+
+    def _runGroup(self, group, index):
+        """
+        Gathers the inputs of a batch group, evaluates its kernel once for
+        all assets and sets the new concentrations in SWMM. The state of
+        stateful kernels is (re)initialized on the first step (index 0).
+        A group with an update interval is only evaluated once the interval
+        has passed, over the time elapsed since its last update.
+        """
+
+        now = self.sim.current_time
+        if group.interval is not None and index != 0 and group.last_update is not None \
+                and (now - group.last_update).total_seconds() < group.interval:
+            group.holds += 1
+            # Kernels of the reactor concentration react at the next update
+            # to what SWMM mixed in the meantime
+            if "reactorQual" not in group.kernel.inputs:
+                self._setHeld(group, range(len(group)))
+            return
+        group.dt = self.dt if group.last_update is None or index == 0 \
+            else (now - group.last_update).total_seconds()
+        group.last_update = now
+        group.updates += 1
+
+        active = None
+        if group.gate is not None:
+            active = self._wakeGroup(group)
+            if not active.any():
+                return
+            if active.all():
+                active = None
+
+        args = [self._gatherInput(group, name, active) for name in group.kernel.inputs]
+        args += [group.parameters[p] if active is None else group.parameters[p][active]
+                 for p in group.kernel.parameters]
+        indices = np.arange(len(group)) if active is None else np.flatnonzero(active)
+        state = None
+        if group.kernel.state is not None:
+            if index == 0:
+                group.resetState()
+            state = group.state
+            state.last_update = (now - self.start_time).total_seconds()
+            args.insert(0, state)
+        Cnew = group.kernel.func(*args)
+        if isinstance(Cnew, tuple):
+            Cnew, update = Cnew
+        else:
+            update = None
+
+        setter = self.sim._model.setNodePollut if group.element_type == ElementType.Nodes \
+            else self.sim._model.setLinkPollut
+        for j, i in enumerate(indices):
+            if update is None or update[j]:
+                setter(group.IDs[i], group.pollutants[i], float(Cnew[j]))
+
+        if group.gate is not None or group.interval is not None:
+            Cnew = np.broadcast_to(Cnew, (len(indices),))
+            was_set = np.ones(len(indices), dtype=bool) if update is None else np.asarray(update, dtype=bool)
+            previous = group.last[indices]
+            # Assets the kernel left unset may not be set while asleep
+            unchanged = was_set & (Cnew == previous)
+            if group.interval is not None:
+                change = np.where(was_set & ~np.isnan(previous), np.abs(Cnew - previous), 0.0)
+                group.max_change[indices] = np.maximum(group.max_change[indices], change)
+            group.last[indices[was_set]] = Cnew[was_set]
+            if group.gate is not None:
+                self._sleepGroup(group, indices, unchanged)
+
+
+    def _runPlan(self, index):
+        """
+        Runs every batch group and then every per-asset treatment in the
+        execution plan. The model dt is computed once and shared by all
+        methods.
+        """
+
+        # Calculate model dt in seconds
+        current_step = self.sim.current_time
+        self.dt = (current_step - self.last_timestep).total_seconds()
+        restore = self._patchInflow() if self.resume_inflow is not None else None
+
+        if self.balance is not None:
+            self.balance.before(self.dt)
+        if self.profiler is not None:
+            self._runPlanProfiled(index)
+        else:
+            for group in self.groups:
+                self._runGroup(group, index)
+            for t in self.scalar_plan:
+                if t.step_indexed:
+                    t.func(index, t.ID, t.pollutant, t.parameters, t.element_type)
+                else:
+                    t.func(t.ID, t.pollutant, t.parameters, t.element_type)
+
+        if self.balance is not None:
+            self.balance.after(self.dt)
+        if restore is not None:
+            restore()
+        for recorder in self.recorders:
+            recorder.sample()
 
         #Update timestep after water quality methods are completed
-        self.last_timestep = self.sim.current_time
+        self.last_timestep = current_step
+        self.step_index = index + 1
+
+
+    def _patchInflow(self):
+        """
+        SWMM reports no node inflow quality at the first step after a hot
+        start, so for that step the node inflow quality getter (and the
+        state cache buffers that use it) return the inflow quality saved
+        with the loaded state. Returns a function that undoes the patch.
+        """
+
+        model = self.sim._model
+        getter = model.getNodePollut
+        patched = "getNodePollut" in vars(model)
+        inflow, self.resume_inflow = self.resume_inflow, None
+        quantity = tka.NodePollut.inflowQual.value
+
+        def getNodePollut(ID, pollutant_quantity):
+            if pollutant_quantity == quantity and ID in inflow:
+                return inflow[ID]
+            return getter(ID, pollutant_quantity)
+
+        buffers = [buffer for buffer in self.cache.buffers.values() if buffer.getter == getter]
+        model.getNodePollut = getNodePollut
+        for buffer in buffers:
+            buffer.getter = getNodePollut
+
+        def restore():
+            if patched:
+                model.getNodePollut = getter
+            else:
+                del model.getNodePollut
+            for buffer in buffers:
+                buffer.getter = getter
+        return restore
+
+
+    def _runPlanProfiled(self, index):
+        """
+        Runs the execution plan through the profiler and prints a summary
+        every report_every steps.
+        """
+
+        start = perf_counter()
+        for group in self.groups:
+            self.profiler.runGroup(self, group, index)
+        for t in self.scalar_plan:
+            self.profiler.runTreatment(self, t, index)
+        self.profiler.time += perf_counter() - start
+        self.profiler.steps += 1
+        if self.report_every and self.profiler.steps % self.report_every == 0:
+            print(self.profiler.summary(self))
+
+
+    def massBalance(self):
+        """
+        Returns the running pollutant mass balance of every treated asset
+        (requires mass_balance=True) as {(ID, pollutant): totals}, with
+        the inflow, outflow and stored loads, the load removed (> 0) or
+        generated (< 0) by the method, the continuity error and the peak
+        treated concentration. See MassBalance.
+        """
+
+        if self.balance is None:
+            print("Mass balance is off. Use waterQuality(sim, config, mass_balance=True).")
+            return None
+        b = self.balance
+        stored0 = b.stored0 if b.stored0 is not None else b.stored
+        error = b.error if b.stored0 is not None else np.zeros(len(b.keys))
+        return {key: {"inflow": b.inflow[i], "outflow": b.outflow[i], "removed": b.removed[i],
+                      "stored": b.stored[i], "stored0": stored0[i], "error": error[i], "peak": b.peak[i]}
+                for i, key in enumerate(b.keys)}
+
+
+    def continuityError(self):
+        """
+        Returns the network pollutant continuity error (%) of the treated
+        assets: the sum of their mass balance errors over the sum of their
+        inflow and initially stored loads.
+        """
+
+        if self.balance is None or self.balance.stored0 is None:
+            return 0.0
+        b = self.balance
+        total = b.inflow.sum() + b.stored0.sum()
+        return 100.0*b.error.sum()/total if total > 0 else 0.0
+
+
+    def activity(self):
+        """
+        Returns the steps every treated asset of a gated batch group
+        (requires gating=True) was evaluated and skipped while asleep, as
+        {(ID, pollutant): {"evaluated": n, "skipped": n, "asleep": bool}}.
+        """
+
+        if not self.gating:
+            print("Activity gating is off. Use waterQuality(sim, config, gating=True).")
+            return None
+        return {(ID, pollutant): {"evaluated": int(group.evaluated[i]), "skipped": int(group.skipped[i]),
+                                  "asleep": not group.awake[i]}
+                for group in self.groups if group.gate is not None
+                for i, (ID, pollutant) in enumerate(zip(group.IDs, group.pollutants))}
+
+
+    def decimation(self):
+        """
+        Returns, for every treated asset of a batch group with an update
+        interval, the number of updates and held steps and the largest
+        change of its concentration at an update (which bounds the error
+        of holding it), as {(ID, pollutant): {"interval": s, "updates": n,
+        "held": n, "max_change": C}}.
+        """
+
+        groups = [group for group in self.groups if group.interval is not None]
+        if not groups:
+            print("No update interval is set. Use waterQuality(sim, config, update_interval=seconds).")
+            return None
+        return {(ID, pollutant): {"interval": group.interval, "updates": group.updates, "held": group.holds,
+                                  "max_change": float(group.max_change[i])}
+                for group in groups for i, (ID, pollutant) in enumerate(zip(group.IDs, group.pollutants))}
+
+
+    def stats(self, slowest=10):
+        """
+        Returns the profile of the run so far (requires instrument=True):
+        steps and time in updateWQState, time, calls and asset updates per
+        method, toolkit get/set counts, CSTR solver evaluations and the
+        slowest (asset, pollutant, seconds) treatments.
+        """
+
+        if self.profiler is None:
+            print("Instrumentation is off. Use waterQuality(sim, config, instrument=True).")
+            return None
+        return self.profiler.stats(self, slowest)
+
+
+    def updateWQState(self):
+        """
+        Runs the selected water quality methods and updates the pollutant
+        concentration during a SWMM simulation. The step index used by
+        CSTR is counted internally.
+        """
+
+        self._runPlan(self.step_index)
 
 
     def updateWQState_CSTR(self, index):
         """
-        Runs the water quality method CSTR only and updates the pollutant
-        concentration during a SWMM simulation.
+        Runs the selected water quality methods and updates the pollutant
+        concentration during a SWMM simulation, using the given step index
+        (index 0 initializes the CSTR reactor concentrations to c0).
         """
 
-        if self.sim._advance_seconds:
-            raise(PySWMMStepAdvanceNotSupported)
+        self._runPlan(index)
 
-        # Parse all the elements and their parameters in the config dictionary
-        for asset_ID, asset_info in self.config.items():
-            attribute = self.config[asset_ID]['method']
-            element_type = self.config[asset_ID]['type']
-            if element_type == "node":
-                element_type = ElementType.Nodes
-            else:
-                print("CSTR does not work for links.")
-            # Call the water quality method for each element
-            self.method[attribute](index, asset_ID, self.config[asset_ID]['pollutant'], self.config[asset_ID]['parameters'], element_type)
 
-        #Update timestep after water quality methods are completed
-        self.last_timestep = self.sim.current_time
+    def _solverTimes(self):
+        """
+        Returns the CSTR solver clock of every state record (NaN for
+        records of other methods).
+        """
+
+        times = np.full(len(self.states), np.nan)
+        start = 0
+        for group in self.groups:
+            if group.kernel.state is None:
+                continue
+            if isinstance(group.state, CSTRState):
+                times[start:start+len(group)] = group.state.t
+            start += len(group)
+        for key, state in self.CSTR_state.items():
+            times[self.state_rows[key]] = state.t
+        return times
+
+
+    def save_state(self, path, hotstart=True):
+        """
+        SAVE STATE
+        Saves the water quality state to path (.npz): the state record of
+        every stateful asset (CSTR reactor concentrations, event clocks and
+        last update times), the CSTR solver clocks, the concentrations held
+        by gated and decimated assets, the inflow quality of the treated
+        nodes and the water quality clock (start time, last timestep, dt
+        and step index).
+
+        path     = file to save to; .npz is appended if it is missing
+        hotstart = also save the SWMM state to a hotstart file with the same
+                   name and the extension .hsf, for load_state()
+
+        Returns the path of the hotstart file, or None.
+        """
+
+        if not path.endswith(".npz"):
+            path = path + ".npz"
+        keys = [(ID, pollutant) for group in self.groups for ID, pollutant in zip(group.IDs, group.pollutants)]
+        held = np.concatenate([group.last for group in self.groups]) if self.groups else np.empty(0)
+        updated = [np.nan if group.last_update is None else (group.last_update - self.start_time).total_seconds()
+                   for group in self.groups for ID in group.IDs]
+        nodes = list(dict.fromkeys(t.ID for t in self.plan if t.element_type == ElementType.Nodes))
+        inflow = [self.sim._model.getNodePollut(ID, tka.NodePollut.inflowQual.value) for ID in nodes]
+        np.savez(path, version=np.array(1),
+                 state_keys=np.array(["\t".join(key) for key in self.state_keys], dtype=str),
+                 states=self.states, solver_time=self._solverTimes(),
+                 held_keys=np.array(["{}\t{}".format(*key) for key in keys], dtype=str),
+                 held=held, group_update=np.array(updated, dtype=float),
+                 inflow_IDs=np.array(nodes, dtype=str), inflow=np.array(inflow, dtype=float),
+                 clock=np.array([self.start_time, self.last_timestep], dtype="datetime64[us]"),
+                 dt=np.array(self.dt), step_index=np.array(self.step_index))
+        if not hotstart:
+            return None
+        hotstart_path = os.path.splitext(path)[0] + ".hsf"
+        self.sim.save_hotstart(hotstart_path)
+        return hotstart_path
+
+
+    def load_state(self, path, hotstart=True):
+        """
+        LOAD STATE
+        Restores a water quality state saved by save_state(). With
+        hotstart=True the simulation is also set to start at the time the
+        state was saved, from the SWMM hotstart file saved with it, so this
+        must be called before the simulation starts. SWMM reports no node
+        inflow quality at the first step of a hot start, so that step uses
+        the inflow quality saved with the state. The config must have
+        the same stateful assets as the saved one; parameters may differ.
+        With hotstart=False only the treatment state is restored and the
+        simulation keeps its own clock, so the state can be loaded at any
+        time; decimated groups then update at the next step.
+
+        NOTE: Continue with updateWQState(); updateWQState_CSTR(0) resets
+        the CSTR reactors to c0. SWMM applies a set concentration one
+        routing step later, so the concentration it reports at the first
+        step of a hot start is untreated. Mass balance totals count from
+        the loaded state.
+
+        path     = file saved by save_state()
+        hotstart = start the simulation from the paired hotstart file
+        """
+
+        if not path.endswith(".npz") and not os.path.exists(path):
+            path = path + ".npz"
+        with np.load(path) as saved:
+            if int(saved["version"]) != 1:
+                raise WaterQualityStateError(path, "unknown version {}".format(int(saved["version"])))
+            state_keys = [tuple(key.split("\t")) for key in saved["state_keys"]]
+            if state_keys != self.state_keys:
+                raise WaterQualityStateError(path, "it was saved for other stateful assets: {}".format(
+                    ", ".join("{} {} ({})".format(*key) for key in state_keys) or "none"))
+            states = saved["states"]
+            if states.dtype != self.states.dtype:
+                raise WaterQualityStateError(path, "state records have another layout")
+            solver_time = saved["solver_time"]
+            held = dict(zip((tuple(key.split("\t")) for key in saved["held_keys"]),
+                            zip(saved["held"], saved["group_update"])))
+            start_time, last_timestep = saved["clock"].astype(object)
+            dt = float(saved["dt"])
+            step_index = int(saved["step_index"])
+            inflow = dict(zip(saved["inflow_IDs"], saved["inflow"]))
+
+        if hotstart:
+            hotstart_path = os.path.splitext(path)[0] + ".hsf"
+            if self.sim.sim_is_started:
+                raise WaterQualityStateError(path, "a hotstart can only be used before the simulation starts")
+            if not os.path.exists(hotstart_path):
+                raise WaterQualityStateError(path, "hotstart file '{}' does not exist".format(hotstart_path))
+            self.sim.start_time = last_timestep
+            self.sim.use_hotstart(hotstart_path)
+            self.resume_inflow = inflow
+
+        # Stateful groups read the loaded records, so the first step after
+        # loading must not reset them
+        start = 0
+        for group in self.groups:
+            if group.kernel.state is None:
+                continue
+            group.resetState()
+            if isinstance(group.state, CSTRState):
+                group.state.t = float(solver_time[start])
+            start += len(group)
+        for key in list(self.CSTR_state):
+            del self.CSTR_state[key]
+        for t in self.scalar_plan:
+            if t.method == "CSTR":
+                row = self.state_rows[(t.ID, t.pollutant)]
+                options = {o: t.parameters.get(o, default) for o, default in CSTR_OPTIONS.items()}
+                state = CSTRState([t.parameters["c0"]], records=self.states[row:row+1], **options)
+                state.t = float(solver_time[row])
+                self.CSTR_state[(t.ID, t.pollutant)] = state
+        self.states[:] = states
+        for group in self.groups:
+            updated = []
+            for i, key in enumerate(zip(group.IDs, group.pollutants)):
+                if key in held:
+                    group.last[i], seconds = held[key]
+                    updated.append(seconds)
+            updated = [seconds for seconds in updated if not np.isnan(seconds)]
+            if group.interval is not None and updated and hotstart:
+                group.last_update = start_time + timedelta(seconds=min(updated))
+            elif not hotstart:
+                group.last_update = None
+        if not hotstart:
+            # The saved clock can be ahead of this simulation, which would
+            # give a negative dt. Step 0 resets the stateful methods, so the
+            # next step must not be step 0.
+            self.step_index = max(self.step_index, 1)
+            return
+        self.start_time = start_time
+        self.last_timestep = last_timestep
+        self.dt = dt
+        self.step_index = step_index
+
+
+    def _pollut(self, ID, element_type, name):
+        """
+        Returns the pollutant vector of a node or link read by a per-asset
+        method from the per-step state cache, so the treatments of every
+        pollutant of an asset share one toolkit read per step.
+        """
+
+        buffer = self.cache.buffer(element_type, name)
+        if ID not in buffer.row:
+            buffer.rows([ID])
+        return self.cache.read(buffer, np.array([buffer.row[ID]]))[0]
+
+
+    def _result(self, ID, element_type, name):
+        """
+        Returns a hydraulic result of a node or link read by a per-asset
+        method from the per-step state cache (see RESULT_INPUTS).
+        """
+
+        return self._pollut(ID, element_type, name)
 
 
     def _EventMeanConc(self, ID, pollutantID, parameters, element_type):
@@ -146,19 +1507,18 @@ class waterQuality:
 
         R = pollutant removal fraction (unitless)
         """
-        # Get pollutant index
-        pollutant_index = self.sim._model.getObjectIDIndex(tka.ObjectType.POLLUT, pollutantID)
+        pollutant_index = self.pollutant_index[pollutantID]
 
         if element_type == ElementType.Nodes:
             # Get SWMM parameter
-            Cin = self.sim._model.getNodePollut(ID, tka.NodePollut.inflowQual.value)[pollutant_index]
+            Cin = self._pollut(ID, element_type, "inflowQual")[pollutant_index]
             # Calculate new concentration
             Cnew = (1-parameters["R"])*Cin
             # Set new concentration
             self.sim._model.setNodePollut(ID, pollutantID, Cnew)
         else:
             # Get SWMM parameter
-            Cin = self.sim._model.getLinkPollut(ID, tka.LinkPollut.reactorQual.value)[pollutant_index]
+            Cin = self._pollut(ID, element_type, "reactorQual")[pollutant_index]
             # Calculate new concentration
             Cnew = (1-parameters["R"])*Cin
             # Set new concentration
@@ -175,19 +1535,18 @@ class waterQuality:
         R2 = pollutant removal fraction for other pollutant (unitless)
         """
 
-        # Get pollutant index
-        pollutant_index = self.sim._model.getObjectIDIndex(tka.ObjectType.POLLUT, pollutantID)
+        pollutant_index = self.pollutant_index[pollutantID]
 
         if element_type == ElementType.Nodes:
             # Get SWMM parameter
-            Cin = self.sim._model.getNodePollut(ID, tka.NodePollut.inflowQual.value)[pollutant_index]
+            Cin = self._pollut(ID, element_type, "inflowQual")[pollutant_index]
             # Calculate new concentration
             Cnew = (1-parameters["R1"]*parameters["R2"])*Cin
             # Set new concentration
             self.sim._model.setNodePollut(ID, pollutantID, Cnew)
         else:
             # Get SWMM parameter
-            Cin = self.sim._model.getLinkPollut(ID, tka.LinkPollut.reactorQual.value)[pollutant_index]
+            Cin = self._pollut(ID, element_type, "reactorQual")[pollutant_index]
             # Calculate new concentration
             Cnew = (1-parameters["R1"]*parameters["R2"])*Cin
             # Set new concentration
@@ -206,12 +1565,11 @@ class waterQuality:
         """
 
         parameters = parameters
-        # Get pollutant index
-        pollutant_index = self.sim._model.getObjectIDIndex(tka.ObjectType.POLLUT, pollutantID)
+        pollutant_index = self.pollutant_index[pollutantID]
 
         if element_type == ElementType.Nodes:
             # Get SWMM parameter
-            Cin = self.sim._model.getNodePollut(ID, tka.NodePollut.inflowQual.value)[pollutant_index]
+            Cin = self._pollut(ID, element_type, "inflowQual")[pollutant_index]
             # Calculate removal
             R = (1-np.heaviside((Cin-parameters["BC"]), 0))\
             *parameters["R_l"]+np.heaviside((Cin\
@@ -222,7 +1580,7 @@ class waterQuality:
             self.sim._model.setNodePollut(ID, pollutantID, Cnew)
         else:
             # Get SWMM parameter
-            Cin = self.sim._model.getLinkPollut(ID, tka.LinkPollut.reactorQual.value)[pollutant_index]
+            Cin = self._pollut(ID, element_type, "reactorQual")[pollutant_index]
             # Calculate removal
             R = (1-np.heaviside((Cin-parameters["BC"]), 0))\
             *parameters["R_l"]+np.heaviside((Cin\
@@ -241,31 +1599,32 @@ class waterQuality:
 
             k   = reaction rate constant (SI: m/hr, US: ft/hr)
             n   = reaction order (first order, second order, etc.) (unitless)
+
+            NOTE: The reaction is integrated over the model dt with
+            StormReactor.kernels.nth_order_reaction: exact for n = 0, 1
+            and 2, an exponential integrator sub-stepped at the routing
+            step otherwise, and never negative.
             """
 
             parameters = parameters
-            # Get pollutant index
-            pollutant_index = self.sim._model.getObjectIDIndex(tka.ObjectType.POLLUT, pollutantID)
-
-            # Get current time
-            current_step = self.sim.current_time
-            # Calculate model dt in seconds
-            dt = (current_step - self.last_timestep).total_seconds()
+            pollutant_index = self.pollutant_index[pollutantID]
+            k = np.array([parameters["k"]], dtype=float)
+            n = np.array([parameters["n"]], dtype=float)
 
             if element_type == ElementType.Nodes:
                 # Get SWMM parameter
-                C = self.sim._model.getNodePollut(ID, tka.NodePollut.reactorQual.value)[pollutant_index]
+                C = self._pollut(ID, element_type, "reactorQual")[pollutant_index]
                 # Calculate treatment
-                Cnew = C - (parameters["k"]*(C**parameters["n"])*dt)
+                Cnew = nth_order_reaction(np.array([C]), self.dt, self.routing_step, k, n)
                 # Set new concentration
-                self.sim._model.setNodePollut(ID, pollutantID, Cnew)
+                self.sim._model.setNodePollut(ID, pollutantID, float(Cnew[0]))
             else:
                 # Get SWMM parameter
-                C = self.sim._model.getLinkPollut(ID, tka.LinkPollut.reactorQual.value)[pollutant_index]
+                C = self._pollut(ID, element_type, "reactorQual")[pollutant_index]
                 # Calculate treatment
-                Cnew = C - (parameters["k"]*(C**parameters["n"])*dt)
+                Cnew = nth_order_reaction(np.array([C]), self.dt, self.routing_step, k, n)
                 # Set new concentration
-                self.sim._model.setLinkPollut(ID, pollutantID, Cnew)
+                self.sim._model.setLinkPollut(ID, pollutantID, float(Cnew[0]))
 
 
     def _kCModel(self, ID, pollutantID, parameters, element_type):
@@ -279,14 +1638,13 @@ class waterQuality:
         """
 
         parameters = parameters
-        # Get pollutant index
-        pollutant_index = self.sim._model.getObjectIDIndex(tka.ObjectType.POLLUT, pollutantID)
+        pollutant_index = self.pollutant_index[pollutantID]
 
         if element_type == ElementType.Nodes:
             # Get SWMM parameters
-            Cin = self.sim._model.getNodePollut(ID, tka.NodePollut.inflowQual.value)[pollutant_index]
-            d = self.sim._model.getNodeResult(ID, tka.NodeResults.newDepth.value)
-            hrt = self.sim._model.getNodeResult(ID, tka.NodeResults.hyd_res_time.value)
+            Cin = self._pollut(ID, element_type, "inflowQual")[pollutant_index]
+            d = self._result(ID, element_type, "newDepth")
+            hrt = self._result(ID, element_type, "hyd_res_time")
             # Calculate removal
             if d != 0.0 and Cin != 0.0:
                 R = np.heaviside((Cin-parameters["C_s"]), 0)\
@@ -312,19 +1670,16 @@ class waterQuality:
         """
 
         parameters = parameters
-        # Get pollutant index
-        pollutant_index = self.sim._model.getObjectIDIndex(tka.ObjectType.POLLUT, pollutantID)
+        pollutant_index = self.pollutant_index[pollutantID]
 
-        # Get current time
-        current_step = self.sim.current_time
-        # Calculate model dt in seconds
-        dt = (current_step - self.last_timestep).total_seconds()
+        # Model dt in seconds, computed once per step
+        dt = self.dt
 
         if element_type == ElementType.Nodes:
             # Get SWMM parameters
-            Cin = self.sim._model.getNodePollut(ID, tka.NodePollut.inflowQual.value)[pollutant_index]
-            Qin = self.sim._model.getNodeResult(ID, tka.NodeResults.totalinflow.value)
-            d = self.sim._model.getNodeResult(ID, tka.NodeResults.newDepth.value)
+            Cin = self._pollut(ID, element_type, "inflowQual")[pollutant_index]
+            Qin = self._result(ID, element_type, "totalinflow")
+            d = self._result(ID, element_type, "newDepth")
             if d != 0.0:
                 # Calculate new concentration
                 Cnew = np.heaviside((0.1-Qin), 0)*(parameters["C_s"]\
@@ -334,12 +1689,12 @@ class waterQuality:
                 Cnew = np.heaviside((0.1-Qin), 0)*parameters["C_s"]\
                 +(Cin-parameters["C_s"])+(1-np.heaviside((0.1-Qin), 0))*Cin
             # Set new concentration
-            self.sim._model.setNodePollut(ID, pollutantID, Cnew)
+            self.sim._model.setNodePollut(ID, pollutantID, max(Cnew, 0.0))
         else:
             # Get SWMM parameters
-            C = self.sim._model.getLinkPollut(ID, tka.LinkPollut.reactorQual.value)[pollutant_index]
-            Q = self.sim._model.getLinkResult(ID, tka.LinkResults.newFlow.value)
-            d = self.sim._model.getLinkResult(ID, tka.LinkResults.newDepth.value)
+            C = self._pollut(ID, element_type, "reactorQual")[pollutant_index]
+            Q = self._result(ID, element_type, "totalinflow")
+            d = self._result(ID, element_type, "newDepth")
             if d != 0.0:
                 # Calculate new concentration
                 Cnew = np.heaviside((0.1-Q), 0)*(parameters["C_s"]\
@@ -349,7 +1704,7 @@ class waterQuality:
                 Cnew = np.heaviside((0.1-Q), 0)*parameters["C_s"]\
                 +(C-parameters["C_s"])+(1-np.heaviside((0.1-Q), 0))*C
             # Set new concentration
-            self.sim._model.setLinkPollut(ID, pollutantID, Cnew)
+            self.sim._model.setLinkPollut(ID, pollutantID, max(Cnew, 0.0))
 
 
     """
@@ -431,61 +1786,53 @@ class waterQuality:
     """
 
 
-    def _CSTR_tank(self, t, C, Qin, Cin, Qout, V, k, n):
-        """
-        UNSTEADY CONTINUOUSLY STIRRED TANK REACTOR (CSTR)
-        CSTR is a common model for a chemical reactor. The behavior of a CSTR
-        is modeled assuming it is not in steady state. This is because
-        outflow, inflow, volume, and concentration are constantly changing.
-
-        NOTE: You do not need to call this method, only the CSTR_solver.
-        CSTR_tank is intitalized in __init__ in Node_Treatment.
-        """
-        dCdt = (Qin*Cin - Qout*C)/V + k*C**n
-        return dCdt
-
-
     def _CSTRSolver(self, index, ID, pollutantID, parameters, element_type):
         """
         UNSTEADY CONTINUOUSLY STIRRED TANK REACTOR (CSTR) SOLVER
         CSTR is a common model for a chemical reactor. The behavior of a CSTR
         is modeled assuming it is not in steady state. This is because
         outflow, inflow, volume, and concentration are constantly changing.
-        Therefore, Scipy.Integrate.ode solver is used to solve for concentration.
+        Zero- and first-order reactions (n = 0 or 1) are updated with the
+        exact solution over the step; other orders are integrated with the
+        chosen Scipy integrator and an analytic Jacobian.
 
-        NOTE: You only need to call this method, not CSTR_tank. CSTR_tank is
-        intitalized in __init__ in Node_Treatment.
+        NOTE: Each asset keeps its own concentration and solver time in
+        self.CSTR_state. With vectorize=True all CSTR assets are instead
+        integrated together by StormReactor.kernels.cstr.
 
         k   = reaction rate constant (SI/US: 1/s)
         n   = reaction order (first order, second order, etc.) (unitless)
         c0  = intital concentration inside reactor (SI/US: mg/L)
+
+        Optional solver parameters (see StormReactor.kernels.CSTRState):
+        integrator = "vode" (default), "vode-bdf", "lsoda", "BDF", "Radau"
+                     or "LSODA"
+        rtol, atol = solver tolerances (default 1e-6, 1e-12)
+        V_min      = volume at or below which the tank is treated as empty
+                     and follows the inflow concentration (default 0)
         """
 
-        # Get current time
-        current_step = self.sim.current_time
-        # Calculate model dt in seconds
-        dt = (current_step - self.last_timestep).total_seconds()
-        # Get pollutant index
-        pollutant_index = self.sim._model.getObjectIDIndex(tka.ObjectType.POLLUT, pollutantID)
+        pollutant_index = self.pollutant_index[pollutantID]
 
         if element_type == ElementType.Nodes:
             # Get SWMM parameters
-            Cin = self.sim._model.getNodePollut(ID, tka.NodePollut.inflowQual.value)[pollutant_index]
-            Qin = self.sim._model.getNodeResult(ID, tka.NodeResults.totalinflow.value)
-            Qout = self.sim._model.getNodeResult(ID, tka.NodeResults.outflow.value)
-            V = self.sim._model.getNodeResult(ID, tka.NodeResults.newVolume.value)
-
-            # Parameterize solver
-            self.solver.set_f_params(Qin, Cin, Qout, V, parameters["k"], parameters["n"])
-            # Solve ODE
-            if index == 0:
-                self.solver.set_initial_value(parameters["c0"], 0.0)
-                self.solver.integrate(self.solver.t+dt)
-            else:
-                self.solver.set_initial_value(self.solver.y, self.solver.t)
-                self.solver.integrate(self.solver.t+dt)
+            Cin = self._pollut(ID, element_type, "inflowQual")[pollutant_index]
+            Qin = self._result(ID, element_type, "totalinflow")
+            Qout = self._result(ID, element_type, "outflow")
+            V = self._result(ID, element_type, "newVolume")
+
+            # Each asset integrates from its own state
+            if index == 0 or (ID, pollutantID) not in self.CSTR_state:
+                options = {o: parameters.get(o, default) for o, default in CSTR_OPTIONS.items()}
+                row = self.state_rows[(ID, pollutantID)]
+                self.CSTR_state[(ID, pollutantID)] = CSTRState([parameters["c0"]], records=self.states[row:row+1],
+                                                               **options)
+            state = self.CSTR_state[(ID, pollutantID)]
+            state.last_update = (self.sim.current_time - self.start_time).total_seconds()
+            Cnew = cstr(state, np.array([Cin]), np.array([Qin]), np.array([Qout]), np.array([V]),
+                        self.dt, np.array([parameters["k"]], dtype=float), np.array([parameters["n"]], dtype=float))
             # Set new concentration
-            self.sim._model.setNodePollut(ID, pollutantID, self.solver.y[0])
+            self.sim._model.setNodePollut(ID, pollutantID, float(Cnew[0]))
         else:
             print("CSTR does not work for links.")
 
@@ -505,24 +1852,23 @@ class waterQuality:
         """
 
         parameters = parameters
-        t = 0
-        # Get pollutant index
-        pollutant_index = self.sim._model.getObjectIDIndex(tka.ObjectType.POLLUT, pollutantID)
+        pollutant_index = self.pollutant_index[pollutantID]
+        # Time elapsed since water entered the node is kept in the asset's
+        # state record across steps
+        state = self.states[self.state_rows[(ID, pollutantID)]]
+        if index == 0:
+            state["event_time"] = 0.0
+        state["last_update"] = (self.sim.current_time - self.start_time).total_seconds()
 
         if element_type == ElementType.Nodes:
             # Get SWMM parameters
-            Cin = self.sim._model.getNodePollut(ID, tka.NodePollut.inflowQual.value)[pollutant_index]
-            Qin = self.sim._model.getNodeResult(ID, tka.NodeResults.totalinflow.value)
+            Cin = self._pollut(ID, element_type, "inflowQual")[pollutant_index]
+            Qin = self._result(ID, element_type, "totalinflow")
             # Time calculations for phosphorus model
             if Qin >= 0.01:
-                # Get current time
-                current_step = self.sim.current_time
-                # Calculate model dt in seconds
-                dt = (current_step - self.last_timestep).total_seconds()
                 # Accumulate time elapsed since water entered node
-                t = t + dt
-                # Updating reference step
-                self.last_timestep = current_step
+                state["event_time"] += self.dt
+                t = state["event_time"]
                 # Calculate new concentration
                 Cnew = (Cin*np.exp((-parameters["k"]*parameters["L"]\
                     *parameters["A"]*parameters["E"])/Qin))+(parameters["Ceq0"]\
@@ -531,6 +1877,6 @@ class waterQuality:
                 # Set new concentration
                 self.sim._model.setNodePollut(ID, pollutantID, Cnew)
             else:
-                t = 0
+                state["event_time"] = 0.0
         else:
             print("Phosphorus does not work for links.")
@@ -23,7 +23,10 @@ setuptools.setup(
         "pyswmm>=1.2",
         "scipy>=1.7",
     ],
-    python_requires='>=3.6',
+    extras_require={
+        "numba": ["numba>=0.56"],
+    },
+    python_requires='>=3.7',
 
     keywords= "swmm pyswmm pollutants modeling water-quality",
 )